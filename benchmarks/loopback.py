@@ -0,0 +1,324 @@
+"""
+Drive a MidiRouter through in-process loopback ports with synthetic workloads
+and report throughput and end-to-end latency.
+
+Latency is measured from handing a message to the input port's callback (as
+rtmidi would) until the router calls send on an output port.
+
+Run from the repository root:
+
+    $ python -m benchmarks.loopback
+    $ python -m benchmarks.loopback --raw --dispatch direct --workload clock sysex --mappings 1 100
+    $ python -m benchmarks.loopback --paced
+    $ python -m benchmarks.loopback --paced --gc auto freeze manual --realtime-priority 50 --cpus 2
+"""
+import argparse
+import collections
+import random
+import threading
+import time
+
+import mido
+
+from midi_router import config
+from midi_router.capture import CaptureWriter
+from midi_router.midi_router import MidiRouter
+from midi_router.output_queue import QueuedOutputPort
+from midi_router.realtime import GC_MODES, apply_realtime_settings, format_report, parse_cpus
+from midi_router.routing_table import RoutingTable
+
+
+NUM_INPUTS = 4
+NUM_OUTPUTS = 4
+INPUT_NAMES = [f"Loopback In {index}" for index in range(NUM_INPUTS)]
+OUTPUT_NAMES = [f"Loopback Out {index}" for index in range(NUM_OUTPUTS)]
+
+# Workload events are (seconds since start, input index, message)
+WorkloadEvent = collections.namedtuple("WorkloadEvent", ["at", "input_index", "message"])
+
+
+class LoopbackInputPort:
+    def __init__(self, name, callback, raw):
+        self.name = name
+        self.callback = callback
+        self.raw = raw
+
+    def inject(self, message):
+        if self.raw:
+            self.callback((message, 0.0), self.name)
+        else:
+            self.callback(message)
+
+    def close(self):
+        pass
+
+
+class LoopbackOutputPort:
+    def __init__(self, name, send_time=0.0):
+        self.name = name
+        self.send_time = send_time
+        self.arrivals = []
+
+    def send(self, message):
+        if self.send_time:
+            # Simulate a slow device (e.g. DIN midi at 31.25 kbaud)
+            time.sleep(self.send_time)
+        self.arrivals.append(time.perf_counter_ns())
+
+    send_message = send
+
+    def close(self):
+        pass
+
+
+class LoopbackRouter(MidiRouter):
+    """MidiRouter whose ports are loopback ports instead of rtmidi ports."""
+    def __init__(self, *args, send_time=0.0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.send_time = send_time
+        self.loopback_inputs = {}
+        self.loopback_outputs = {}
+
+    def _get_port_names(self):
+        return list(INPUT_NAMES), list(OUTPUT_NAMES)
+
+    def _open_input_port(self, long_name):
+        if self.raw:
+            callback = self._receive_raw_message_callback
+        else:
+            callback = self._create_receive_message_callback(long_name)
+        port = self.loopback_inputs[long_name] = LoopbackInputPort(long_name, callback, self.raw)
+        return port
+
+    def _open_output_port(self, long_name):
+        port = self.loopback_outputs[long_name] = LoopbackOutputPort(long_name, self.send_time)
+        if self.output_queue_size:
+            return QueuedOutputPort(port, raw=self.raw, maxsize=self.output_queue_size)
+        return self.dispatcher.wrap_output_port(port)
+
+
+def make_config(num_mappings):
+    mappings = []
+    for index in range(num_mappings):
+        from_channel = (index // (NUM_INPUTS * NUM_OUTPUTS)) % 4
+        mappings.append({
+            "from_port": {"identifier": f"in_{index % NUM_INPUTS}"},
+            "to_port": {"identifier": f"out_{(index // NUM_INPUTS) % NUM_OUTPUTS}"},
+            "from_channel": from_channel,
+            "to_channel": (from_channel + index) % 16,
+        })
+    return config.Config.model_validate({
+        "ports": {
+            "inputs": [
+                {"identifier": f"in_{index}", "name": name, "port_type": "USB"}
+                for index, name in enumerate(INPUT_NAMES)
+            ],
+            "outputs": [
+                {"identifier": f"out_{index}", "name": name, "port_type": "USB"}
+                for index, name in enumerate(OUTPUT_NAMES)
+            ],
+        },
+        "mappings": mappings,
+    })
+
+
+def chords_workload(rng, seconds):
+    """8 note chords on and off every 20ms on every input."""
+    events = []
+    for step in range(int(seconds / 0.02)):
+        at = step * 0.02
+        for input_index in range(NUM_INPUTS):
+            channel = rng.randrange(4)
+            root = rng.randrange(36, 72)
+            notes = [root + interval for interval in (0, 4, 7, 11, 12, 16, 19, 23)]
+            message_type = "note_on" if step % 2 == 0 else "note_off"
+            for note in notes:
+                events.append(WorkloadEvent(at, input_index, mido.Message(message_type, channel=channel, note=note, velocity=100)))
+    return events
+
+
+def clock_workload(rng, seconds, bpm=300):
+    """24 ppqn clock from one input, bracketed by start and stop."""
+    interval = 60 / (bpm * 24)
+    events = [WorkloadEvent(0.0, 0, mido.Message("start"))]
+    events.extend(
+        WorkloadEvent(tick * interval, 0, mido.Message("clock"))
+        for tick in range(int(seconds / interval))
+    )
+    events.append(WorkloadEvent(seconds, 0, mido.Message("stop")))
+    return events
+
+
+def cc14_workload(rng, seconds, pairs_per_second=2000):
+    """14-bit controller sweeps (MSB then LSB) across 16 controllers."""
+    events = []
+    for index in range(int(seconds * pairs_per_second)):
+        at = index / pairs_per_second
+        input_index = index % NUM_INPUTS
+        channel = rng.randrange(4)
+        control = index % 16
+        value = (index * 37) % 16384
+        events.append(WorkloadEvent(at, input_index, mido.Message("control_change", channel=channel, control=control, value=value >> 7)))
+        events.append(WorkloadEvent(at, input_index, mido.Message("control_change", channel=channel, control=control + 32, value=value & 0x7F)))
+    return events
+
+
+def sysex_workload(rng, seconds, dump_size=32 * 1024, dumps_per_second=4):
+    """Large sysex dumps, as sent when transferring patch banks."""
+    data = tuple(rng.randrange(128) for _ in range(dump_size - 2))
+    return [
+        WorkloadEvent(index / dumps_per_second, index % NUM_INPUTS, mido.Message("sysex", data=data))
+        for index in range(max(1, int(seconds * dumps_per_second)))
+    ]
+
+
+WORKLOADS = {
+    "chords": chords_workload,
+    "clock": clock_workload,
+    "cc14": cc14_workload,
+    "sysex": sysex_workload,
+}
+
+
+class _ShadowPort:
+    def __init__(self, name, sink):
+        self.name = name
+        self._sink = sink
+
+    def send(self, message):
+        self._sink(self.name)
+
+
+def expected_deliveries(router_config, events):
+    """
+    For every output, the indexes of the events it should receive, in order.
+    Computed by routing the workload through a separately compiled table.
+    """
+    expected = {name: [] for name in OUTPUT_NAMES}
+    current = [0]
+    sink = lambda name: expected[name].append(current[0])
+    routing_table = RoutingTable.compile(
+        router_config.mappings,
+        {f"in_{index}": _ShadowPort(name, sink) for index, name in enumerate(INPUT_NAMES)},
+        {f"out_{index}": _ShadowPort(name, sink) for index, name in enumerate(OUTPUT_NAMES)},
+    )
+    for index, event in enumerate(events):
+        current[0] = index
+        routing_table.route(INPUT_NAMES[event.input_index], event.message)
+    return expected
+
+
+def run_workload(events, num_mappings, raw=False, dispatch="queue", paced=False, router_kwargs=None):
+    router_config = make_config(num_mappings)
+    router = LoopbackRouter(router_config, raw=raw, dispatch=dispatch, **(router_kwargs or {}))
+    thread = threading.Thread(target=router.run, daemon=True)
+    thread.start()
+    if not router.running.wait(timeout=5):
+        raise RuntimeError("router didn't start")
+
+    inputs = [router.loopback_inputs[name] for name in INPUT_NAMES]
+    messages = [event.message.bytes() if raw else event.message for event in events]
+    injected_at = [0] * len(events)
+
+    start = time.perf_counter()
+    for index, event in enumerate(events):
+        if paced:
+            # Sleep most of the way, then spin for accurate timing
+            remaining = start + event.at - time.perf_counter()
+            if remaining > 0.002:
+                time.sleep(remaining - 0.001)
+            while time.perf_counter() < start + event.at:
+                pass
+        injected_at[index] = time.perf_counter_ns()
+        inputs[event.input_index].inject(messages[index])
+
+    expected = expected_deliveries(router_config, events)
+    num_expected = sum(len(indexes) for indexes in expected.values())
+    outputs = router.loopback_outputs
+    deadline = time.perf_counter() + 10
+    while sum(len(port.arrivals) for port in outputs.values()) < num_expected and time.perf_counter() < deadline:
+        time.sleep(0.01)
+
+    # Snapshot before stopping, which releases held notes
+    arrivals_by_name = {name: list(port.arrivals) for name, port in outputs.items()}
+    router.stop()
+    thread.join(timeout=5)
+
+    latencies_us = []
+    delivered = 0
+    last_arrival = injected_at[-1] if injected_at else 0
+    for name, indexes in expected.items():
+        arrivals = arrivals_by_name[name]
+        delivered += len(arrivals)
+        if arrivals:
+            last_arrival = max(last_arrival, arrivals[-1])
+        # Deliveries to an output happen in order, so pair them with the expected events.
+        # This isn't possible when messages were coalesced or dropped.
+        if len(arrivals) == len(indexes):
+            latencies_us.extend((arrival - injected_at[index]) / 1000 for arrival, index in zip(arrivals, indexes))
+
+    elapsed = max((last_arrival - injected_at[0]) / 1e9, 1e-9) if injected_at else 1e-9
+    return {
+        "injected": len(events),
+        "expected": num_expected,
+        "delivered": delivered,
+        "throughput": len(events) / elapsed,
+        "latencies_us": sorted(latencies_us),
+    }
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return float("nan")
+    return sorted_values[min(int(fraction * len(sorted_values)), len(sorted_values) - 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workload", nargs="+", choices=list(WORKLOADS), default=list(WORKLOADS))
+    parser.add_argument("--mappings", type=int, nargs="+", default=[1, 10, 100])
+    parser.add_argument("--seconds", type=float, default=1.0, help="Length of each workload [%(default)s]")
+    parser.add_argument("--raw", action="store_true", help="Run the router in raw mode")
+    parser.add_argument("--dispatch", choices=["queue", "direct"], default="queue")
+    parser.add_argument("--paced", action="store_true",
+                        help="Inject messages at the workload's own timing instead of as fast as possible")
+    parser.add_argument("--output-queue-size", metavar="N", type=int, default=0,
+                        help="Give every output its own send queue (see start --output-queue-size)")
+    parser.add_argument("--send-time", metavar="SECONDS", type=float, default=0.0,
+                        help="Simulate slow outputs, taking this long for every send")
+    parser.add_argument("--capture", metavar="FILE",
+                        help="Capture all incoming messages to FILE (see start --capture)")
+    parser.add_argument("--gc", nargs="+", choices=GC_MODES, default=["auto"],
+                        help="Run every workload in each of these gc modes (see start --gc)")
+    parser.add_argument("--realtime-priority", metavar="N", type=int, help="See start --realtime-priority")
+    parser.add_argument("--cpus", metavar="LIST", help="See start --cpus")
+    parser.add_argument("--lock-memory", action="store_true", help="See start --lock-memory")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    report = apply_realtime_settings(
+        priority=args.realtime_priority, cpus=parse_cpus(args.cpus) if args.cpus else None, lock=args.lock_memory)
+    if report:
+        print(format_report(report))
+    router_kwargs = {"output_queue_size": args.output_queue_size, "send_time": args.send_time}
+    if args.capture:
+        router_kwargs["capture"] = CaptureWriter(args.capture)
+
+    print(f"raw={args.raw} dispatch={args.dispatch} paced={args.paced} "
+          f"output_queue_size={args.output_queue_size} send_time={args.send_time} capture={args.capture}")
+    print(f"{'workload':>8}  {'mappings':>8}  {'gc':>6}  {'injected':>9}  {'delivered':>10}  {'msgs/s':>10}  "
+          f"{'p50 us':>8}  {'p99 us':>8}  {'max us':>9}")
+    for workload in args.workload:
+        events = WORKLOADS[workload](random.Random(args.seed), args.seconds)
+        for num_mappings in args.mappings:
+            for gc_mode in args.gc:
+                result = run_workload(events, num_mappings, raw=args.raw, dispatch=args.dispatch, paced=args.paced,
+                                      router_kwargs=dict(router_kwargs, gc_mode=gc_mode))
+                latencies_us = result["latencies_us"]
+                delivered = f"{result['delivered']}/{result['expected']}"
+                print(f"{workload:>8}  {num_mappings:>8}  {gc_mode:>6}  {result['injected']:>9}  {delivered:>10}  "
+                      f"{result['throughput']:>10.0f}  {percentile(latencies_us, 0.5):>8.0f}  "
+                      f"{percentile(latencies_us, 0.99):>8.0f}  {(latencies_us[-1] if latencies_us else float('nan')):>9.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Compare the compiled RoutingTable against the per-message Mapper chain.
+
+Run from the repository root:
+
+    $ python -m benchmarks.routing_table
+"""
+import argparse
+import timeit
+
+import mido
+
+from midi_router import config
+from midi_router.mapper import Mapper
+from midi_router.routing_table import RoutingTable
+
+
+NUM_INPUTS = 4
+NUM_OUTPUTS = 4
+
+
+class NullPort:
+    def __init__(self, name):
+        self.name = name
+
+    def send(self, message):
+        pass
+
+
+def make_mappings(num_mappings):
+    return [
+        config.Mapping(
+            from_port=config.PortSpecifier(identifier=f"in_{index % NUM_INPUTS}"),
+            to_port=config.PortSpecifier(identifier=f"out_{(index // NUM_INPUTS) % NUM_OUTPUTS}"),
+            from_channel=index % 16,
+            to_channel=(index * 7) % 16,
+        )
+        for index in range(num_mappings)
+    ]
+
+
+def make_mapper_chain(mappings, input_ports_by_identifier, output_ports_by_identifier):
+    # Mirrors the removed MidiRouter._create_mappers_by_input_port_name
+    mappers_by_input_port_name = {port.name: [] for port in input_ports_by_identifier.values()}
+    for mapping_config in mappings:
+        mapper = Mapper.from_mapping_config(mapping_config, input_ports_by_identifier, output_ports_by_identifier)
+        long_name = input_ports_by_identifier[mapping_config.from_port.identifier].name
+        mappers_by_input_port_name[long_name].append(mapper)
+    return mappers_by_input_port_name
+
+
+def run(num_mappings, number):
+    input_ports_by_identifier = {f"in_{index}": NullPort(f"Input {index}") for index in range(NUM_INPUTS)}
+    output_ports_by_identifier = {f"out_{index}": NullPort(f"Output {index}") for index in range(NUM_OUTPUTS)}
+    mappings = make_mappings(num_mappings)
+
+    mappers_by_input_port_name = make_mapper_chain(mappings, input_ports_by_identifier, output_ports_by_identifier)
+    routing_table = RoutingTable.compile(mappings, input_ports_by_identifier, output_ports_by_identifier)
+
+    messages = [
+        (f"Input {index % NUM_INPUTS}", mido.Message("note_on", channel=index % 16, note=60, velocity=100))
+        for index in range(64)
+    ]
+
+    def mapper_chain():
+        for input_port_name, message in messages:
+            for mapper in mappers_by_input_port_name.get(input_port_name, []):
+                mapper.send(input_port_name, message)
+
+    def table():
+        for input_port_name, message in messages:
+            routing_table.route(input_port_name, message)
+
+    mapper_seconds = min(timeit.repeat(mapper_chain, number=number, repeat=5))
+    table_seconds = min(timeit.repeat(table, number=number, repeat=5))
+    per_message = 1e6 / (number * len(messages))
+    return mapper_seconds * per_message, table_seconds * per_message
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mappings", type=int, nargs="+", default=[1, 10, 30, 100])
+    parser.add_argument("--number", type=int, default=200)
+    args = parser.parse_args()
+
+    print(f"{'mappings':>8}  {'mapper chain (us/msg)':>22}  {'routing table (us/msg)':>22}  {'speedup':>8}")
+    for num_mappings in args.mappings:
+        mapper_us, table_us = run(num_mappings, args.number)
+        print(f"{num_mappings:>8}  {mapper_us:>22.2f}  {table_us:>22.2f}  {mapper_us / table_us:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Measure how long the router takes from launching the process until messages
+are being routed, with and without a cached config.
+
+Every run starts a new interpreter that goes through the same steps as
+`midi-router start` (with loopback ports instead of rtmidi ports) and reports
+when each step finished.
+
+Run from the repository root:
+
+    $ python -m benchmarks.startup
+    $ python -m benchmarks.startup --mappings 200 --runs 20
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+
+STEPS = ["cli import", "router import", "config load", "routing"]
+
+
+def run_child(config_path):
+    """The measured process. Prints the time.time_ns() at which every step finished."""
+    finished_at = []
+    import midi_router.cli  # noqa: F401
+    finished_at.append(time.time_ns())
+    from midi_router.config_cache import load_config
+    from benchmarks.loopback import LoopbackRouter
+    finished_at.append(time.time_ns())
+    router_config = load_config(config_path)
+    finished_at.append(time.time_ns())
+    router = LoopbackRouter(router_config)
+    thread = threading.Thread(target=router.run, daemon=True)
+    thread.start()
+    if not router.running.wait(timeout=10):
+        raise RuntimeError("router didn't start")
+    finished_at.append(time.time_ns())
+    router.stop()
+    thread.join(timeout=5)
+    print(json.dumps(finished_at))
+
+
+def measure(config_path, cached):
+    """Milliseconds from launching the process until the end of every step."""
+    from midi_router.config_cache import get_config_cache_path
+
+    cache_path = get_config_cache_path(config_path)
+    if not cached and os.path.exists(cache_path):
+        os.remove(cache_path)
+    launched_at = time.time_ns()
+    output = subprocess.run(
+        [sys.executable, "-m", "benchmarks.startup", "--child", config_path],
+        check=True, capture_output=True, text=True,
+    ).stdout
+    return [(finished_at - launched_at) / 1e6 for finished_at in json.loads(output.splitlines()[-1])]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mappings", type=int, default=100)
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--child", metavar="CONFIG", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        run_child(args.child)
+        return
+
+    from benchmarks.loopback import make_config
+
+    with tempfile.TemporaryDirectory() as directory:
+        config_path = os.path.join(directory, "config.yaml")
+        with open(config_path, "w") as stream:
+            make_config(args.mappings).to_yaml(stream=stream)
+
+        print(f"mappings={args.mappings} runs={args.runs} (median ms since launching the process)")
+        print(f"{'config':>8}  " + "  ".join(f"{step:>13}" for step in STEPS))
+        for cached in (False, True):
+            # Warm up the page cache and the config cache
+            measure(config_path, cached)
+            runs = [measure(config_path, cached) for _ in range(args.runs)]
+            medians = [statistics.median(run[index] for run in runs) for index in range(len(STEPS))]
+            print(f"{'cached' if cached else 'yaml':>8}  " + "  ".join(f"{median:>13.1f}" for median in medians))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+
+import mido
+
+from midi_router.transforms import CHANNEL_STATUS_BY_TYPE, SYSTEM_STATUS_BY_TYPE
+
+
+DEFAULT_CAPTURE_SIZE = 16 * 1024 * 1024
+
+# File layout: a fixed header, a table of input identifiers (as a json list),
+# then the ring of records. Every record is a RECORD header followed by the raw
+# midi bytes. A record with the WRAP_MARKER index (or the end of the ring being
+# too short for a record header) means the next record is at the start of the
+# ring.
+MAGIC = b"MIDICAP1"
+HEADER = struct.Struct("<8sQQQQQ")  # magic, ring size, head, tail, record count, start time (ns since epoch)
+HEADER_SIZE = 64
+IDENTIFIERS_SIZE = 4096
+RING_OFFSET = HEADER_SIZE + IDENTIFIERS_SIZE
+RECORD = struct.Struct("<QHH")  # ns since start, identifier index, length
+WRAP_MARKER = 0xFFFF
+# Longer messages (i.e. huge sysex dumps) are skipped rather than flushing most of the ring
+MAX_RECORD_FRACTION = 4
+
+# For writing mido messages without building their bytes (see CaptureWriter.record_message)
+STATUS_BY_TYPE = {**CHANNEL_STATUS_BY_TYPE, **SYSTEM_STATUS_BY_TYPE}
+MESSAGE_LENGTHS_BY_TYPE = {
+    **{message_type: 3 for message_type in CHANNEL_STATUS_BY_TYPE},
+    "program_change": 2,
+    "aftertouch": 2,
+    **{message_type: 1 for message_type in SYSTEM_STATUS_BY_TYPE},
+    "quarter_frame": 2,
+    "songpos": 3,
+    "song_select": 2,
+}
+DATA_ATTRIBUTES_BY_TYPE = {
+    "note_off": ("note", "velocity"),
+    "note_on": ("note", "velocity"),
+    "polytouch": ("note", "value"),
+    "control_change": ("control", "value"),
+    "program_change": ("program",),
+    "aftertouch": ("value",),
+    "song_select": ("song",),
+}
+PITCHWHEEL_OFFSET = 8192
+
+
+class CaptureWriter:
+    """
+    Appends every routed message to a preallocated, memory mapped ring file.
+
+    Records are written with struct.pack_into straight into the mapping, and
+    mido messages field by field, so capturing allocates nothing and costs no
+    system call. When
+    the ring is full, the oldest records are overwritten.
+    """
+    def __init__(self, path, size=DEFAULT_CAPTURE_SIZE):
+        self.path = path
+        self.size = size
+        self.skipped = 0
+        self._lock = threading.Lock()
+        self._identifiers = []
+        self._indexes_by_identifier = {}
+        self._identifiers_by_port_name = {}
+        self._indexes_by_port_name = {}
+        self._started_at = time.perf_counter_ns()
+
+        with open(path, "wb") as stream:
+            # Allocate every block now, so that writing never extends the file
+            stream.truncate(RING_OFFSET + size)
+            if hasattr(os, "posix_fallocate"):
+                os.posix_fallocate(stream.fileno(), 0, RING_OFFSET + size)
+        self._file = open(path, "r+b")
+        self._mmap = mmap.mmap(self._file.fileno(), RING_OFFSET + size)
+        self._head = self._tail = self._count = 0
+        HEADER.pack_into(self._mmap, 0, MAGIC, size, 0, 0, 0, time.time_ns())
+        self._write_identifiers()
+
+    def set_port_identifiers(self, identifiers_by_port_name):
+        """Called whenever input ports change, so that records refer to config identifiers."""
+        with self._lock:
+            self._identifiers_by_port_name = dict(identifiers_by_port_name)
+            self._indexes_by_port_name = {}
+
+    def _get_index(self, input_port_name):
+        identifier = self._identifiers_by_port_name.get(input_port_name, input_port_name)
+        index = self._indexes_by_identifier.get(identifier)
+        if index is None:
+            index = self._indexes_by_identifier[identifier] = len(self._identifiers)
+            self._identifiers.append(identifier)
+            self._write_identifiers()
+        self._indexes_by_port_name[input_port_name] = index
+        return index
+
+    def _write_identifiers(self):
+        encoded = json.dumps(self._identifiers).encode()
+        if len(encoded) >= IDENTIFIERS_SIZE:
+            raise ValueError("Too many input identifiers to capture")
+        self._mmap[HEADER_SIZE:HEADER_SIZE + len(encoded) + 1] = encoded + b"\n"
+
+    def record(self, input_port_name, data, received_at):
+        """
+        data is the raw midi bytes (a bytes-like object or a sequence of ints),
+        received_at the time.perf_counter_ns() it was received.
+        """
+        length = len(data)
+        if self._too_long(length):
+            return
+        mapping = self._mmap
+        with self._lock:
+            position = self._begin_record(input_port_name, length, received_at)
+            if length <= 3 or not isinstance(data, (bytes, bytearray, memoryview)):
+                # rtmidi's lists of ints have no buffer to copy from
+                for byte in data:
+                    mapping[position] = byte
+                    position += 1
+            else:
+                mapping[position:position + length] = data
+            self._end_record(length)
+
+    def record_message(self, input_port_name, message, received_at):
+        """Like record, for a mido message, whose fields are written without building its bytes first."""
+        message_type = message.type
+        if message_type == "sysex":
+            data = message.data
+            length = len(data) + 2
+        else:
+            length = MESSAGE_LENGTHS_BY_TYPE[message_type]
+        if self._too_long(length):
+            return
+        mapping = self._mmap
+        with self._lock:
+            position = self._begin_record(input_port_name, length, received_at)
+            status = STATUS_BY_TYPE[message_type]
+            if status < 0xF0:
+                status |= message.channel
+            mapping[position] = status
+            if message_type == "sysex":
+                position += 1
+                for byte in data:
+                    mapping[position] = byte
+                    position += 1
+                mapping[position] = 0xF7
+            elif message_type == "pitchwheel":
+                value = message.pitch + PITCHWHEEL_OFFSET
+                mapping[position + 1] = value & 0x7F
+                mapping[position + 2] = value >> 7
+            elif message_type == "songpos":
+                mapping[position + 1] = message.pos & 0x7F
+                mapping[position + 2] = message.pos >> 7
+            elif message_type == "quarter_frame":
+                mapping[position + 1] = message.frame_type << 4 | message.frame_value
+            else:
+                for attribute in DATA_ATTRIBUTES_BY_TYPE.get(message_type, ()):
+                    position += 1
+                    mapping[position] = getattr(message, attribute)
+            self._end_record(length)
+
+    def _too_long(self, length):
+        if RECORD.size + length > self.size // MAX_RECORD_FRACTION:
+            self.skipped += 1
+            return True
+        return False
+
+    def _begin_record(self, input_port_name, length, received_at):
+        """Make room for a record and write its header. Returns where its bytes go. Called with the lock held."""
+        mapping = self._mmap
+        index = self._indexes_by_port_name.get(input_port_name)
+        if index is None:
+            index = self._get_index(input_port_name)
+
+        size = self.size
+        head = self._head
+        record_size = RECORD.size + length
+        if head + record_size > size:
+            self._free(head, size)
+            if size - head >= RECORD.size:
+                RECORD.pack_into(mapping, RING_OFFSET + head, 0, WRAP_MARKER, 0)
+            head = self._head = 0
+        self._free(head, head + record_size)
+        if not self._count:
+            self._tail = head
+
+        position = RING_OFFSET + head
+        RECORD.pack_into(mapping, position, received_at - self._started_at, index, length)
+        return position + RECORD.size
+
+    def _end_record(self, length):
+        self._head += RECORD.size + length
+        self._count += 1
+        # head, tail and count
+        struct.pack_into("<QQQ", self._mmap, 16, self._head, self._tail, self._count)
+
+    def _free(self, start, end):
+        """Drop the oldest records until none starts within [start, end)."""
+        mapping = self._mmap
+        size = self.size
+        while self._count and start <= self._tail < end:
+            _, index, length = RECORD.unpack_from(mapping, RING_OFFSET + self._tail)
+            if index == WRAP_MARKER:
+                self._tail = 0
+                continue
+            tail = self._tail + RECORD.size + length
+            # The tail always points at a record header
+            self._tail = tail if size - tail >= RECORD.size else 0
+            self._count -= 1
+
+    def close(self):
+        with self._lock:
+            self._mmap.flush()
+            self._mmap.close()
+            self._file.close()
+
+
+def read_capture(path):
+    """
+    Read a capture, oldest record first. Returns (start time in ns since the
+    epoch, list of (ns since start, input identifier, bytes) records).
+    """
+    with open(path, "rb") as stream:
+        data = stream.read()
+    magic, size, head, tail, count, started_at = HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not a midi router capture")
+    identifiers = json.loads(data[HEADER_SIZE:RING_OFFSET].split(b"\n", 1)[0])
+
+    records = []
+    position = tail
+    while len(records) < count:
+        if size - position < RECORD.size:
+            position = 0
+            continue
+        timestamp, index, length = RECORD.unpack_from(data, RING_OFFSET + position)
+        if index == WRAP_MARKER:
+            position = 0
+            continue
+        start = RING_OFFSET + position + RECORD.size
+        records.append((timestamp, identifiers[index], data[start:start + length]))
+        position += RECORD.size + length
+    return started_at, records
+
+
+# Standard MIDI File export: 120 bpm, so a beat is 500ms
+SMF_TICKS_PER_BEAT = 480
+SMF_TEMPO = 500000
+
+
+def export_smf(capture_path, output_path):
+    """
+    Write a capture to a type 1 Standard MIDI File with a track per input.
+    Real-time messages (clock, start, stop...) and system common messages (MTC
+    quarter frames, song position...) can't be stored in a file and are left
+    out. Returns the number of messages written.
+    """
+    _, records = read_capture(capture_path)
+    midi_file = mido.MidiFile(type=1, ticks_per_beat=SMF_TICKS_PER_BEAT)
+    tempo_track = mido.MidiTrack([mido.MetaMessage("set_tempo", tempo=SMF_TEMPO, time=0)])
+    midi_file.tracks.append(tempo_track)
+    tracks = {}
+    last_ticks = {}
+    written = 0
+    first_timestamp = records[0][0] if records else 0
+    for timestamp, identifier, data in records:
+        # Only sysex of the system messages can be stored
+        if data[0] > 0xF0:
+            continue
+        track = tracks.get(identifier)
+        if track is None:
+            track = tracks[identifier] = mido.MidiTrack([mido.MetaMessage("track_name", name=identifier, time=0)])
+            midi_file.tracks.append(track)
+            last_ticks[identifier] = 0
+        ticks = round(mido.second2tick((timestamp - first_timestamp) / 1e9, SMF_TICKS_PER_BEAT, SMF_TEMPO))
+        track.append(mido.Message.from_bytes(data, time=ticks - last_ticks[identifier]))
+        last_ticks[identifier] = ticks
+        written += 1
+    midi_file.save(output_path)
+    return written
@@ -1,12 +1,12 @@
 import argparse
+import json
 import logging
 import sys
+import time
 
-import mido
-
-from midi_router.config import Config
-from midi_router.config_generator import generate_default_config
-from midi_router.midi_router import MidiRouter
+# Only the parts needed by a command are imported when it runs, so that
+# starting doesn't wait for e.g. wonderwords to load. Defaults that need a
+# module (like the stats socket's) are resolved by the command, too.
 
 LOG_LEVELS = [
     # logging.CRITICAL,
@@ -21,21 +21,138 @@ class CommandLine:
     def __init__(self, args):
         self.args = args
 
+    def get_stats_socket(self):
+        from midi_router.stats import DEFAULT_STATS_SOCKET
+
+        return self.args.stats_socket or DEFAULT_STATS_SOCKET
+
     def print_info(self):
+        import mido
+
         print("MIDI Input Ports:")
         print("  " + "\n  ".join(mido.get_input_names()))
         print("MIDI Output Ports:")
         print("  " + "\n  ".join(mido.get_output_names()))
 
     def write_default_config(self):
+        from midi_router.config_generator import generate_default_config
+
         print(f"Writing to {self.args.config.name}")
         generate_default_config().to_yaml(stream=self.args.config)
 
     def start(self):
+        from midi_router.capture import CaptureWriter
+        from midi_router.config_cache import load_config
+        from midi_router.midi_router import MidiRouter
+        from midi_router.stats import RouterStats
+        from midi_router.trace import MessageTracer
+
         print(f"Starting using config {self.args.config.name}")
-        config = Config.from_yaml(stream=self.args.config)
-        router = MidiRouter(config)
-        router.run()
+        config = load_config(self.args.config.name)
+        if self.args.realtime_priority is not None or self.args.cpus or self.args.lock_memory:
+            from midi_router.realtime import apply_realtime_settings, format_report, parse_cpus
+
+            # Threads and worker processes started from now on inherit these
+            report = apply_realtime_settings(
+                priority=self.args.realtime_priority,
+                cpus=parse_cpus(self.args.cpus) if self.args.cpus else None,
+                lock=self.args.lock_memory,
+            )
+            print(format_report(report))
+        if self.args.metrics:
+            from midi_router.network import parse_address
+
+            try:
+                parse_address(self.args.metrics)
+            except ValueError:
+                sys.exit(f"Invalid --metrics address {self.args.metrics} (expected [HOST]:PORT)")
+        config_path = None if self.args.no_reload else self.args.config.name
+        if self.args.workers > 1:
+            from midi_router.sharding import ShardedRouter
+
+            if self.args.capture:
+                sys.exit("--capture can't be combined with --workers")
+            router = ShardedRouter(
+                config, self.args.workers, config_path=config_path,
+                stats_socket=self.get_stats_socket() if self.args.stats else None,
+                trace_rate=self.args.trace_rate if self.args.trace else None,
+                log_level=logging.getLogger().level,
+                router_kwargs=dict(raw=self.args.raw, dispatch=self.args.dispatch,
+                                   output_queue_size=self.args.output_queue_size, gc_mode=self.args.gc),
+                lock_memory=self.args.lock_memory,
+                metrics_address=self.args.metrics,
+            )
+            router.run()
+            return
+        tracer = MessageTracer(self.args.trace_rate) if self.args.trace else None
+        stats = RouterStats() if self.args.stats or self.args.metrics else None
+        capture = None
+        if self.args.capture:
+            print(f"Capturing to {self.args.capture}")
+            capture = CaptureWriter(self.args.capture, size=self.args.capture_size * 1024 * 1024)
+        router = MidiRouter(config, raw=self.args.raw, dispatch=self.args.dispatch, tracer=tracer,
+                            stats=stats, stats_socket=self.get_stats_socket() if self.args.stats else None,
+                            metrics_address=self.args.metrics,
+                            output_queue_size=self.args.output_queue_size,
+                            config_path=config_path, capture=capture, gc_mode=self.args.gc)
+        try:
+            router.run()
+        finally:
+            if capture is not None:
+                capture.close()
+
+    def replay(self):
+        from midi_router.config_cache import load_config
+        from midi_router.replay import replay_capture
+
+        print(f"Replaying {self.args.capture} using config {self.args.config.name}")
+        config = load_config(self.args.config.name)
+        replayed = replay_capture(self.args.capture, config, speed=self.args.speed,
+                                  raw=self.args.raw, dispatch=self.args.dispatch)
+        print(f"Replayed {replayed} messages")
+
+    def export_smf(self):
+        from midi_router.capture import export_smf
+
+        written = export_smf(self.args.capture, self.args.output)
+        print(f"Wrote {written} messages to {self.args.output}")
+
+    def simulate(self):
+        from midi_router.config_cache import load_config
+        from midi_router.simulate import (SimulationRouter, capture_stream, format_report, get_default_port_names,
+                                          read_port_names, simulate, synthetic_stream)
+
+        config = load_config(self.args.config.name)
+        if self.args.ports:
+            input_port_names, output_port_names = read_port_names(self.args.ports)
+        else:
+            input_port_names, output_port_names = get_default_port_names(config)
+        router = SimulationRouter(config, input_port_names, output_port_names, raw=self.args.raw)
+        router.compile()
+        if self.args.capture:
+            stream = capture_stream(self.args.capture, router.input_ports_by_identifier)
+        else:
+            stream = synthetic_stream(port.name for port in router.input_ports_by_identifier.values())
+        report = simulate(router, stream, repeat=self.args.repeat)
+        print(format_report(report, config, top=self.args.top))
+        if self.args.max_fan_out is not None:
+            exceeding = [group for group in report["groups"] if group["max_fan_out"] > self.args.max_fan_out]
+            if exceeding:
+                sys.exit(f"{len(exceeding)} kinds of messages fan out to more than {self.args.max_fan_out} outputs")
+
+    def print_stats(self):
+        from midi_router.stats import add_rates, format_stats, read_stats
+
+        try:
+            previous = read_stats(self.get_stats_socket())
+            time.sleep(self.args.interval)
+            snapshot = add_rates(read_stats(self.get_stats_socket()), previous)
+        except (FileNotFoundError, ConnectionRefusedError):
+            sys.exit(f"No midi router is serving statistics on {self.get_stats_socket()} (start it with --stats)")
+        if self.args.json:
+            print(json.dumps(snapshot, indent=2))
+        else:
+            print(format_stats(snapshot))
 
     def run(self):
         if self.args.cmd == 'info':
@@ -44,6 +161,14 @@ class CommandLine:
             self.write_default_config()
         elif self.args.cmd == 'start':
             self.start()
+        elif self.args.cmd == 'stats':
+            self.print_stats()
+        elif self.args.cmd == 'replay':
+            self.replay()
+        elif self.args.cmd == 'export-smf':
+            self.export_smf()
+        elif self.args.cmd == 'simulate':
+            self.simulate()
 
 
 def main(argv=None):
@@ -57,10 +182,55 @@ def main(argv=None):
     start_parser = subparsers.add_parser('start', help="Start the midi router")
     start_parser.set_defaults(cmd='start')
     start_parser.add_argument('--config', '-c', metavar='FILE', type=argparse.FileType('r'), default='config.yaml', help='Config file to use [%(default)s]')
+    start_parser.add_argument('--raw', action='store_true', help='Route raw midi bytes without parsing them into mido messages')
+    start_parser.add_argument('--dispatch', choices=['queue', 'direct'], default='queue', help='Route messages on the event loop (queue) or directly on the midi input threads (direct) [%(default)s]')
+    start_parser.add_argument('--trace', action='store_true', help='Log every routed message (rate limited)')
+    start_parser.add_argument('--trace-rate', metavar='N', type=int, default=50, help='Maximum number of traced messages per second [%(default)s]')
+    start_parser.add_argument('--output-queue-size', metavar='N', type=int, default=0, help='Give every output its own send queue of N messages, coalescing controller changes for slow devices (0 disables) [%(default)s]')
+    start_parser.add_argument('--stats', action='store_true', help='Collect latency and throughput statistics (see the stats command)')
+    start_parser.add_argument('--stats-socket', metavar='FILE', help='Unix socket to serve statistics on [midi-router.sock in the temporary directory]')
+    start_parser.add_argument('--metrics', metavar='[HOST]:PORT', help='Collect statistics and serve them over HTTP for monitoring, in the Prometheus format on /metrics and on /health (e.g. :9100, or 127.0.0.1:9100 for this machine only)')
+    start_parser.add_argument('--workers', metavar='N', type=int, default=1, help='Route independent groups of ports (with no mappings between them) in up to N worker processes [%(default)s]')
+    start_parser.add_argument('--no-reload', action='store_true', help="Don't reload the config when the file changes or on SIGHUP")
+    start_parser.add_argument('--capture', metavar='FILE', help='Record all incoming messages to a capture file (see the replay and export-smf commands)')
+    start_parser.add_argument('--capture-size', metavar='MB', type=int, default=16, help='Size of the capture file. Once full, the oldest messages are overwritten [%(default)s]')
+    start_parser.add_argument('--realtime-priority', metavar='N', type=int, choices=range(1, 100), help='Run under the SCHED_FIFO real-time scheduler at priority N (1-99)')
+    start_parser.add_argument('--cpus', metavar='LIST', help='Only run on these CPUs, e.g. 3 or 2-3')
+    start_parser.add_argument('--lock-memory', action='store_true', help='Lock the router\'s memory into RAM (mlockall)')
+    start_parser.add_argument('--gc', choices=['auto', 'freeze', 'manual'], default='auto', help='When Python\'s garbage collector runs: automatically, automatically but never over the routing structures (freeze), or only when no messages are arriving (manual) [%(default)s]')
     
     info_parser = subparsers.add_parser('info', help="Display midi info")
     info_parser.set_defaults(cmd='info')
     
+    stats_parser = subparsers.add_parser('stats', help="Display statistics of a running midi router (started with --stats)")
+    stats_parser.set_defaults(cmd='stats')
+    stats_parser.add_argument('--stats-socket', metavar='FILE', help='Unix socket of the running midi router [midi-router.sock in the temporary directory]')
+    stats_parser.add_argument('--interval', metavar='SECONDS', type=float, default=1.0, help='Measure message rates over this long [%(default)s]')
+    stats_parser.add_argument('--json', action='store_true', help='Print the raw statistics as json')
+
+    replay_parser = subparsers.add_parser('replay', help="Route the messages of a capture file (recorded with start --capture)")
+    replay_parser.set_defaults(cmd='replay')
+    replay_parser.add_argument('capture', metavar='CAPTURE', help='Capture file to replay')
+    replay_parser.add_argument('--config', '-c', metavar='FILE', type=argparse.FileType('r'), default='config.yaml', help='Config file to use [%(default)s]')
+    replay_parser.add_argument('--speed', metavar='X', type=float, default=1.0, help='Replay X times faster than recorded (0 replays as fast as possible) [%(default)s]')
+    replay_parser.add_argument('--raw', action='store_true', help='Route raw midi bytes without parsing them into mido messages')
+    replay_parser.add_argument('--dispatch', choices=['queue', 'direct'], default='queue', help='Route messages on the event loop (queue) or directly on the replay thread (direct) [%(default)s]')
+
+    export_smf_parser = subparsers.add_parser('export-smf', help="Convert a capture file to a Standard MIDI File")
+    export_smf_parser.set_defaults(cmd='export-smf')
+    export_smf_parser.add_argument('capture', metavar='CAPTURE', help='Capture file to convert')
+    export_smf_parser.add_argument('output', metavar='OUTPUT', help='Standard MIDI File to write (.mid)')
+
+    simulate_parser = subparsers.add_parser('simulate', help="Route messages through a config without any midi hardware, reporting fan-out, output load and routing cost")
+    simulate_parser.set_defaults(cmd='simulate')
+    simulate_parser.add_argument('--config', '-c', metavar='FILE', type=argparse.FileType('r'), default='config.yaml', help='Config file to use [%(default)s]')
+    simulate_parser.add_argument('--ports', metavar='FILE', help='Port names to assign, one per line or as printed by the info command [every configured port]')
+    simulate_parser.add_argument('--capture', metavar='FILE', help='Route the messages of a capture file (recorded with start --capture) instead of every message type on every channel')
+    simulate_parser.add_argument('--raw', action='store_true', help='Route raw midi bytes, as with start --raw')
+    simulate_parser.add_argument('--repeat', metavar='N', type=int, default=100, help='Route every message N more times to measure its cost [%(default)s]')
+    simulate_parser.add_argument('--top', metavar='N', type=int, default=10, help='Number of messages and outputs to list [%(default)s]')
+    simulate_parser.add_argument('--max-fan-out', metavar='N', type=int, help='Exit with an error if any message is sent to more than N outputs')
+
     generate_config_parser = subparsers.add_parser('generate-config', help='Generate example config file')
     generate_config_parser.set_defaults(cmd='generate-config')
     generate_config_parser.add_argument('--config', '-c', metavar='FILE', type=argparse.FileType('w'), default='config.yaml', help='Config file to use [%(default)s]')
@@ -71,3 +241,7 @@ def main(argv=None):
         parser.print_help()
 
     CommandLine(args).run()
+
+
+if __name__ == "__main__":
+    main()
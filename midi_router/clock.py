@@ -0,0 +1,247 @@
+import collections
+import logging
+import threading
+import time
+
+import mido
+
+from midi_router import config
+
+
+logger = logging.getLogger("midi_router")
+
+
+CLOCK_TICKS_PER_BEAT = 24
+
+# Status bytes of the messages handled by the clock engine (clock, start,
+# continue, stop and song position)
+CLOCK_STATUS_BYTES = frozenset([0xF8, 0xFA, 0xFB, 0xFC, 0xF2])
+CLOCK_STATUS = 0xF8
+START_STATUS = 0xFA
+CONTINUE_STATUS = 0xFB
+
+# Sleep until this close to the next tick, then spin. Sleeping alone typically
+# overshoots by the scheduler's timer slack (50us by default). The spin releases
+# the GIL on every check, so that input and routing threads are never held up
+# by it.
+SPIN_TIME = 0.0001
+
+# Gains of the phase locked loop that smooths incoming clock. The phase gain is
+# how much of each tick's timing error is let through; the frequency gain is how
+# quickly the estimated tempo follows.
+PLL_PHASE_GAIN = 0.1
+PLL_FREQUENCY_GAIN = 0.01
+
+# A gap between incoming ticks longer than this (about 10 bpm) means the clock
+# source stopped, so the loop re-acquires the tempo from scratch.
+MAX_TICK_GAP = 0.25
+
+
+class ClockEngine:
+    """
+    Dedicated handling of midi clock (Clock/Start/Stop/Continue/SongPos).
+
+    The engine acts like an output port in the routing table: clock messages
+    from the source input are sent to it, and it fans clock out to its output
+    ports in one loop on its own high resolution timer thread.
+
+    In SMOOTH mode every incoming tick is re-emitted exactly once (so downstream
+    sequencers never gain or lose ticks), but at the time predicted by a phase
+    locked loop plus a small fixed latency, which removes the jitter picked up on
+    the way in. Transport messages are delayed by the same latency so they stay
+    in order with the ticks.
+
+    In MASTER mode the engine generates clock at a fixed bpm and incoming ticks
+    are ignored. Transport messages from the source input (if any) are
+    forwarded immediately.
+    """
+    name = "clock engine"
+
+    def __init__(self, clock_config, raw=False):
+        self.mode = clock_config.mode
+        self.source_identifier = clock_config.from_port.identifier if clock_config.from_port is not None else None
+        self.output_identifiers = (
+            None if clock_config.to_ports == config.PortConstant.ALL
+            else {port.identifier for port in clock_config.to_ports}
+        )
+        self.latency = clock_config.latency_ms / 1000
+        self.raw = raw
+        self.master_period = 60 / (clock_config.bpm * CLOCK_TICKS_PER_BEAT)
+        # Set by the router whenever the routing table is compiled
+        self.outputs = ()
+        self.ticks_sent = 0
+        # Names of the outputs whose last send failed, so that each failure is only logged once
+        self._failing_output_names = set()
+
+        self._clock_message = [CLOCK_STATUS] if raw else mido.Message("clock")
+        self._condition = threading.Condition()
+        self._closed = False
+        self._thread = None
+        # SMOOTH: (time, message) entries to send, where a message of None is a tick
+        self._scheduled = collections.deque()
+        self._period = None
+        self._last_tick_received_at = None
+        self._last_tick_smoothed_at = None
+        self._last_scheduled_at = 0.0
+        # MASTER: when the next tick is due
+        self._next_master_tick_at = 0.0
+
+    def select_outputs(self, output_ports_by_identifier):
+        """The output ports clock is sent to (instead of through the routing table)."""
+        return [
+            port
+            for identifier, port in output_ports_by_identifier.items()
+            if port is not None and (self.output_identifiers is None or identifier in self.output_identifiers)
+        ]
+
+    @property
+    def bpm(self):
+        period = self.master_period if self.mode == config.ClockMode.MASTER else self._period
+        return 60 / (period * CLOCK_TICKS_PER_BEAT) if period else None
+
+    def start(self):
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="clock engine", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join(timeout=1)
+            self._thread = None
+
+    def stats(self):
+        return {
+            "mode": self.mode.value,
+            "bpm": self.bpm,
+            "ticks_sent": self.ticks_sent,
+        }
+
+    def send(self, message):
+        """Receive a clock message (as a mido message) from the source input."""
+        if message.type == "clock":
+            self._receive_tick(time.perf_counter())
+        else:
+            self._receive_transport(message, message.type in ("start", "continue"))
+
+    def send_message(self, data):
+        """Receive a clock message (as raw bytes) from the source input."""
+        status = data[0]
+        if status == CLOCK_STATUS:
+            self._receive_tick(time.perf_counter())
+        else:
+            self._receive_transport(data, status == START_STATUS or status == CONTINUE_STATUS)
+
+    def _receive_tick(self, now):
+        if self.mode == config.ClockMode.MASTER:
+            return
+
+        with self._condition:
+            last_received_at = self._last_tick_received_at
+            if last_received_at is None or now - last_received_at > MAX_TICK_GAP:
+                # (Re-)acquire
+                self._period = None
+                smoothed_at = now
+            elif self._period is None:
+                self._period = now - last_received_at
+                smoothed_at = now
+            else:
+                predicted_at = self._last_tick_smoothed_at + self._period
+                error = now - predicted_at
+                smoothed_at = predicted_at + PLL_PHASE_GAIN * error
+                self._period += PLL_FREQUENCY_GAIN * error
+            self._last_tick_received_at = now
+            self._last_tick_smoothed_at = smoothed_at
+            self._schedule(smoothed_at + self.latency, None)
+
+    def _receive_transport(self, message, starts):
+        if self.mode == config.ClockMode.MASTER:
+            with self._condition:
+                if starts:
+                    # The first tick after start marks the first beat, so restart the tick grid
+                    self._next_master_tick_at = time.perf_counter() + self.master_period
+                self._send_to_outputs(message)
+            return
+
+        with self._condition:
+            self._schedule(time.perf_counter() + self.latency, message)
+
+    def _schedule(self, at, message):
+        # Never reorder: an entry is sent no earlier than the previous one
+        at = max(at, self._last_scheduled_at)
+        self._last_scheduled_at = at
+        self._scheduled.append((at, message))
+        self._condition.notify()
+
+    def _send_to_outputs(self, message):
+        for port in self.outputs:
+            try:
+                if self.raw:
+                    port.send_message(message)
+                else:
+                    port.send(message)
+            except Exception as e:
+                # Most likely the device is gone. Keep clocking the others until the ports are reconciled.
+                if port.name not in self._failing_output_names:
+                    self._failing_output_names.add(port.name)
+                    logger.info(f"Failed to send clock to {port.name}: {e!r}")
+            else:
+                if self._failing_output_names:
+                    self._failing_output_names.discard(port.name)
+
+    def _run(self):
+        if self.mode == config.ClockMode.MASTER:
+            self._run_master()
+        else:
+            self._run_smooth()
+
+    def _sleep_until(self, at):
+        """Returns False if the engine was closed while sleeping."""
+        with self._condition:
+            while not self._closed:
+                remaining = at - time.perf_counter() - SPIN_TIME
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            if self._closed:
+                return False
+        while time.perf_counter() < at:
+            time.sleep(0)
+        return True
+
+    def _run_master(self):
+        self._next_master_tick_at = time.perf_counter() + self.master_period
+        while self._sleep_until(self._next_master_tick_at):
+            with self._condition:
+                now = time.perf_counter()
+                if now < self._next_master_tick_at:
+                    # The tick grid was restarted while sleeping
+                    continue
+                if now - self._next_master_tick_at > self.master_period:
+                    # Fell behind (e.g. the process was suspended). Skip ahead instead
+                    # of sending a burst of ticks.
+                    self._next_master_tick_at = now
+                self._next_master_tick_at += self.master_period
+                self._send_to_outputs(self._clock_message)
+                self.ticks_sent += 1
+
+    def _run_smooth(self):
+        scheduled = self._scheduled
+        while True:
+            with self._condition:
+                while not scheduled and not self._closed:
+                    self._condition.wait()
+                if self._closed:
+                    return
+                at = scheduled[0][0]
+            if not self._sleep_until(at):
+                return
+            with self._condition:
+                _, message = scheduled.popleft()
+            if message is None:
+                self._send_to_outputs(self._clock_message)
+                self.ticks_sent += 1
+            else:
+                self._send_to_outputs(message)
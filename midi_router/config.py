@@ -10,6 +10,11 @@ import pydantic
 import pydantic.types
 import pydantic_core
 import yaml
+try:
+    # libyaml's loader is many times faster
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
 
 
 port_long_name_re = re.compile(r"(?P<name>.*) (?P<port>\d+:\d+)")
@@ -17,27 +22,58 @@ port_long_name_re = re.compile(r"(?P<name>.*) (?P<port>\d+:\d+)")
 class PortType(Enum):
     USB = "USB"
     DIN = "DIN"
+    # Another midi-router over UDP (see network.py)
+    NETWORK = "NETWORK"
 
 class PortConstant(Enum):
     ALL = "ALL"
 
 class ChannelConstant(Enum):
     ALL = "ALL"
+
+class ClockMode(Enum):
+    # Clock messages are routed by the mappings like any other message
+    PASSTHROUGH = "PASSTHROUGH"
+    # Clock from from_port is re-generated with reduced jitter
+    SMOOTH = "SMOOTH"
+    # Clock is generated at a fixed bpm
+    MASTER = "MASTER"
     
 
+class NetworkPortConfig(pydantic.BaseModel):
+    # "host:port" to send to for outputs, and to listen on for inputs (e.g.
+    # ":5004" listens on every interface)
+    address: pydantic.types.StrictStr = pydantic.Field(pattern=r"^[^:]*:\d+$")
+    # Messages sent to an output within this window go out together. Longer
+    # windows send fewer datagrams at the cost of that much latency, 0 sends
+    # every message on its own.
+    batch_window_ms: float = pydantic.Field(default=1.0, ge=0, le=100)
+    # Earlier batches repeated in every datagram to an output, to recover from
+    # lost datagrams
+    journal_size: pydantic.conint(ge=0, le=32) = 4
+
+
 class Port(pydantic.BaseModel, ABC):
     identifier: pydantic.types.StrictStr
     name: pydantic.types.StrictStr
     port: Optional[pydantic.types.StrictStr] = pydantic.Field(default=None, pattern=r"\d+:\d+")
     port_type: PortType
+    # Settings of NETWORK ports, which only they have
+    network: Optional[NetworkPortConfig] = None
 
     @pydantic.field_validator("port_type")
     @classmethod
     def validate_only_usb_supported(cls, v, info):
-        if v != PortType.USB:
-            raise NotImplementedError("Only USB port types are supported at this time.")
+        if v not in (PortType.USB, PortType.NETWORK):
+            raise NotImplementedError("Only USB and NETWORK port types are supported at this time.")
         return v
 
+    @pydantic.model_validator(mode='after')
+    def validate_network(self):
+        if (self.port_type == PortType.NETWORK) != (self.network is not None):
+            raise ValueError("network is required for NETWORK ports, and only allowed for them")
+        return self
+
     @staticmethod
     def parse_long_port_name(long_name):
         re_match = port_long_name_re.match(long_name)
@@ -74,21 +110,124 @@ class PortSpecifier(pydantic.BaseModel):
         return hash(self.identifier)
 
 
+# mido message types that can be received from ports
+MessageType = Literal[
+    "note_off", "note_on", "polytouch", "control_change", "program_change", "aftertouch", "pitchwheel",
+    "sysex", "quarter_frame", "songpos", "song_select", "tune_request",
+    "clock", "start", "continue", "stop", "active_sensing", "reset",
+]
+Channel = pydantic.conint(ge=0, le=15)
+MidiValue = pydantic.conint(ge=0, le=127)
+# A SysEx manufacturer ID: one byte, or three bytes starting with 0 (e.g. [0, 32, 41])
+SysexManufacturer = MidiValue | pydantic.conlist(MidiValue, min_length=3, max_length=3)
+
+
+class NoteRange(pydantic.BaseModel):
+    low: MidiValue = 0
+    high: MidiValue = 127
+
+    @pydantic.model_validator(mode='after')
+    def validate_order(self):
+        if self.low > self.high:
+            raise ValueError("low must not be above high")
+        return self
+
+
+class VelocityCurve(pydantic.BaseModel):
+    # Velocities 1-127 are mapped onto min-max. Gammas above 1 make soft notes
+    # softer, gammas below 1 make them louder.
+    min: pydantic.conint(ge=1, le=127) = 1
+    max: pydantic.conint(ge=1, le=127) = 127
+    gamma: float = pydantic.Field(default=1.0, gt=0)
+
+
 class Mapping(pydantic.BaseModel):
     from_port: PortSpecifier | PortConstant = PortConstant.ALL
     to_port: PortSpecifier | PortConstant = PortConstant.ALL
     from_channel: int | ChannelConstant = ChannelConstant.ALL
-    to_channel: int | ChannelConstant = ChannelConstant.ALL
+    # A list of channels fans every message out to each of them
+    to_channel: int | list[Channel] | ChannelConstant = ChannelConstant.ALL
+
+    # Filters. Channel filters never apply to channelless messages, but message
+    # type filters do.
+    message_types: Optional[list[MessageType]] = None
+    exclude_message_types: list[MessageType] = []
+    # Only notes in this range (before transposing) are routed, e.g. for keyboard splits
+    notes: Optional[NoteRange] = None
+
+    # Transforms. Notes transposed out of range are dropped.
+    transpose: pydantic.conint(ge=-127, le=127) = 0
+    velocity: Optional[VelocityCurve] = None
+    # Maps controller numbers to other controller numbers, or to null to drop them
+    control_map: dict[MidiValue, Optional[MidiValue]] = {}
+
+    # SysEx filters: only dumps from these manufacturers, no dumps from these
+    # manufacturers, and no dumps longer than this (in bytes, including F0 and F7)
+    sysex_manufacturers: Optional[list[SysexManufacturer]] = None
+    exclude_sysex_manufacturers: list[SysexManufacturer] = []
+    max_sysex_size: Optional[pydantic.PositiveInt] = None
+
+    @pydantic.field_validator("to_channel")
+    @classmethod
+    def validate_to_channel_list(cls, v):
+        if isinstance(v, list) and not v:
+            raise ValueError("to_channel list must not be empty")
+        return v
+
+    @pydantic.field_validator("sysex_manufacturers", "exclude_sysex_manufacturers")
+    @classmethod
+    def validate_sysex_manufacturers(cls, v):
+        for manufacturer in v or []:
+            if isinstance(manufacturer, list) and manufacturer[0] != 0:
+                raise ValueError("three byte manufacturer IDs must start with 0")
+        return v
     
 
+class ClockConfig(pydantic.BaseModel):
+    mode: ClockMode = ClockMode.PASSTHROUGH
+    from_port: Optional[PortSpecifier] = None
+    to_ports: list[PortSpecifier] | PortConstant = PortConstant.ALL
+    bpm: float = pydantic.Field(default=120.0, gt=0, le=1000)
+    latency_ms: float = pydantic.Field(default=2.0, ge=0, le=100)
+
+    @pydantic.model_validator(mode='after')
+    def validate_from_port(self):
+        if self.mode == ClockMode.SMOOTH and self.from_port is None:
+            raise ValueError("from_port is required to smooth clock")
+        return self
+
+
+class SysexConfig(pydantic.BaseModel):
+    # Longer dumps (in bytes, including F0 and F7) are dropped on every route
+    max_size: Optional[pydantic.PositiveInt] = None
+    # Dumps to every output are paced to this rate. 3125 is the speed of a DIN
+    # connection, null sends them as fast as the output takes them.
+    bytes_per_second: Optional[pydantic.PositiveInt] = 3125
+    # Dumps waiting to be sent to an output, beyond which new dumps are dropped
+    queue_size: pydantic.PositiveInt = 64
+
+
 class PortsConfig(pydantic.BaseModel):
     inputs: list[InputPort]
     outputs: list[InputPort]
+
+
+# A named point in the routing graph. Mappings can route to a bus and from a bus
+# just like to outputs and from inputs, and are joined through it when the
+# config is compiled, so buses cost nothing when routing.
+class BusConfig(pydantic.BaseModel):
+    identifier: pydantic.types.StrictStr
+    # Exposes the bus as a pair of virtual ports of this name, so other
+    # software can read everything routed to the bus and send messages into it
+    virtual_port: Optional[pydantic.types.StrictStr] = None
     
 
 class Config(pydantic.BaseModel):
     ports: PortsConfig
     mappings: list[Mapping]
+    clock: Optional[ClockConfig] = None
+    sysex: Optional[SysexConfig] = None
+    buses: list[BusConfig] = []
 
     @pydantic.model_validator(mode='after')
     def validate_identifiers(self):
@@ -96,8 +235,10 @@ class Config(pydantic.BaseModel):
         input_port_identifiers_set = set(input_port_identifiers)
         output_port_identifiers = [port.identifier for port in self.ports.outputs]
         output_port_identifiers_set = set(output_port_identifiers)
-        all_port_identifiers = input_port_identifiers + output_port_identifiers
-        all_port_identifiers_set = input_port_identifiers_set | output_port_identifiers_set
+        bus_identifiers = [bus.identifier for bus in self.buses]
+        bus_identifiers_set = set(bus_identifiers)
+        all_port_identifiers = input_port_identifiers + output_port_identifiers + bus_identifiers
+        all_port_identifiers_set = input_port_identifiers_set | output_port_identifiers_set | bus_identifiers_set
 
         if len(all_port_identifiers_set) != len(all_port_identifiers):
             counts = Counter(all_port_identifiers)
@@ -107,19 +248,63 @@ class Config(pydantic.BaseModel):
         bad_from_port_errors = [
             f"mappings.{mapping_index}.from_port.identifier\n    Unknown input port identifier: {mapping.from_port.identifier}"
             for mapping_index, mapping in enumerate(self.mappings)
-            if isinstance(mapping.from_port, PortSpecifier) and mapping.from_port.identifier not in input_port_identifiers_set
+            if isinstance(mapping.from_port, PortSpecifier)
+            and mapping.from_port.identifier not in input_port_identifiers_set | bus_identifiers_set
         ]
         bad_to_port_errors = [
             f"mappings.{mapping_index}.to_port.identifier\n    Unknown output port identifier: {mapping.to_port.identifier}"
             for mapping_index, mapping in enumerate(self.mappings)
-            if isinstance(mapping.to_port, PortSpecifier) and mapping.to_port.identifier not in output_port_identifiers_set
+            if isinstance(mapping.to_port, PortSpecifier)
+            and mapping.to_port.identifier not in output_port_identifiers_set | bus_identifiers_set
         ]
 
+        if self.clock is not None:
+            if self.clock.from_port is not None and self.clock.from_port.identifier not in input_port_identifiers_set:
+                bad_from_port_errors.append(f"clock.from_port.identifier\n    Unknown input port identifier: {self.clock.from_port.identifier}")
+            if isinstance(self.clock.to_ports, list):
+                bad_to_port_errors.extend(
+                    f"clock.to_ports.{port_index}.identifier\n    Unknown output port identifier: {to_port.identifier}"
+                    for port_index, to_port in enumerate(self.clock.to_ports)
+                    if to_port.identifier not in output_port_identifiers_set
+                )
+
         if bad_from_port_errors or bad_to_port_errors:
             all_bad_port_errors = bad_from_port_errors + bad_to_port_errors
             raise pydantic_core.PydanticCustomError('invalid_specifier', "\n".join(all_bad_port_errors))
+
+        bus_cycle = self._find_bus_cycle(bus_identifiers_set)
+        if bus_cycle:
+            raise ValueError("Mappings between buses must not form a loop: " + " -> ".join(bus_cycle))
             
         return self
+
+    def _find_bus_cycle(self, bus_identifiers):
+        """A list of bus identifiers that route back to the first one, or None."""
+        next_buses = {identifier: [] for identifier in bus_identifiers}
+        for mapping in self.mappings:
+            if (isinstance(mapping.from_port, PortSpecifier) and mapping.from_port.identifier in bus_identifiers
+                    and isinstance(mapping.to_port, PortSpecifier) and mapping.to_port.identifier in bus_identifiers):
+                next_buses[mapping.from_port.identifier].append(mapping.to_port.identifier)
+        # Depth first search, where path holds the buses being visited
+        visited = set()
+        for start in next_buses:
+            if start in visited:
+                continue
+            path = [start]
+            iterators = [iter(next_buses[start])]
+            visited.add(start)
+            while iterators:
+                next_bus = next(iterators[-1], None)
+                if next_bus is None:
+                    path.pop()
+                    iterators.pop()
+                elif next_bus in path:
+                    return path[path.index(next_bus):] + [next_bus]
+                elif next_bus not in visited:
+                    visited.add(next_bus)
+                    path.append(next_bus)
+                    iterators.append(iter(next_buses[next_bus]))
+        return None
         
     
     def to_yaml(self, stream=None, sort_keys=False):
@@ -127,5 +312,5 @@ class Config(pydantic.BaseModel):
 
     @classmethod
     def from_yaml(cls, stream):
-        return cls.model_validate(yaml.safe_load(stream))
+        return cls.model_validate(yaml.load(stream, Loader=YamlLoader))
 
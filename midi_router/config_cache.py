@@ -0,0 +1,76 @@
+"""
+Loads config files through a cache of their validated form.
+
+Parsing the YAML is by far the slowest part of loading a config, which is
+noticeable on small boards. Every config file that is loaded gets a cache file
+next to it holding the validated config as JSON, along with a checksum of the
+YAML it came from and of the config schema. As long as both are unchanged,
+loading the config only validates the JSON (in pydantic's compiled validator)
+instead of parsing YAML.
+"""
+import hashlib
+import logging
+import os
+
+from midi_router import config
+
+
+logger = logging.getLogger("midi_router")
+
+
+CONFIG_CACHE_MAGIC = b"midi-router config cache 1\n"
+
+
+def get_config_cache_path(path):
+    directory, file_name = os.path.split(path)
+    return os.path.join(directory, f".{file_name}.cache")
+
+
+_schema_digest = None
+
+
+def _get_schema_digest():
+    """Checksum of the config models, so that upgrading invalidates all caches."""
+    global _schema_digest
+    if _schema_digest is None:
+        with open(config.__file__, "rb") as stream:
+            _schema_digest = hashlib.sha256(stream.read()).digest()
+    return _schema_digest
+
+
+def load_config(path):
+    """Load and validate the config file at path, through its cache when possible."""
+    with open(path, "rb") as stream:
+        data = stream.read()
+    digest = hashlib.sha256(_get_schema_digest() + data).hexdigest().encode()
+    cache_path = get_config_cache_path(path)
+    router_config = _read_cache(cache_path, digest)
+    if router_config is None:
+        router_config = config.Config.from_yaml(data)
+        _write_cache(cache_path, digest, router_config)
+    return router_config
+
+
+def _read_cache(cache_path, digest):
+    try:
+        with open(cache_path, "rb") as stream:
+            if stream.readline() != CONFIG_CACHE_MAGIC or stream.readline().rstrip(b"\n") != digest:
+                return None
+            return config.Config.model_validate_json(stream.read())
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.info(f"Ignoring config cache {cache_path}: {e!r}")
+        return None
+
+
+def _write_cache(cache_path, digest, router_config):
+    temporary_path = cache_path + ".tmp"
+    try:
+        with open(temporary_path, "wb") as stream:
+            stream.write(CONFIG_CACHE_MAGIC + digest + b"\n")
+            stream.write(router_config.model_dump_json().encode())
+        os.replace(temporary_path, cache_path)
+    except OSError as e:
+        # e.g. a read-only config directory. Loading just stays slower.
+        logger.info(f"Not caching the config in {cache_path}: {e!r}")
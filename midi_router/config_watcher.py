@@ -0,0 +1,125 @@
+import asyncio
+import ctypes
+import ctypes.util
+import logging
+import os
+import struct
+
+
+logger = logging.getLogger("midi_router")
+
+
+# How often the config file is checked when inotify isn't available.
+CONFIG_CHANGE_CHECK_SLEEP = 1.0
+
+# Editors often write a file in several steps (truncate, write, rename...). Wait
+# until the file has been quiet for this long before reporting a change.
+CONFIG_CHANGE_SETTLE_TIME = 0.1
+
+# inotify constants from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+INOTIFY_EVENT = struct.Struct("iIII")
+
+
+class PollingConfigWatcher:
+    """Reports a change when the config file's modification time, size or inode changes."""
+    def __init__(self, path, interval=CONFIG_CHANGE_CHECK_SLEEP):
+        self.path = path
+        self.interval = interval
+        self._signature = self._get_signature()
+
+    def _get_signature(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    async def wait_for_change(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            signature = self._get_signature()
+            if signature != self._signature:
+                self._signature = signature
+                return
+
+    def close(self):
+        pass
+
+
+class InotifyConfigWatcher:
+    """
+    Watches the config file's directory with inotify.
+
+    The directory is watched rather than the file itself, because many editors
+    save by writing a new file and renaming it over the old one.
+    """
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.file_name = os.fsencode(os.path.basename(self.path))
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        watch = libc.inotify_add_watch(
+            self.fd, os.fsencode(os.path.dirname(self.path)), IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE)
+        if watch < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, os.strerror(errno), self.path)
+
+    def _read_file_names(self):
+        """Names of the files in all pending events."""
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+        file_names = []
+        offset = 0
+        while offset < len(data):
+            _, _, _, name_length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            file_names.append(data[offset:offset + name_length].rstrip(b"\0"))
+            offset += name_length
+        return file_names
+
+    async def _wait_readable(self, timeout=None):
+        loop = asyncio.get_running_loop()
+        readable = loop.create_future()
+        loop.add_reader(self.fd, lambda: readable.done() or readable.set_result(None))
+        try:
+            await asyncio.wait_for(readable, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            loop.remove_reader(self.fd)
+
+    async def wait_for_change(self):
+        while True:
+            await self._wait_readable()
+            if self.file_name in self._read_file_names():
+                break
+        # Swallow the rest of the save
+        while await self._wait_readable(CONFIG_CHANGE_SETTLE_TIME):
+            self._read_file_names()
+
+    def close(self):
+        os.close(self.fd)
+
+
+def create_config_watcher(path):
+    """Use inotify when available, otherwise poll."""
+    try:
+        watcher = InotifyConfigWatcher(path)
+    except (OSError, AttributeError) as e:
+        # AttributeError: libc without inotify (not Linux)
+        logger.info(f"inotify unavailable ({e!r}), polling {path} for changes")
+        return PollingConfigWatcher(path)
+    logger.info(f"Watching {path} for changes")
+    return watcher
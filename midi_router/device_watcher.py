@@ -0,0 +1,111 @@
+import asyncio
+import logging
+
+# Imported by the first create_device_watcher(), which runs once routing has
+# started, as building its bindings is one of the slowest parts of starting up.
+alsa_midi = None
+_alsa_midi_imported = False
+
+
+logger = logging.getLogger("midi_router")
+
+
+# How often ports are enumerated when no port change notifications are available.
+MIDI_DEVICE_CHANGE_CHECK_SLEEP = 0.6
+
+# Even with port change notifications, enumerate ports this often as a safety net
+# (e.g. if a notification is lost because the sequencer's input buffer overflowed).
+ANNOUNCEMENT_FALLBACK_CHECK_SLEEP = 10.0
+
+# A single device usually announces several clients/ports in quick succession.
+# Wait until announcements have been quiet for this long before reporting a change.
+ANNOUNCEMENT_SETTLE_TIME = 0.005
+
+
+class PollingDeviceWatcher:
+    """Reports a possible device change every `interval` seconds."""
+    def __init__(self, interval=MIDI_DEVICE_CHANGE_CHECK_SLEEP):
+        self.interval = interval
+
+    async def wait_for_change(self):
+        await asyncio.sleep(self.interval)
+
+    def close(self):
+        pass
+
+
+class AlsaSequencerDeviceWatcher:
+    """
+    Waits for client/port start, exit and change announcements from the ALSA
+    sequencer's System Announce port, so that ports only need to be enumerated
+    when something actually changed.
+    """
+    CHANGE_EVENT_TYPES = frozenset([
+        "CLIENT_START", "CLIENT_EXIT", "CLIENT_CHANGE",
+        "PORT_START", "PORT_EXIT", "PORT_CHANGE",
+    ])
+
+    def __init__(self, fallback_interval=ANNOUNCEMENT_FALLBACK_CHECK_SLEEP):
+        self.fallback_interval = fallback_interval
+        self._change_event_types = {getattr(alsa_midi.EventType, name) for name in self.CHANGE_EVENT_TYPES}
+        self.client = alsa_midi.AsyncSequencerClient("midi-router-watcher")
+        try:
+            port = self.client.create_port(
+                "announcements",
+                caps=alsa_midi.PortCaps.WRITE | alsa_midi.PortCaps.SUBS_WRITE | alsa_midi.PortCaps.NO_EXPORT,
+                type=alsa_midi.PortType.APPLICATION,
+            )
+            port.connect_from(alsa_midi.SYSTEM_ANNOUNCE)
+        except Exception:
+            self.client.close()
+            raise
+
+    async def wait_for_change(self):
+        try:
+            while True:
+                event = await self.client.event_input(timeout=self.fallback_interval)
+                if event is None or event.type in self._change_event_types:
+                    break
+            # Swallow the rest of the burst
+            while await self.client.event_input(timeout=ANNOUNCEMENT_SETTLE_TIME) is not None:
+                pass
+        except alsa_midi.ALSAError as e:
+            # Most likely the input buffer overflowed and announcements were lost
+            logger.warning(repr(e))
+            self.client.drop_input()
+
+    def close(self):
+        self.client.close()
+
+
+def _import_alsa_midi():
+    global alsa_midi, _alsa_midi_imported
+    if not _alsa_midi_imported:
+        _alsa_midi_imported = True
+        try:
+            import alsa_midi
+        except (ImportError, OSError):
+            # alsa-midi is optional, and needs libasound at import time
+            pass
+    return alsa_midi
+
+
+def load_alsa_midi():
+    """
+    Import alsa-midi ahead of create_device_watcher. The import takes long
+    enough (~160ms on a Pi) to be done on a worker thread before routing starts.
+    """
+    _import_alsa_midi()
+
+
+def create_device_watcher():
+    """Use ALSA sequencer announcements when available, otherwise poll."""
+    if _import_alsa_midi() is not None:
+        try:
+            watcher = AlsaSequencerDeviceWatcher()
+        except Exception as e:
+            logger.info(f"ALSA sequencer announcements unavailable ({e!r}), polling for device changes")
+        else:
+            logger.info("Watching ALSA sequencer announcements for device changes")
+            return watcher
+    return PollingDeviceWatcher()
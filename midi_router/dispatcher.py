@@ -0,0 +1,246 @@
+import collections
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger("midi_router")
+
+
+# received_at is the time.perf_counter_ns() when the callback received the message
+IncomingMessage = collections.namedtuple("IncomingMessage", ["input_port_name", "message", "received_at"])
+
+
+# Maximum number of messages routed per wakeup before yielding back to the event
+# loop, so that bursts can't starve other tasks (such as device monitoring).
+DRAIN_BATCH_SIZE = 64
+
+# Priority lanes of the queue dispatcher, highest first. Song position and MTC
+# quarter frames travel with clock, so that e.g. a song position is never routed
+# after the continue that follows it. Program changes, bank selects and sustain
+# travel with notes, as they change how the notes that follow them sound.
+LANES = ("realtime", "notes", "control", "bulk")
+REALTIME_LANE, NOTES_LANE, CONTROL_LANE, BULK_LANE = range(len(LANES))
+# Control changes are looked up by controller number (see NOTES_LANE_CONTROLS)
+CONTROL_CHANGE_LANE = -1
+# Bank select MSB and LSB, and sustain
+NOTES_LANE_CONTROLS = frozenset((0, 32, 64))
+# The most messages each lane routes per scheduling round. Every lane gets its
+# share of each round, so a flood in one lane can't starve the others.
+LANE_WEIGHTS = (32, 16, 8, 1)
+
+
+def _get_lane(status):
+    if status >= 0xF8 or status in (0xF1, 0xF2):
+        return REALTIME_LANE
+    if status < 0xA0 or 0xC0 <= status < 0xD0:
+        return NOTES_LANE
+    if 0xB0 <= status < 0xC0:
+        return CONTROL_CHANGE_LANE
+    if status == 0xF0:
+        return BULK_LANE
+    return CONTROL_LANE
+
+
+# Indexed by status byte (raw mode) and by mido message type
+LANE_BY_STATUS = tuple(_get_lane(status) for status in range(256))
+LANE_BY_TYPE = {
+    "note_off": NOTES_LANE, "note_on": NOTES_LANE, "polytouch": CONTROL_LANE, "control_change": CONTROL_CHANGE_LANE,
+    "program_change": NOTES_LANE, "aftertouch": CONTROL_LANE, "pitchwheel": CONTROL_LANE,
+    "sysex": BULK_LANE, "quarter_frame": REALTIME_LANE, "songpos": REALTIME_LANE, "song_select": CONTROL_LANE,
+    "tune_request": CONTROL_LANE, "clock": REALTIME_LANE, "start": REALTIME_LANE, "continue": REALTIME_LANE,
+    "stop": REALTIME_LANE, "active_sensing": REALTIME_LANE, "reset": REALTIME_LANE,
+}
+
+
+class QueueDispatcher:
+    """
+    Hands messages from the rtmidi callback threads to the asyncio event loop.
+
+    Callbacks append to a deque and wake the loop with call_soon_threadsafe only
+    when no wakeup is already pending, so the loop sleeps while there is no
+    traffic and a burst of messages costs a single wakeup.
+
+    There is a deque per priority lane (see LANES). The loop drains them in
+    rounds where every lane routes up to its LANE_WEIGHTS messages, and queued
+    real-time messages are routed before every other message, so clock waits
+    for at most one message however long the queues are. Messages within a lane
+    stay in order, but a backlog of one lane (e.g. a controller sweep) can be
+    overtaken by messages of a higher lane.
+    """
+    # Messages are routed one at a time, on the event loop
+    routes_concurrently = False
+
+    def __init__(self, route, raw=False):
+        self.route = route
+        self.raw = raw
+        self.lanes = tuple(collections.deque() for _ in LANES)
+        self.max_lane_depths = [0] * len(LANES)
+        self.max_queue_depth = 0
+        # Messages put so far, which tells when the router is idle
+        self.received = 0
+        self._loop = None
+        self._wakeup_pending = False
+
+    def start(self, loop):
+        self._loop = loop
+        self._wakeup_pending = True
+        loop.call_soon(self._drain)
+
+    def stop(self):
+        self._loop = None
+
+    def wrap_output_port(self, port):
+        # All sends happen on the event loop thread
+        return port
+
+    def stats(self):
+        return {
+            "queue_depth": sum(len(lane) for lane in self.lanes),
+            "max_queue_depth": self.max_queue_depth,
+            "lanes": {
+                name: {"depth": len(lane), "max_depth": max_depth}
+                for name, lane, max_depth in zip(LANES, self.lanes, self.max_lane_depths)
+            },
+        }
+
+    def put(self, input_port_name, message):
+        """Called from the rtmidi callback threads."""
+        self.received += 1
+        lane = LANE_BY_STATUS[message[0]] if self.raw else LANE_BY_TYPE[message.type]
+        if lane == CONTROL_CHANGE_LANE:
+            control = message[1] if self.raw else message.control
+            lane = NOTES_LANE if control in NOTES_LANE_CONTROLS else CONTROL_LANE
+        self.lanes[lane].append(IncomingMessage(input_port_name, message, time.perf_counter_ns()))
+        if not self._wakeup_pending:
+            self._wakeup_pending = True
+            self._wakeup()
+
+    def _wakeup(self):
+        loop = self._loop
+        try:
+            loop.call_soon_threadsafe(self._drain)
+        except (AttributeError, RuntimeError):
+            # No running loop (the router is re-initializing). Messages stay queued
+            # until start() is called again.
+            self._wakeup_pending = False
+
+    def _drain(self):
+        # Clear the flag before draining so that messages appended while draining
+        # schedule a new wakeup.
+        self._wakeup_pending = False
+        lanes = self.lanes
+        self._update_max_depths()
+        route = self.route
+        realtime = lanes[REALTIME_LANE]
+        routed = 0
+        while routed < DRAIN_BATCH_SIZE:
+            round_routed = 0
+            realtime_quota = LANE_WEIGHTS[REALTIME_LANE]
+            for lane_index in range(1, len(LANES)):
+                lane = lanes[lane_index]
+                for _ in range(min(LANE_WEIGHTS[lane_index], len(lane))):
+                    while realtime and realtime_quota:
+                        route(*realtime.popleft())
+                        realtime_quota -= 1
+                        round_routed += 1
+                    route(*lane.popleft())
+                    round_routed += 1
+            while realtime and realtime_quota:
+                route(*realtime.popleft())
+                realtime_quota -= 1
+                round_routed += 1
+            if not round_routed:
+                return
+            routed += round_routed
+        if any(lanes) and not self._wakeup_pending:
+            self._wakeup_pending = True
+            self._loop.call_soon(self._drain)
+
+    def _update_max_depths(self):
+        queue_depth = 0
+        max_lane_depths = self.max_lane_depths
+        for lane_index, lane in enumerate(self.lanes):
+            depth = len(lane)
+            queue_depth += depth
+            if depth > max_lane_depths[lane_index]:
+                max_lane_depths[lane_index] = depth
+        if queue_depth > self.max_queue_depth:
+            self.max_queue_depth = queue_depth
+
+
+class DirectDispatcher:
+    """
+    Routes messages directly on the rtmidi callback thread that received them.
+
+    This skips the queue and the event loop entirely for the lowest latency. As
+    every input has its own callback thread, output ports are wrapped so that
+    sends to the same output are serialized.
+    """
+    # Every input's callback thread routes at the same time
+    routes_concurrently = True
+
+    def __init__(self, route, raw=False):
+        self.route = route
+        self.dropped = 0
+        self.received = 0
+        self._running = False
+
+    def start(self, loop):
+        self._running = True
+
+    def stop(self):
+        self._running = False
+
+    def wrap_output_port(self, port):
+        return LockedOutputPort(port)
+
+    def stats(self):
+        return {
+            "queue_depth": 0,
+            "max_queue_depth": 0,
+            # Messages received while re-initializing. Queued messages are never dropped.
+            "dropped": self.dropped,
+        }
+
+    def put(self, input_port_name, message):
+        """Called from the rtmidi callback threads."""
+        self.received += 1
+        if self._running:
+            self.route(input_port_name, message, time.perf_counter_ns())
+        else:
+            # Received while the router is re-initializing
+            self.dropped += 1
+
+
+class LockedOutputPort:
+    """Output port wrapper that serializes sends from multiple threads."""
+    def __init__(self, port):
+        self.port = port
+        self.name = port.name
+        self._lock = threading.Lock()
+        self.closed = False
+
+    def send(self, message):
+        with self._lock:
+            if not self.closed:
+                self.port.send(message)
+
+    def send_message(self, data):
+        with self._lock:
+            if not self.closed:
+                self.port.send_message(data)
+
+    def close(self):
+        with self._lock:
+            self.closed = True
+            self.port.close()
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.port!r})"
+
+
+DISPATCHERS = {
+    "queue": QueueDispatcher,
+    "direct": DirectDispatcher,
+}
@@ -70,14 +70,12 @@ class Mapper:
 
     def send(self, from_port_name, message):
         if self.filter(message):
-            #logger.info(f"from {from_port_name}: {message}")
             transformed = self.transform(message)
             for to_port in self.to_ports:
                 if to_port.name != from_port_name:
-                    if hasattr(message, "channel"):
-                        logger.info(f"  to {to_port.name}: {transformed}")
+                    # Lazy formatting, so that nothing is formatted unless INFO is enabled
+                    logger.info("  to %s: %s", to_port.name, transformed)
                     to_port.send(transformed)
-            #logger.info("\n")
 
 
     def dict(self):
@@ -0,0 +1,223 @@
+"""
+Serves the router's statistics over HTTP for monitoring: /metrics in the
+Prometheus text format, and /health.
+
+Nothing here runs on the hot path. The counters and histograms are the ones the
+router keeps anyway (see stats.RouterStats), and they are only read and
+rendered when scraped.
+"""
+import asyncio
+import inspect
+import json
+import logging
+
+from midi_router.network import parse_address
+
+
+logger = logging.getLogger("midi_router")
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Upper bounds of the exported latency histogram buckets in microseconds. They
+# are powers of two, which are also bounds of the finer buckets the router
+# records (see stats.latency_bucket), so they are exact. The router's bounds
+# are exclusive while Prometheus's are inclusive, but latencies are recorded
+# in whole microseconds rounded down, so a bucket holds every latency below its
+# bound and only a latency of exactly the bound is counted in the next one.
+METRICS_LATENCY_BOUNDS_US = tuple(1 << power for power in range(4, 21))
+# Requests are a request line and a few headers, anything longer is refused
+MAX_REQUEST_SIZE = 8192
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(**labels):
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + "}"
+
+
+class _Metrics:
+    """Collects the lines of the exposition, grouping samples under their metric."""
+    def __init__(self):
+        self.lines = []
+
+    def add(self, name, metric_type, help_text, samples):
+        """samples are (labels string, value) tuples. Metrics without samples are left out."""
+        if not samples:
+            return
+        self.lines.append(f"# HELP midi_router_{name} {help_text}")
+        self.lines.append(f"# TYPE midi_router_{name} {metric_type}")
+        for labels, value in samples:
+            self.lines.append(f"midi_router_{name}{labels} {value}")
+
+    def add_latency_histogram(self, name, help_text, routes):
+        self.lines.append(f"# HELP midi_router_{name} {help_text}")
+        self.lines.append(f"# TYPE midi_router_{name} histogram")
+        for route in routes:
+            buckets = route["buckets"]
+            cumulative = 0
+            index = 0
+            for bound_us in METRICS_LATENCY_BOUNDS_US:
+                while index < len(buckets) and buckets[index][0] <= bound_us:
+                    cumulative += buckets[index][1]
+                    index += 1
+                labels = _labels(input=route["input"], output=route["output"], le=bound_us / 1e6)
+                self.lines.append(f"midi_router_{name}_bucket{labels} {cumulative}")
+            labels = _labels(input=route["input"], output=route["output"], le="+Inf")
+            self.lines.append(f"midi_router_{name}_bucket{labels} {route['count']}")
+            labels = _labels(input=route["input"], output=route["output"])
+            self.lines.append(f"midi_router_{name}_sum{labels} {route['total_us'] / 1e6}")
+            self.lines.append(f"midi_router_{name}_count{labels} {route['count']}")
+
+    def render(self):
+        return "\n".join(self.lines) + "\n"
+
+
+def format_metrics(snapshot):
+    """Render a stats snapshot (see MidiRouter._get_stats_snapshot) in the Prometheus text format."""
+    metrics = _Metrics()
+    metrics.add("uptime_seconds", "gauge", "Time since the router started.", [("", snapshot["uptime"])])
+    if "workers" in snapshot:
+        metrics.add("workers", "gauge", "Worker processes serving statistics.", [("", snapshot["workers"])])
+
+    routes = snapshot["routes"]
+    metrics.add("input_messages_total", "counter", "Messages received per input port.", [
+        (_labels(port=name), count) for name, count in snapshot.get("inputs", {}).items()])
+    counts_by_output = {}
+    for route in routes:
+        counts_by_output[route["output"]] = counts_by_output.get(route["output"], 0) + route["count"]
+    metrics.add("output_messages_total", "counter", "Messages routed per output port.", [
+        (_labels(port=name), count) for name, count in counts_by_output.items()])
+    metrics.add("route_messages_total", "counter", "Messages routed per route.", [
+        (_labels(input=route["input"], output=route["output"]), route["count"]) for route in routes])
+    if routes:
+        metrics.add_latency_histogram(
+            "route_latency_seconds", "Time from receiving a message until sending it, per route.", routes)
+
+    ports = [
+        (_labels(port=name, direction=direction), port)
+        for direction, ports_by_name in snapshot.get("ports", {}).items()
+        for name, port in ports_by_name.items()
+    ]
+    metrics.add("port_opens_total", "counter", "Times a port was opened, including reopens after device changes.", [
+        (labels, port["opens"]) for labels, port in ports])
+    metrics.add("port_open_errors_total", "counter", "Times opening a port failed.", [
+        (labels, port["open_errors"]) for labels, port in ports])
+    if "reinitializations" in snapshot:
+        metrics.add("reinitializations_total", "counter",
+                    "Times all ports were closed and reopened after a device change that couldn't be reconciled.",
+                    [("", snapshot["reinitializations"])])
+
+    dispatch = snapshot["dispatch"]
+    metrics.add("dispatch_queue_depth", "gauge", "Messages waiting to be routed.", [("", dispatch["queue_depth"])])
+    if "dropped" in dispatch:
+        metrics.add("dispatch_dropped_total", "counter", "Messages dropped before being routed.",
+                    [("", dispatch["dropped"])])
+    outputs = snapshot.get("outputs", {})
+    metrics.add("output_queue_depth", "gauge", "Messages waiting in an output queue.", [
+        (_labels(port=name), output["queue_depth"]) for name, output in outputs.items()])
+    metrics.add("output_queue_dropped_total", "counter", "Messages dropped because an output queue was full.", [
+        (_labels(port=name), output["dropped"]) for name, output in outputs.items()])
+    metrics.add("output_queue_coalesced_total", "counter", "Messages replaced by a newer value in an output queue.", [
+        (_labels(port=name), output["coalesced"]) for name, output in outputs.items()])
+
+    network = snapshot.get("network", {})
+    for key, help_text in (
+            ("datagrams", "Datagrams sent or received per network port."),
+            ("errors", "Send or receive errors per network port."),
+            ("recovered", "Batches recovered from the journal per network port."),
+            ("lost", "Batches lost per network port.")):
+        metrics.add(f"network_{key}_total", "counter", help_text, [
+            (_labels(port=name), port[key]) for name, port in network.items()])
+
+    garbage_collector = snapshot.get("gc")
+    if garbage_collector is not None:
+        metrics.add("gc_collections_total", "counter", "Garbage collections per generation.", [
+            (_labels(generation=generation), count)
+            for generation, count in enumerate(garbage_collector["collections"])])
+        metrics.add("gc_pause_seconds_total", "counter", "Time spent in garbage collections.",
+                    [("", garbage_collector["total_pause_ms"] / 1e3)])
+    return metrics.render()
+
+
+def get_health(snapshot):
+    """
+    "ok" while the router is routing, with every worker answering. Otherwise
+    "not running" (e.g. while re-initializing) or "degraded" (some workers
+    didn't answer).
+    """
+    health = {"status": "ok", "uptime": snapshot["uptime"]}
+    if not snapshot.get("running", True):
+        health["status"] = "not running"
+    if "workers" in snapshot:
+        health["workers"] = snapshot["workers"]
+        health["expected_workers"] = snapshot["expected_workers"]
+        if snapshot["workers"] == 0:
+            health["status"] = "not running"
+        elif snapshot["workers"] < snapshot["expected_workers"]:
+            health["status"] = "degraded"
+    return health
+
+
+class MetricsServer:
+    """
+    Minimal HTTP server for /metrics and /health (see get_health), which
+    answers 503 unless the router is healthy. Rendering happens on the event
+    loop, only when a request arrives.
+    """
+    def __init__(self, address, get_snapshot):
+        self.address = address
+        self.get_snapshot = get_snapshot
+        self._server = None
+
+    async def start(self):
+        host, port = parse_address(self.address)
+        self._server = await asyncio.start_server(self._handle_client, host=host, port=port)
+        logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _get_snapshot(self):
+        # The supervisor of worker processes gathers its snapshot asynchronously
+        snapshot = self.get_snapshot()
+        if inspect.isawaitable(snapshot):
+            snapshot = await snapshot
+        return snapshot
+
+    async def _handle_client(self, reader, writer):
+        try:
+            try:
+                request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout=5.0)
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+                return
+            if len(request) > MAX_REQUEST_SIZE:
+                return
+            method, _, rest = request.decode("latin-1").partition(" ")
+            path = rest.partition(" ")[0].partition("?")[0]
+            if method not in ("GET", "HEAD"):
+                status, content_type, body = "405 Method Not Allowed", "text/plain", "Method not allowed\n"
+            elif path == "/metrics":
+                status, content_type, body = "200 OK", CONTENT_TYPE, format_metrics(await self._get_snapshot())
+            elif path == "/health":
+                health = get_health(await self._get_snapshot())
+                status = "200 OK" if health["status"] == "ok" else "503 Service Unavailable"
+                content_type, body = "application/json", json.dumps(health) + "\n"
+            else:
+                status, content_type, body = "404 Not Found", "text/plain", "Not found\n"
+            body = body.encode()
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n"
+                f"Connection: close\r\n\r\n".encode()
+                + (body if method != "HEAD" else b""))
+            await writer.drain()
+        except ConnectionError:
+            pass
+        except Exception:
+            logger.exception("Failed to serve metrics")
+        finally:
+            writer.close()
@@ -1,9 +1,11 @@
 import asyncio
 import collections
+import functools
 import itertools
 import json
 import logging
-import queue
+import signal
+import threading
 
 import mido
 try:
@@ -13,183 +15,665 @@ except ImportError:
         """Dummy class to catch when rtmidi isn't available."""
 
 from midi_router import config
-from midi_router.mapper import Mapper
+from midi_router.clock import ClockEngine
+from midi_router.config import ClockMode
+from midi_router.config_cache import load_config
+from midi_router.config_watcher import create_config_watcher
+from midi_router.device_watcher import create_device_watcher, load_alsa_midi
+from midi_router.dispatcher import DISPATCHERS, LockedOutputPort
+from midi_router.metrics import MetricsServer
+from midi_router.network import NetworkInputPort, NetworkOutputPort, find_network_port, get_network_port_name
+from midi_router.note_tracker import LockedNoteTracker, NoteTracker
+from midi_router.output_queue import QueuedOutputPort
+from midi_router.port_registry import PortRegistry
+from midi_router.raw_ports import RawInputPort, RawOutputPort
+from midi_router.realtime import GC_IDLE_CHECK_INTERVAL, GarbageCollector
+from midi_router.routing_table import RoutingTable
+from midi_router.stats import StatsServer
+from midi_router.sysex import SysexOutputPort, find_sysex_output_port
 
 
 logger = logging.getLogger("midi_router")
 
 
-IncomingMessage = collections.namedtuple("IncomingMessage", ["input_port_name", "message"])
+class MidiDeviceChangeException(Exception):
+    pass
 
 
 
-class MidiDeviceChangeException(Exception):
-    pass
+class MidiRouter:
+    def __init__(self, config, raw=False, dispatch="queue", tracer=None, stats=None, stats_socket=None,
+                 output_queue_size=0, config_path=None, capture=None, gc_mode="auto", metrics_address=None):
+        """
+        In raw mode, ports are opened directly through rtmidi and messages are
+        routed as raw bytes without ever constructing mido.Message objects.
 
+        dispatch selects how messages get from the rtmidi callbacks to the
+        outputs (see dispatcher.DISPATCHERS): "queue" routes them on the event
+        loop, "direct" routes them on the callback thread itself.
 
-# Worst-case time between device change checks is the sleep time plus how long
-# we wait to receive a midi message (plus processing time)
-#
-# Increasing the queue get timeout increases performance by processing events as
-# soon as their availble, but with the tradeoff of checking device changes less
-# frequently.
-EVENT_QUEUE_GET_TIMEOUT = 0.6
-MIDI_DEVICE_CHANGE_CHECK_SLEEP = 0.6
+        tracer (see trace.MessageTracer) is called with every routed message.
 
+        stats (see stats.RouterStats) records per-route latencies, which are
+        served on the unix socket stats_socket, and over HTTP on metrics_address
+        ("host:port", see metrics.MetricsServer).
 
-class MidiRouter:
-    def __init__(self, config):
+        With output_queue_size, every output port gets a send queue of that size
+        drained by its own writer thread (see output_queue.QueuedOutputPort).
+
+        With a sysex config, every output sends SysEx dumps from its own thread
+        (see sysex.SysexOutputPort).
+
+        A clock config other than PASSTHROUGH hands clock over to a
+        clock.ClockEngine, which sends clock to its outputs from its own thread.
+
+        With config_path, the config is reloaded whenever that file changes, on
+        SIGHUP, or when reload() is called. Ports used by both the old and the new
+        config stay open.
+
+        capture (see capture.CaptureWriter) records every incoming message for
+        later replay.
+
+        gc_mode selects when Python's garbage collector runs (see
+        realtime.GarbageCollector).
+        """
         self.config = config
-        self.incoming_message_queue = queue.Queue()
+        self.raw = raw
+        self.tracer = tracer
+        self.stats = stats
+        self.stats_socket = stats_socket
+        self.metrics_address = metrics_address
+        self.output_queue_size = output_queue_size
+        self.config_path = config_path
+        self.capture = capture
+        self.routing_table = None
+        self.clock_engine = self._create_clock_engine(config.clock)
+        self.dispatcher = DISPATCHERS[dispatch](self._route_message, raw=raw)
+        # Releases notes that would otherwise be left hanging when routes change
+        self.note_tracker = (LockedNoteTracker if self.dispatcher.routes_concurrently else NoteTracker)(raw=raw)
+        self.garbage_collector = GarbageCollector(gc_mode)
+        # Set while ports are open and messages are being routed
+        self.running = threading.Event()
+        self._stopping = False
+        # Set by reload() until the reload happens
+        self._reload_pending = False
+        self._loop = None
+        self._main_task = None
+        # Created on the event loop
+        self._reconcile_lock = None
+        self._reload_requested = None
+        # The ports available after the last reconcile (see port_registry.PortRegistry)
+        self._port_registry = None
+        # The device last assigned to every short-named port, kept across
+        # re-initializations (see _get_identifiers_to_port_names)
+        self._input_device_keys_by_identifier = {}
+        self._output_device_keys_by_identifier = {}
+        # Kept across re-initializations, for monitoring
+        self.reinitializations = 0
+        # By ("input" or "output", port name)
+        self.opens_by_port = collections.Counter()
+        self.open_errors_by_port = collections.Counter()
+
+    def _create_clock_engine(self, clock_config):
+        if clock_config is None or clock_config.mode == ClockMode.PASSTHROUGH:
+            return None
+        return ClockEngine(clock_config, raw=self.raw)
 
     def run(self):
-        # Every time the midi devices change, re-initialize
-        while True:
+        # Device changes are reconciled incrementally. Only fall back to a full
+        # re-initialization if that fails.
+        self._stopping = False
+        if self.tracer is not None:
+            self.tracer.start()
+        if self.clock_engine is not None:
+            self.clock_engine.start()
+        self.garbage_collector.start()
+        previous_sighup_handler = self._add_reload_signal_handler() if self.config_path is not None else None
+        try:
+            while not self._stopping:
+                try:
+                    self._run()
+                except MidiDeviceChangeException:
+                    logger.warning("Midi Device Change Detected. Re-initializing")
+                    self.reinitializations += 1
+        finally:
+            if previous_sighup_handler is not None:
+                signal.signal(signal.SIGHUP, previous_sighup_handler)
+            self.garbage_collector.stop()
+            if self.clock_engine is not None:
+                self.clock_engine.close()
+            if self.tracer is not None:
+                self.tracer.stop()
+
+    def stop(self):
+        """Stop run() from another thread."""
+        self._stopping = True
+        loop, main_task = self._loop, self._main_task
+        if loop is not None:
             try:
-                self._run()
-            except MidiDeviceChangeException:
-                logger.warn("Midi Device Change Detected. Re-initializing")
-
-    def _run(self):
-        input_port_names_by_identifier = self._get_identifiers_to_port_names(mido.get_input_names(), self.config.ports.inputs)
-        output_port_names_by_identifier = self._get_identifiers_to_port_names(mido.get_output_names(), self.config.ports.outputs)
+                loop.call_soon_threadsafe(main_task.cancel)
+            except RuntimeError:
+                # The loop already finished
+                pass
 
+    def reload(self):
+        """
+        Reload the config file from another thread. Requested while
+        re-initializing, the reload happens once routing resumes.
+        """
+        self._reload_pending = True
+        loop = self._loop
+        if loop is not None:
+            try:
+                loop.call_soon_threadsafe(self._reload_requested.set)
+            except RuntimeError:
+                # The loop already finished
+                pass
 
-        input_ports_by_identifier = {}
-        output_ports_by_identifier = {}
+    def _run(self):
+        self.input_ports_by_identifier = {}
+        self.output_ports_by_identifier = {}
+        self.routing_table = None
         try:
-            for identifier, port_name in input_port_names_by_identifier.items():
-                input_ports_by_identifier[identifier] = self._open_input_port(port_name)
-
-            for identifier, port_name in output_port_names_by_identifier.items():
-                output_ports_by_identifier[identifier] = self._open_output_port(port_name)
-
-            mappers_by_input_port_name = self._create_mappers_by_input_port_name(input_ports_by_identifier, output_ports_by_identifier)
-            
-            logger.debug(f"input_port_names_by_identifier={json.dumps(input_port_names_by_identifier, indent=2)}")
-            logger.debug(f"output_port_names_by_identifier={json.dumps(output_port_names_by_identifier, indent=2)}")
-            logger.debug(f"input_ports_by_identifier={json.dumps({k: v.name for k, v in input_ports_by_identifier.items()}, indent=2)}")
-            logger.debug(f"output_ports_by_identifier={json.dumps({k: v.name for k, v in output_ports_by_identifier.items()}, indent=2)}")
-            logger.debug(
-                "mappers_by_input_port_name=" + 
-                json.dumps(
-                    {
-                        k:[v.dict() for v in value] for k, value in mappers_by_input_port_name.items()
-                    },
-                    indent=2
-                ))
-
-            asyncio.run(self._run_async(mappers_by_input_port_name))
-
+            asyncio.run(self._run_async())
         finally:
-            for port in itertools.chain(input_ports_by_identifier.values(), output_ports_by_identifier.values()):
+            # Closing a queued output (see output_queue.QueuedOutputPort) still sends the queued note offs
+            self.note_tracker.release_all()
+            for port in itertools.chain(self.input_ports_by_identifier.values(), self.output_ports_by_identifier.values()):
                 port.close()
 
-    async def _run_async(self, mappers_by_input_port_name):
-        monitor_midi_device_change_task = asyncio.create_task(self._monitor_midi_device_changes())
-        process_message_queue_task = asyncio.create_task(self._process_message_queue(mappers_by_input_port_name))
-        await monitor_midi_device_change_task
-        await process_message_queue_task
+    async def _run_async(self):
+        self._reconcile_lock = asyncio.Lock()
+        self._reload_requested = asyncio.Event()
+        await self._reconcile_ports(self._get_port_registry())
+        stats_server = None
+        if self.stats is not None and self.stats_socket is not None:
+            stats_server = StatsServer(self.stats_socket, self._get_stats_snapshot)
+            await stats_server.start()
+        metrics_server = None
+        if self.stats is not None and self.metrics_address is not None:
+            metrics_server = MetricsServer(self.metrics_address, self._get_stats_snapshot)
+            await metrics_server.start()
+        self._loop = asyncio.get_running_loop()
+        self._main_task = asyncio.current_task()
+        if self._reload_pending:
+            # Requested while re-initializing
+            self._reload_requested.set()
+        # Before routing starts, so that messages never wait behind the import
+        await self._loop.run_in_executor(None, load_alsa_midi)
+        self.dispatcher.start(self._loop)
+        tasks = [asyncio.create_task(self._monitor_midi_device_changes())]
+        if self.garbage_collector.mode != "auto":
+            tasks.append(asyncio.create_task(self._collect_garbage_when_idle()))
+        if self.config_path is not None:
+            tasks.append(asyncio.create_task(self._watch_config_file()))
+            tasks.append(asyncio.create_task(self._reload_on_request()))
+        self.running.set()
+        try:
+            if not self._stopping:
+                # These only return by raising (e.g. MidiDeviceChangeException)
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+                for task in done:
+                    task.result()
+        except asyncio.CancelledError:
+            if not self._stopping:
+                raise
+        finally:
+            self.running.clear()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self._loop = self._main_task = None
+            self.dispatcher.stop()
+            if stats_server is not None:
+                await stats_server.stop()
+            if metrics_server is not None:
+                await metrics_server.stop()
+
+    def _add_reload_signal_handler(self):
+        """
+        Reload on SIGHUP for as long as run() runs, including while
+        re-initializing between event loops, so that a reload request never
+        terminates the router. Returns the previous handler, or None.
+        """
+        try:
+            return signal.signal(signal.SIGHUP, lambda signum, frame: self.reload())
+        except (AttributeError, ValueError):
+            # No SIGHUP (Windows), or not running on the main thread
+            logger.debug("Not reloading the config on SIGHUP")
+            return None
+
+    def _route_message(self, input_port_name, message, received_at):
+        if self.stats is not None:
+            sent_at = []
+            if self.raw:
+                actions = self.routing_table.route_bytes(input_port_name, message, sent_at)
+            else:
+                actions = self.routing_table.route(input_port_name, message, sent_at)
+            self.stats.record(input_port_name, actions, received_at, sent_at)
+        elif self.raw:
+            actions = self.routing_table.route_bytes(input_port_name, message)
+        else:
+            actions = self.routing_table.route(input_port_name, message)
+        if self.tracer is not None:
+            self.tracer(input_port_name, message, actions)
+        if self.capture is not None:
+            # After routing, so capturing never delays the outputs
+            if self.raw:
+                self.capture.record(input_port_name, message, received_at)
+            else:
+                self.capture.record_message(input_port_name, message, received_at)
+
+    def _get_stats_snapshot(self):
+        snapshot = self.stats.snapshot()
+        snapshot["dispatch"] = self.dispatcher.stats()
+        snapshot["outputs"] = {
+            port.name: port.stats()
+            for port in list(self.output_ports_by_identifier.values())
+            if hasattr(port, "stats")
+        }
+        network_ports = (
+            find_network_port(port)
+            for port in itertools.chain(
+                list(self.input_ports_by_identifier.values()), list(self.output_ports_by_identifier.values()))
+        )
+        snapshot["network"] = {port.name: port.stats() for port in network_ports if port is not None}
+        if self.clock_engine is not None:
+            snapshot["clock"] = self.clock_engine.stats()
+        snapshot["gc"] = self.garbage_collector.stats()
+        snapshot["ports"] = {"input": {}, "output": {}}
+        for direction, name in list(self.opens_by_port) + list(self.open_errors_by_port):
+            snapshot["ports"][direction][name] = {
+                "opens": self.opens_by_port[direction, name],
+                "open_errors": self.open_errors_by_port[direction, name],
+            }
+        snapshot["reinitializations"] = self.reinitializations
+        snapshot["running"] = self.running.is_set()
+        return snapshot
+
+    async def _collect_garbage_when_idle(self):
+        received = self.dispatcher.received
+        while True:
+            await asyncio.sleep(GC_IDLE_CHECK_INTERVAL)
+            idle = self.dispatcher.received == received and not self.dispatcher.stats()["queue_depth"]
+            received = self.dispatcher.received
+            self.garbage_collector.collect_if_idle(idle)
 
-    async def _process_message_queue(self, mappers_by_input_port_name):
+    async def _watch_config_file(self):
+        watcher = create_config_watcher(self.config_path)
+        try:
+            while True:
+                await watcher.wait_for_change()
+                self._reload_requested.set()
+        finally:
+            watcher.close()
+
+    async def _reload_on_request(self):
         while True:
+            await self._reload_requested.wait()
+            self._reload_requested.clear()
+            self._reload_pending = False
+            await self._reload_config()
+
+    def _load_config(self):
+        return load_config(self.config_path)
+
+    async def _reload_config(self):
+        logger.warning(f"Reloading config {self.config_path}")
+        try:
+            # Parse and validate off the event loop
+            new_config = await asyncio.get_running_loop().run_in_executor(None, self._load_config)
+        except Exception as e:
+            logger.error(f"Keeping the current config. Failed to load {self.config_path}: {e}")
+            return
+        if new_config == self.config:
+            logger.info("Config unchanged")
+            return
+
+        async with self._reconcile_lock:
+            previous_clock_engine = self.clock_engine
+            # Enabling or disabling the sysex settings wraps or unwraps every output port
+            reopen_ports = (new_config.sysex is None) != (self.config.sysex is None)
+            if new_config.clock != self.config.clock:
+                self.clock_engine = self._create_clock_engine(new_config.clock)
+                if self.clock_engine is not None:
+                    self.clock_engine.start()
+                    if previous_clock_engine is None:
+                        self._lock_output_ports()
+            self.config = new_config
             try:
-                incoming_message = self.incoming_message_queue.get(timeout=EVENT_QUEUE_GET_TIMEOUT)
-            except queue.Empty:
-                pass
-            else:
-                input_port_name, message = incoming_message
-                if hasattr(message, "channel"):
-                    logger.info(f"from {input_port_name}: {message}")
-                for mapper in mappers_by_input_port_name.get(input_port_name, []):
-                    mapper.send(input_port_name, message)
-                if hasattr(message, "channel"):
-                    logger.info("\n")
-            await asyncio.sleep(0)  # Cooperative parallelism
+                if reopen_ports:
+                    logger.warning("Reopening all ports to apply the sysex settings")
+                    raise MidiDeviceChangeException()
+                if new_config.sysex is not None:
+                    for port in list(self.output_ports_by_identifier.values()):
+                        find_sysex_output_port(port).configure(new_config.sysex)
+                await self._apply_port_changes(self._port_registry, recompile=True)
+                self._configure_network_output_ports()
+            except MidiDeviceChangeException:
+                raise
+            except Exception as e:
+                logger.exception("Failed to apply the new config")
+                raise MidiDeviceChangeException() from e
+            finally:
+                if previous_clock_engine is not None and previous_clock_engine is not self.clock_engine:
+                    previous_clock_engine.close()
+        logger.warning("Config reloaded")
+
+    def _configure_network_output_ports(self):
+        network_configs_by_identifier = {
+            port_info.identifier: port_info.network
+            for port_info in self.config.ports.outputs
+            if port_info.network is not None
+        }
+        for identifier, port in list(self.output_ports_by_identifier.items()):
+            network_port = find_network_port(port)
+            if network_port is not None and identifier in network_configs_by_identifier:
+                network_port.configure(network_configs_by_identifier[identifier])
+
+    def _lock_output_ports(self):
+        # A new clock engine sends from its own thread
+        for identifier, port in list(self.output_ports_by_identifier.items()):
+            if not isinstance(port, (LockedOutputPort, QueuedOutputPort, SysexOutputPort)):
+                self.output_ports_by_identifier[identifier] = LockedOutputPort(port)
 
     async def _monitor_midi_device_changes(self):
-        old_port_names = (mido.get_input_names(), mido.get_output_names())
+        watcher = create_device_watcher()
+        try:
+            await self._reconcile_device_changes(watcher)
+        finally:
+            watcher.close()
+
+    async def _reconcile_device_changes(self, watcher):
         while True:
-            new_port_names = (mido.get_input_names(), mido.get_output_names())
-            if old_port_names != new_port_names:
-                raise MidiDeviceChangeException()
-            await asyncio.sleep(MIDI_DEVICE_CHANGE_CHECK_SLEEP)  # Cooperative parallelism plus wait
-
-    def _create_mappers_by_input_port_name(self, input_ports_by_identifier, output_ports_by_identifier):
-        mappers_by_input_port_name = {
-            port.name: []
-            for port in input_ports_by_identifier.values()
+            await watcher.wait_for_change()
+            port_registry = self._get_port_registry()
+            if port_registry != self._port_registry:
+                logger.warning("Midi Device Change Detected. Reconciling ports")
+                try:
+                    await self._reconcile_ports(port_registry)
+                except Exception as e:
+                    logger.exception("Failed to reconcile ports")
+                    raise MidiDeviceChangeException() from e
+
+    def _get_port_names(self):
+        return mido.get_input_names(), mido.get_output_names()
+
+    def _get_port_registry(self):
+        # The only place ports are enumerated
+        return PortRegistry(*self._get_port_names())
+
+    async def _reconcile_ports(self, port_registry):
+        async with self._reconcile_lock:
+            await self._apply_port_changes(port_registry)
+            # Opening ports can itself add ports (e.g. rtmidi clients), so snapshot afterwards
+            self._port_registry = self._get_port_registry()
+
+    async def _apply_port_changes(self, port_registry, recompile=False):
+        """
+        Open and close only the ports whose assignment changed, then recompile
+        the routing table if anything changed. Ports that are unaffected stay
+        open, so streams between them are never interrupted.
+
+        The new routing table is compiled on a worker thread and swapped in
+        between two messages. Ports that are no longer used are closed only
+        after the swap. Must be called with the reconcile lock held.
+        """
+        input_port_names_by_identifier = self._get_identifiers_to_port_names(
+            port_registry.inputs, self.config.ports.inputs,
+            {identifier: port.name for identifier, port in self.input_ports_by_identifier.items()},
+            self._input_device_keys_by_identifier)
+        output_port_names_by_identifier = self._get_identifiers_to_port_names(
+            port_registry.outputs, self.config.ports.outputs,
+            {identifier: port.name for identifier, port in self.output_ports_by_identifier.items()},
+            self._output_device_keys_by_identifier)
+        # Buses exposed as virtual ports have a port of each kind
+        virtual_port_names_by_identifier = self._get_virtual_port_names_by_identifier()
+        input_port_names_by_identifier.update(virtual_port_names_by_identifier)
+        output_port_names_by_identifier.update(virtual_port_names_by_identifier)
+
+        unused_ports = []
+        try:
+            inputs_changed = self._reconcile_port_group(
+                "input", self.input_ports_by_identifier, input_port_names_by_identifier, self._open_input_port,
+                unused_ports)
+            outputs_changed = self._reconcile_port_group(
+                "output", self.output_ports_by_identifier, output_port_names_by_identifier, self._open_output_port,
+                unused_ports)
+
+            if inputs_changed or outputs_changed or recompile or self.routing_table is None:
+                routing_table = await asyncio.get_running_loop().run_in_executor(None, functools.partial(
+                    RoutingTable.compile, self.config.mappings, dict(self.input_ports_by_identifier),
+                    dict(self.output_ports_by_identifier), clock_engine=self.clock_engine,
+                    note_tracker=self.note_tracker, max_sysex_size=self._get_max_sysex_size(),
+                    buses=self.config.buses))
+
+                logger.debug(f"input_port_names_by_identifier={json.dumps(input_port_names_by_identifier, indent=2)}")
+                logger.debug(f"output_port_names_by_identifier={json.dumps(output_port_names_by_identifier, indent=2)}")
+                logger.debug(f"routing_table={json.dumps(routing_table.dict(), indent=2)}")
+
+                self.routing_table = routing_table
+                if self.clock_engine is not None:
+                    self.clock_engine.outputs = tuple(self.clock_engine.select_outputs(self._get_device_output_ports()))
+                self.note_tracker.release_unroutable(routing_table)
+                if self.capture is not None:
+                    self.capture.set_port_identifiers(
+                        {port.name: identifier for identifier, port in self.input_ports_by_identifier.items()})
+                # The new routing table is in place for good
+                self.garbage_collector.freeze()
+        finally:
+            # After releasing their held notes, whose note offs closing still sends
+            for port in unused_ports:
+                logger.info(f"Closing {port.name}")
+                port.close()
+
+    def _get_virtual_port_names_by_identifier(self):
+        return {bus.identifier: bus.virtual_port for bus in self.config.buses if bus.virtual_port is not None}
+
+    def _get_device_output_ports(self):
+        """The output ports, without the virtual ports of buses."""
+        bus_identifiers = {bus.identifier for bus in self.config.buses}
+        return {
+            identifier: port
+            for identifier, port in self.output_ports_by_identifier.items()
+            if identifier not in bus_identifiers
         }
-        for mapping_config in self.config.mappings:
-            mapper = Mapper.from_mapping_config(mapping_config, input_ports_by_identifier,
-                                                                output_ports_by_identifier)
-            if mapping_config.from_port == config.PortConstant.ALL:
-                for mapper_list in mappers_by_input_port_name.values():
-                    mapper_list.append(mapper)
-            else:
-                long_name = input_ports_by_identifier[mapping_config.from_port.identifier].name
-                mapper_list = mappers_by_input_port_name.get(long_name)
-                # configs might reference disconnected devices, but mapper_lists only exist for connected
-                # devices.
-                if mapper_list is not None:
-                    mapper_list.append(mapper)
-        return mappers_by_input_port_name
+
+    def _get_max_sysex_size(self):
+        return None if self.config.sysex is None else self.config.sysex.max_size
+
+    def _reconcile_port_group(self, direction, ports_by_identifier, port_names_by_identifier, open_port, unused_ports):
+        """
+        Update ports_by_identifier to match port_names_by_identifier. Open ports
+        are matched by name, so a port that moved to another identifier (e.g.
+        after a config reload) stays open. Ports that are no longer used are
+        appended to unused_ports for the caller to close.
+        """
+        changed = False
+        ports_to_reuse_by_name = {}
+        for identifier, port in list(ports_by_identifier.items()):
+            if port_names_by_identifier.get(identifier) != port.name:
+                del ports_by_identifier[identifier]
+                ports_to_reuse_by_name.setdefault(port.name, []).append(port)
+                changed = True
+
+        try:
+            # Ports that aren't connected have no name. Skip them rather than letting the
+            # backend fall back to its default port.
+            for identifier, port_name in port_names_by_identifier.items():
+                if port_name is not None and identifier not in ports_by_identifier:
+                    if ports_to_reuse_by_name.get(port_name):
+                        port = ports_to_reuse_by_name[port_name].pop()
+                        logger.info(f"Moved {port_name} to {identifier}")
+                    else:
+                        port = open_port(port_name)
+                        if port is None:
+                            self.open_errors_by_port[direction, port_name] += 1
+                            continue
+                        self.opens_by_port[direction, port_name] += 1
+                        logger.info(f"Opened {identifier}: {port_name}")
+                    ports_by_identifier[identifier] = port
+                    changed = True
+        finally:
+            unused_ports.extend(itertools.chain.from_iterable(ports_to_reuse_by_name.values()))
+        return changed
 
     def _create_receive_message_callback(self, input_port_name):
         def _receive_message_callback(message):
-            self.incoming_message_queue.put(IncomingMessage(input_port_name, message))
+            self.dispatcher.put(input_port_name, message)
         return _receive_message_callback
 
+    def _receive_raw_message_callback(self, event, input_port_name):
+        # Registered directly with rtmidi; event is (message_bytes, delta_time)
+        self.dispatcher.put(input_port_name, event[0])
+
     def _open_input_port(self, long_name):
+        network_config = self._get_network_config(self.config.ports.inputs, long_name)
+        if network_config is not None:
+            try:
+                if self.raw:
+                    return NetworkInputPort(long_name, network_config.address, self._receive_raw_message_callback, raw=True)
+                return NetworkInputPort(long_name, network_config.address, self._create_receive_message_callback(long_name))
+            except OSError as e:
+                logger.warning(f"Failed to listen on {network_config.address}: {e!r}")
+                return None
+        virtual = long_name in self._get_virtual_port_names_by_identifier().values()
         try:
-            return mido.open_input(long_name, callback=self._create_receive_message_callback(long_name))
+            if self.raw:
+                return RawInputPort(long_name, self._receive_raw_message_callback, virtual=virtual)
+            return mido.open_input(long_name, virtual=virtual, callback=self._create_receive_message_callback(long_name))
         except RTMidiSystemError as e:
             logger.warning(repr(e))
 
     def _open_output_port(self, long_name):
+        network_config = self._get_network_config(self.config.ports.outputs, long_name)
         try:
-            return mido.open_output(long_name)
+            if network_config is not None:
+                port = NetworkOutputPort(long_name, network_config.address, raw=self.raw,
+                                         batch_window_ms=network_config.batch_window_ms,
+                                         journal_size=network_config.journal_size)
+            elif long_name in self._get_virtual_port_names_by_identifier().values():
+                port = RawOutputPort(long_name, virtual=True) if self.raw else mido.open_output(long_name, virtual=True)
+            elif self.raw:
+                port = RawOutputPort(long_name)
+            else:
+                port = mido.open_output(long_name)
+            sysex_config = self.config.sysex
+            if sysex_config is not None:
+                port = SysexOutputPort(port, raw=self.raw, bytes_per_second=sysex_config.bytes_per_second,
+                                       queue_size=sysex_config.queue_size)
+            if self.output_queue_size:
+                # Already safe to send to from multiple threads
+                return QueuedOutputPort(port, raw=self.raw, maxsize=self.output_queue_size)
+            if isinstance(port, SysexOutputPort):
+                # Already serializes sends
+                return port
+            port = self.dispatcher.wrap_output_port(port)
+            if self.clock_engine is not None and not isinstance(port, LockedOutputPort):
+                # The clock engine sends from its own thread
+                port = LockedOutputPort(port)
+            return port
         except RTMidiSystemError as e:
             logger.warning(repr(e))
-
-    def _get_identifiers_to_port_names(self, available_port_names, port_infos):
+        except OSError as e:
+            if network_config is None:
+                raise
+            logger.warning(f"Failed to send to {network_config.address}: {e!r}")
+
+    @staticmethod
+    def _get_network_config(port_infos, long_name):
+        for port_info in port_infos:
+            if port_info.network is not None and get_network_port_name(port_info) == long_name:
+                return port_info.network
+        return None
+
+    def _get_identifiers_to_port_names(self, available_port_names, port_infos, previous_port_names_by_identifier=None,
+                                       device_keys_by_identifier=None):
         """
-        Create a mapping that assigns every port_info to a unique port.
+        Create a mapping that assigns every port_info to a unique port of
+        available_port_names (a port_registry.PortNames).
 
         This ensures that ports with only short names (no port numbers) will each
-        be allocated a different port (if available).
+        be allocated a different port (if available). Short-named port infos keep
+        their previous port (if still available), or else get a port of the
+        device they were last assigned (see port_registry.get_alsa_device_key),
+        so that neither plugging in another identical device nor unplugging and
+        replugging one (which changes its port numbers) reshuffles the
+        assignments. device_keys_by_identifier remembers those devices and is
+        updated in place.
         """
-        # 1. Map all short names to lists of available long names
-        available_short_names_to_long_names = {}
-        for long_name in available_port_names:
-            short_name, _ = config.Port.parse_long_port_name(long_name)
-            available_short_names_to_long_names.setdefault(short_name, [])
-            available_short_names_to_long_names[short_name].append(long_name)
-
-        logger.debug(f"available_long_names before assigning long-named identifiers: {available_short_names_to_long_names}")
-
-
-        # 2. Assign all long_name specified port infos to their associated ports
-        long_name_port_infos = [port_info for port_info in port_infos if port_info.port is not None]
+        long_names_by_short_name = available_port_names.long_names_by_short_name
+        previous_port_names_by_identifier = previous_port_names_by_identifier or {}
+        if device_keys_by_identifier is None:
+            device_keys_by_identifier = {}
+        taken_long_names = set()
         identifiers_to_port_names = {}
-        for port_info in long_name_port_infos:
-            available_long_names = available_short_names_to_long_names.get(port_info.name, [])
-            if port_info.long_name in available_long_names:
-                available_long_names.remove(port_info.long_name)
-                identifiers_to_port_names[port_info.identifier] = port_info.long_name
+
+        # 1. Assign all long_name specified port infos to their associated ports.
+        # Network ports are always available.
+        short_name_port_infos = []
+        for port_info in port_infos:
+            if port_info.network is not None:
+                identifiers_to_port_names[port_info.identifier] = get_network_port_name(port_info)
+                continue
+            if port_info.port is None:
+                short_name_port_infos.append(port_info)
+                continue
+            long_name = port_info.long_name
+            if long_name in long_names_by_short_name.get(port_info.name, ()) and long_name not in taken_long_names:
+                taken_long_names.add(long_name)
+                identifiers_to_port_names[port_info.identifier] = long_name
             else:
                 identifiers_to_port_names[port_info.identifier] = None
 
-        logger.debug(f"available_long_names after assigning long-named identifiers: {available_short_names_to_long_names}")
+        # Devices only need telling apart when several port infos share a short name
+        short_name_counts = collections.Counter(port_info.name for port_info in short_name_port_infos)
 
-        # 3. Greedily assign remaining ports to short_name specified port infos
-        short_name_port_infos = [port_info for port_info in port_infos if port_info.port is None]
+        # 2. Keep previous assignments of short_name specified port infos
+        unassigned_port_infos = []
         for port_info in short_name_port_infos:
-            available_long_names = available_short_names_to_long_names.get(port_info.name, [])
-            if available_long_names:
-                long_name = available_long_names.pop()
+            previous_long_name = previous_port_names_by_identifier.get(port_info.identifier)
+            if (previous_long_name in long_names_by_short_name.get(port_info.name, ())
+                    and previous_long_name not in taken_long_names):
+                taken_long_names.add(previous_long_name)
+                identifiers_to_port_names[port_info.identifier] = previous_long_name
+            else:
+                unassigned_port_infos.append(port_info)
+
+        # 3. Give the rest a port of the device they were last assigned
+        remaining_port_infos = []
+        for port_info in unassigned_port_infos:
+            device_key = device_keys_by_identifier.get(port_info.identifier)
+            long_name = None
+            if device_key is not None and short_name_counts[port_info.name] > 1:
+                long_name = next((
+                    long_name
+                    for long_name in long_names_by_short_name.get(port_info.name, ())
+                    if long_name not in taken_long_names and available_port_names.device_key(long_name) == device_key
+                ), None)
+            if long_name is not None:
+                taken_long_names.add(long_name)
                 identifiers_to_port_names[port_info.identifier] = long_name
+                logger.info(f"Found the device of {port_info.identifier} at {long_name}")
             else:
-                identifiers_to_port_names[port_info.identifier] = None
+                remaining_port_infos.append(port_info)
+
+        # 4. Greedily assign remaining ports to short_name specified port infos, last port first
+        for port_info in remaining_port_infos:
+            long_name = next((
+                long_name
+                for long_name in reversed(long_names_by_short_name.get(port_info.name, ()))
+                if long_name not in taken_long_names
+            ), None)
+            if long_name is not None:
+                taken_long_names.add(long_name)
+            identifiers_to_port_names[port_info.identifier] = long_name
+
+        for port_info in short_name_port_infos:
+            long_name = identifiers_to_port_names[port_info.identifier]
+            if long_name is not None and short_name_counts[port_info.name] > 1:
+                device_key = available_port_names.device_key(long_name)
+                if device_key is not None:
+                    device_keys_by_identifier[port_info.identifier] = device_key
 
         return identifiers_to_port_names
@@ -0,0 +1,341 @@
+"""
+MIDI over UDP, for linking routers on different machines.
+
+Messages sent to a network output are collected into batches, and every batch
+goes out as a datagram. A datagram also carries the journal: copies of the
+batches sent just before it. A receiver that missed datagrams recovers their
+messages from the journal of the next datagram it gets, so a lost datagram
+only delays its messages (unless more than journal_size datagrams in a row are
+lost). Every output port picks a random session id when it is opened, and a
+receiver starts over with the sequence numbers of a new session, so a sender
+that restarts is heard from straight away.
+
+Every message is sent with its time since the first message of its batch, and
+the receiver replays a batch with the same spacing. Batching therefore adds a
+constant batch_window_ms of latency rather than jitter.
+
+This is a protocol of its own, modeled on RTP-MIDI's recovery journal but
+without its session setup, so both ends must be midi-router.
+"""
+import collections
+import logging
+import random
+import socket
+import struct
+import threading
+import time
+
+import mido
+
+
+logger = logging.getLogger("midi_router")
+
+
+MAGIC = b"MRN2"
+# Magic, session id, number of batches (the journal, oldest first, then the new batch)
+DATAGRAM_HEADER = struct.Struct("<4sIB")
+# Sequence number, number of messages
+BATCH_HEADER = struct.Struct("<IH")
+# Microseconds since the batch's first message, number of bytes
+MESSAGE_HEADER = struct.Struct("<IH")
+# Batches are sent early and the journal is trimmed so that datagrams fit in a
+# single ethernet frame. Longer messages (SysEx) are sent in datagrams of their own.
+MAX_DATAGRAM_SIZE = 1400
+MAX_UDP_PAYLOAD = 65507
+MAX_MESSAGES_PER_BATCH = 0xFFFF
+SEQUENCE_MASK = 0xFFFFFFFF
+
+
+def parse_address(address):
+    """ "host:port" to (host, port). """
+    host, _, port = address.rpartition(":")
+    return host or "0.0.0.0", int(port)
+
+
+def get_network_port_name(port_info):
+    """The name a network port (see config.PortType.NETWORK) is opened under."""
+    return f"{port_info.name} (udp {port_info.network.address})"
+
+
+def is_newer(sequence, last_sequence):
+    return 0 < (sequence - last_sequence) & SEQUENCE_MASK < 0x80000000
+
+
+def encode_batch(sequence, messages):
+    return BATCH_HEADER.pack(sequence, len(messages)) + b"".join(messages)
+
+
+def decode_datagram(datagram):
+    """
+    The session id of a datagram, and the list of its (sequence,
+    [(offset_us, bytes)]) batches, oldest first.
+    """
+    magic, session, batch_count = DATAGRAM_HEADER.unpack_from(datagram)
+    if magic != MAGIC:
+        raise ValueError("not a midi-router datagram")
+    position = DATAGRAM_HEADER.size
+    batches = []
+    for _ in range(batch_count):
+        sequence, message_count = BATCH_HEADER.unpack_from(datagram, position)
+        position += BATCH_HEADER.size
+        messages = []
+        for _ in range(message_count):
+            offset_us, length = MESSAGE_HEADER.unpack_from(datagram, position)
+            position += MESSAGE_HEADER.size
+            messages.append((offset_us, datagram[position:position + length]))
+            position += length
+        batches.append((sequence, messages))
+    if position != len(datagram):
+        raise ValueError("truncated datagram")
+    return session, batches
+
+
+class NetworkOutputPort:
+    """
+    Sends messages to a NetworkInputPort at address ("host:port").
+
+    With a batch_window_ms of 0 every message is sent straight away in its own
+    datagram. Otherwise the first message of a batch starts the window, and a
+    sender thread sends the batch when it ends. Sends are thread safe.
+    """
+    def __init__(self, name, address, raw=False, batch_window_ms=1.0, journal_size=4):
+        self.name = name
+        self.address = address
+        self.raw = raw
+        self.batch_window_ms = batch_window_ms
+        self.journal_size = journal_size
+        self.datagrams_sent = 0
+        self.send_errors = 0
+        self.closed = False
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.connect(parse_address(address))
+        self._session = random.getrandbits(32)
+        self._sequence = 0
+        # Encoded MESSAGE_HEADER + bytes of the batch being collected
+        self._messages = []
+        self._batch_size = BATCH_HEADER.size
+        self._batch_started_at = 0
+        self._journal = collections.deque(maxlen=journal_size)
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._write, name=f"network {name}", daemon=True)
+        self._thread.start()
+
+    def configure(self, network_config):
+        """Apply new settings (see config.NetworkPortConfig) from a config reload."""
+        with self._condition:
+            self.batch_window_ms = network_config.batch_window_ms
+            self.journal_size = network_config.journal_size
+            self._journal = collections.deque(self._journal, maxlen=network_config.journal_size)
+            self._condition.notify()
+
+    def send(self, message):
+        self.send_message(message.bytes())
+
+    def send_message(self, data):
+        with self._condition:
+            if self.closed:
+                return
+            now = time.perf_counter_ns()
+            if self._messages and (
+                    self._batch_size + MESSAGE_HEADER.size + len(data) > MAX_DATAGRAM_SIZE - DATAGRAM_HEADER.size
+                    or len(self._messages) == MAX_MESSAGES_PER_BATCH):
+                self._flush()
+            if not self._messages:
+                self._batch_started_at = now
+            offset_us = min((now - self._batch_started_at) // 1000, 0xFFFFFFFF)
+            message = MESSAGE_HEADER.pack(offset_us, len(data)) + bytes(data)
+            self._messages.append(message)
+            self._batch_size += len(message)
+            if not self.batch_window_ms:
+                self._flush()
+            elif len(self._messages) == 1:
+                self._condition.notify()
+
+    def _write(self):
+        while True:
+            with self._condition:
+                while not self._messages and not self.closed:
+                    self._condition.wait()
+                if self.closed:
+                    return
+                batch_started_at = self._batch_started_at
+                send_at = batch_started_at + int(self.batch_window_ms * 1e6)
+                while not self.closed and self._messages and self._batch_started_at == batch_started_at:
+                    timeout = (send_at - time.perf_counter_ns()) / 1e9
+                    if timeout <= 0:
+                        self._flush()
+                        break
+                    self._condition.wait(timeout)
+
+    def _flush(self):
+        """Send the batch being collected. Must be called with the condition held."""
+        batch = encode_batch(self._sequence, self._messages)
+        self._sequence = (self._sequence + 1) & SEQUENCE_MASK
+        self._messages = []
+        self._batch_size = BATCH_HEADER.size
+        size = DATAGRAM_HEADER.size + len(batch)
+        if size > MAX_UDP_PAYLOAD:
+            logger.warning(f"Dropping a {len(batch)} byte batch to {self.name}: too long for a datagram")
+            return
+        journal = []
+        for journal_batch in reversed(self._journal):
+            if size + len(journal_batch) > MAX_DATAGRAM_SIZE:
+                break
+            journal.append(journal_batch)
+            size += len(journal_batch)
+        journal.reverse()
+        datagram = b"".join([DATAGRAM_HEADER.pack(MAGIC, self._session, len(journal) + 1), *journal, batch])
+        try:
+            self._socket.send(datagram)
+            self.datagrams_sent += 1
+        except OSError as e:
+            # e.g. nothing listening at the other end yet
+            self.send_errors += 1
+            logger.debug(f"Failed to send to {self.name}: {e!r}")
+        if self.journal_size:
+            self._journal.append(batch)
+
+    def stats(self):
+        return {
+            "datagrams": self.datagrams_sent,
+            "errors": self.send_errors,
+            "recovered": 0,
+            "lost": 0,
+        }
+
+    def close(self):
+        # Messages still being batched are sent rather than discarded
+        with self._condition:
+            if self.closed:
+                return
+            if self._messages:
+                self._flush()
+            self.closed = True
+            self._condition.notify()
+        self._thread.join(timeout=1)
+        self._socket.close()
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(name={self.name!r}, address={self.address!r})"
+
+
+class NetworkInputPort:
+    """
+    Receives messages from NetworkOutputPorts on address ("host:port", where
+    an empty host listens on every interface).
+
+    Messages are passed to callback from the receiver thread, like rtmidi does:
+    as callback((message_bytes, delta_time), name) in raw mode, and as
+    callback(mido.Message) otherwise.
+    """
+    def __init__(self, name, address, callback, raw=False):
+        self.name = name
+        self.address = address
+        self.raw = raw
+        self.callback = callback
+        self.datagrams_received = 0
+        self.recovered = 0
+        self.lost = 0
+        self.errors = 0
+        self.closed = False
+        self._session = None
+        self._last_sequence = None
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.bind(parse_address(address))
+        self._thread = threading.Thread(target=self._read, name=f"network {name}", daemon=True)
+        self._thread.start()
+
+    def _read(self):
+        while not self.closed:
+            try:
+                datagram = self._socket.recv(MAX_UDP_PAYLOAD)
+            except OSError:
+                if self.closed:
+                    return
+                raise
+            received_at = time.perf_counter_ns()
+            if not datagram:
+                # Woken up by close()
+                continue
+            try:
+                session, batches = decode_datagram(datagram)
+            except (ValueError, struct.error) as e:
+                self.errors += 1
+                logger.debug(f"Ignoring a datagram on {self.name}: {e!r}")
+                continue
+            self.datagrams_received += 1
+            try:
+                self._receive(session, batches, received_at)
+            except Exception:
+                logger.exception(f"Failed to receive from {self.name}")
+
+    def _receive(self, session, batches, received_at):
+        if session != self._session:
+            if self._session is not None:
+                logger.info(f"{self.name}: the sender restarted")
+            # A new sender starts its sequence numbers over
+            self._session = session
+            self._last_sequence = None
+        last_sequence = self._last_sequence
+        sequence, messages = batches[-1]
+        if last_sequence is not None and not is_newer(sequence, last_sequence):
+            # Duplicated or reordered
+            return
+        if last_sequence is not None:
+            missed = (sequence - last_sequence - 1) & SEQUENCE_MASK
+            # Missed batches that are still in the journal arrive late rather than never
+            for journal_sequence, journal_messages in batches[:-1]:
+                if is_newer(journal_sequence, last_sequence):
+                    missed -= 1
+                    self.recovered += 1
+                    for _, data in journal_messages:
+                        self._deliver(data)
+            self.lost += missed
+        self._last_sequence = sequence
+        # Same spacing as when the messages were sent
+        for offset_us, data in messages:
+            delay = (received_at + offset_us * 1000 - time.perf_counter_ns()) / 1e9
+            if delay > 0:
+                time.sleep(delay)
+            self._deliver(data)
+
+    def _deliver(self, data):
+        if self.raw:
+            self.callback((data, 0.0), self.name)
+        else:
+            try:
+                message = mido.Message.from_bytes(data)
+            except ValueError:
+                self.errors += 1
+                return
+            self.callback(message)
+
+    def stats(self):
+        return {
+            "datagrams": self.datagrams_received,
+            "errors": self.errors,
+            "recovered": self.recovered,
+            "lost": self.lost,
+        }
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            # Wakes up the receiver thread
+            self._socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._thread.join(timeout=1)
+        self._socket.close()
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(name={self.name!r}, address={self.address!r})"
+
+
+def find_network_port(port):
+    """The network port port wraps (possibly through other wrappers), or None."""
+    while port is not None and not isinstance(port, (NetworkInputPort, NetworkOutputPort)):
+        port = getattr(port, "port", None)
+    return port
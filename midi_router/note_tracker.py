@@ -0,0 +1,144 @@
+import logging
+import threading
+
+import mido
+
+
+logger = logging.getLogger("midi_router")
+
+
+NOTE_OFF_STATUS = 0x80
+
+
+class NoteTracker:
+    """
+    Tracks the notes held on every output port, so that notes can be released
+    when the routing changes instead of sending All Notes Off.
+
+    Every output gets a flat table of 16 * 128 entries indexed by
+    channel << 7 | note. An entry is 0 when the note is off, and otherwise
+    packs the input port and the input channel and note that turned it on, so
+    that it can be checked whether the matching note off would still reach the
+    output. Updating an entry is a dict lookup and a list store.
+
+    Tables are keyed by port name, since the port objects of an output change
+    when it gets wrapped (e.g. in a LockedOutputPort once a clock engine is
+    added). They are never removed while routing, as the dispatcher's threads
+    may be recording into them.
+    """
+    def __init__(self, raw=False):
+        self.raw = raw
+        self.tables_by_port_name = {}
+        # The port every table's note offs are sent to
+        self.ports_by_name = {}
+        self._source_names = [None]
+        self._source_indexes = {}
+
+    def source(self, input_port_name, channel, note):
+        """The value recorded for a note turned on from input_port_name."""
+        index = self._source_indexes.get(input_port_name)
+        if index is None:
+            index = self._source_indexes[input_port_name] = len(self._source_names)
+            self._source_names.append(input_port_name)
+        return index << 11 | channel << 7 | note
+
+    def record(self, port, channel, note, source):
+        """Record a note on (source from self.source()) or a note off (source 0) sent to port."""
+        table = self.tables_by_port_name.get(port.name)
+        if table is None:
+            if not source:
+                return
+            self.ports_by_name[port.name] = port
+            table = self.tables_by_port_name[port.name] = [0] * (16 * 128)
+        table[channel << 7 | note] = source
+
+    def release_unroutable(self, routing_table):
+        """
+        Send note offs for held notes whose note off would no longer reach the
+        same output, channel and note through routing_table (because the route
+        changed, or the input or output went away). Call this right after
+        switching to a new routing table.
+        """
+        # Outputs still routed to are sent their note offs through the ports the routing table sends to
+        for slots in routing_table.slots_by_input_port_name.values():
+            for actions in slots:
+                for to_port, _ in actions:
+                    if to_port.name in self.ports_by_name:
+                        self.ports_by_name[to_port.name] = to_port
+        for port_name, table in list(self.tables_by_port_name.items()):
+            released = []
+            for index, source in enumerate(table):
+                if source and not self._routes_note_off(routing_table, source, port_name, index >> 7, index & 0x7F):
+                    table[index] = 0
+                    released.append(index)
+            if released:
+                logger.info(f"Releasing {len(released)} held notes on {port_name}")
+                self._send_note_offs(self.ports_by_name[port_name], released)
+
+    def release_all(self):
+        """
+        Send note offs for every held note, e.g. before closing all ports.
+        Only called while nothing is being routed.
+        """
+        for port_name, table in self.tables_by_port_name.items():
+            self._send_note_offs(self.ports_by_name[port_name], [index for index, source in enumerate(table) if source])
+        self.tables_by_port_name.clear()
+        self.ports_by_name.clear()
+
+    def _routes_note_off(self, routing_table, source, port_name, channel, note):
+        input_port_name = self._source_names[source >> 11]
+        slots = routing_table.slots_by_input_port_name.get(input_port_name)
+        if slots is None:
+            return False
+        in_channel, in_note = (source >> 7) & 0x0F, source & 0x7F
+        # The note off slot of the input channel
+        for to_port, transform in slots[(NOTE_OFF_STATUS & 0x7F) | in_channel]:
+            if to_port.name != port_name:
+                continue
+            if transform is None:
+                out_channel, out_note = in_channel, in_note
+            else:
+                out_channel = in_channel if transform.channel is None else transform.channel
+                out_note = in_note if transform.data1_table is None else transform.data1_table[in_note]
+            if out_channel == channel and out_note == note:
+                return True
+        return False
+
+    def _send_note_offs(self, port, indexes):
+        try:
+            for index in indexes:
+                channel, note = index >> 7, index & 0x7F
+                if self.raw:
+                    port.send_message([NOTE_OFF_STATUS | channel, note, 64])
+                else:
+                    port.send(mido.Message("note_off", channel=channel, note=note))
+        except Exception as e:
+            # Most likely the device is gone, along with its notes
+            logger.info(f"Failed to release notes on {port.name}: {e!r}")
+
+
+class LockedNoteTracker(NoteTracker):
+    """
+    NoteTracker for the direct dispatcher, where every input's callback thread
+    records notes at the same time. Serializes recording and releasing, so that
+    no held note is lost.
+    """
+    def __init__(self, raw=False):
+        super().__init__(raw=raw)
+        self._lock = threading.Lock()
+
+    def source(self, input_port_name, channel, note):
+        with self._lock:
+            return super().source(input_port_name, channel, note)
+
+    def record(self, port, channel, note, source):
+        with self._lock:
+            super().record(port, channel, note, source)
+
+    def release_unroutable(self, routing_table):
+        with self._lock:
+            super().release_unroutable(routing_table)
+
+    def release_all(self):
+        with self._lock:
+            super().release_all()
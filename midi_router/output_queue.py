@@ -0,0 +1,183 @@
+import collections
+import logging
+import threading
+
+
+logger = logging.getLogger("midi_router")
+
+
+DEFAULT_OUTPUT_QUEUE_SIZE = 1024
+# When closing, queued ordered messages are still sent for at most this long
+CLOSE_DRAIN_TIMEOUT = 1.0
+
+# Coalescing keys. Continuous messages (controllers, pitch bend and aftertouch)
+# get an int key so that a pending message can be replaced by a newer one with the
+# same key. Real-time messages (clock, start, stop...) may be sent between any
+# other messages. Everything else (notes, sysex, program changes, channel mode
+# messages...) must stay strictly ordered.
+REALTIME = -1
+ORDERED = None
+# RPN/NRPN parameter selects (98-101) and data entry (6, 38, 96, 97) only make
+# sense in the order they were sent, so they are never coalesced
+PARAMETER_CONTROLS = frozenset((6, 38, 96, 97, 98, 99, 100, 101))
+
+
+def message_coalesce_key(message):
+    message_type = message.type
+    if message_type == "control_change":
+        # Channel mode messages (all notes off, reset all controllers...) are ordered
+        if message.control >= 120 or message.control in PARAMETER_CONTROLS:
+            return ORDERED
+        return (0xB0 | message.channel) << 8 | message.control
+    if message_type == "pitchwheel":
+        return (0xE0 | message.channel) << 8
+    if message_type == "aftertouch":
+        return (0xD0 | message.channel) << 8
+    if message_type == "polytouch":
+        return (0xA0 | message.channel) << 8 | message.note
+    if message.is_realtime:
+        return REALTIME
+    return ORDERED
+
+
+def raw_coalesce_key(data):
+    status = data[0]
+    kind = status & 0xF0
+    if kind == 0xB0:
+        if data[1] >= 120 or data[1] in PARAMETER_CONTROLS:
+            return ORDERED
+        return status << 8 | data[1]
+    if kind == 0xE0 or kind == 0xD0:
+        return status << 8
+    if kind == 0xA0:
+        return status << 8 | data[1]
+    if status >= 0xF8:
+        return REALTIME
+    return ORDERED
+
+
+class QueuedOutputPort:
+    """
+    Output port with its own bounded send queue, drained by a writer thread.
+
+    Sending never blocks on the device, so a slow output can't stall routing to
+    the others. While a controller, pitch bend or aftertouch message is still
+    queued, a newer one with the same channel (and controller/note) replaces its
+    value in place instead of being queued, so a slow device only receives the
+    latest values of a knob sweep. Ordered messages act as a barrier: values
+    queued before a note are never replaced by values sent after it.
+
+    When the queue is full, the oldest queued controller, pitch bend or
+    aftertouch value is dropped (and counted) to make room. If there is none, a
+    new value or real-time message is dropped instead, while ordered messages
+    (note offs in particular) are queued regardless, so that no note is left
+    hanging.
+
+    Closing still sends the queued ordered messages (e.g. the note offs of held
+    notes released before closing), unless sending fails because the device is
+    gone. Queued values and real-time messages are discarded.
+    """
+    def __init__(self, port, raw=False, maxsize=DEFAULT_OUTPUT_QUEUE_SIZE):
+        self.port = port
+        self.name = port.name
+        self.maxsize = maxsize
+        self.dropped = 0
+        self.coalesced = 0
+        self.closed = False
+        self._send = port.send_message if raw else port.send
+        self._coalesce_key = raw_coalesce_key if raw else message_coalesce_key
+        # Slots are [message, key] lists so that queued values can be replaced
+        self._pending = collections.deque()
+        self._pending_slots_by_key = {}
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._write, name=f"writer {self.name}", daemon=True)
+        self._thread.start()
+
+    def send(self, message):
+        key = self._coalesce_key(message)
+        with self._condition:
+            if self.closed:
+                return
+            if key is ORDERED:
+                self._pending_slots_by_key.clear()
+            elif key != REALTIME:
+                slot = self._pending_slots_by_key.get(key)
+                if slot is not None:
+                    slot[0] = message
+                    self.coalesced += 1
+                    return
+
+            if len(self._pending) >= self.maxsize and not self._evict_continuous() and key is not ORDERED:
+                self.dropped += 1
+                return
+            slot = [message, key]
+            self._pending.append(slot)
+            if key is not ORDERED and key != REALTIME:
+                self._pending_slots_by_key[key] = slot
+            self._condition.notify()
+
+    # Raw mode sends bytes through send_message
+    send_message = send
+
+    def _evict_continuous(self):
+        """Drop the oldest queued continuous value. Returns False if there is none."""
+        pending = self._pending
+        for index, slot in enumerate(pending):
+            key = slot[1]
+            if key is not ORDERED and key != REALTIME:
+                del pending[index]
+                if self._pending_slots_by_key.get(key) is slot:
+                    del self._pending_slots_by_key[key]
+                self.dropped += 1
+                return True
+        return False
+
+    def _write(self):
+        pending = self._pending
+        while True:
+            with self._condition:
+                while not pending and not self.closed:
+                    self._condition.wait()
+                if not pending:
+                    # Closed, and everything that was left is sent
+                    return
+                slot = pending.popleft()
+                message, key = slot
+                if self._pending_slots_by_key.get(key) is slot:
+                    del self._pending_slots_by_key[key]
+            try:
+                self._send(message)
+            except Exception as e:
+                if not self.closed:
+                    logger.exception(f"Failed to send to {self.name}")
+                    continue
+                # Most likely the device is gone, so the rest can't be sent either
+                with self._condition:
+                    logger.info(f"Discarding {len(pending) + 1} messages queued to {self.name}: {e!r}")
+                    pending.clear()
+                return
+
+    def stats(self):
+        return {
+            "queue_depth": len(self._pending),
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+        }
+
+    def close(self):
+        with self._condition:
+            self.closed = True
+            ordered = [slot for slot in self._pending if slot[1] is ORDERED]
+            self._pending.clear()
+            self._pending.extend(ordered)
+            self._pending_slots_by_key.clear()
+            self._condition.notify()
+        self._thread.join(timeout=CLOSE_DRAIN_TIMEOUT)
+        with self._condition:
+            if self._pending:
+                logger.info(f"Discarding {len(self._pending)} messages queued to {self.name}: not sent in time")
+                self._pending.clear()
+        self.port.close()
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.port!r})"
@@ -0,0 +1,99 @@
+import logging
+import os
+
+from midi_router import config
+
+
+logger = logging.getLogger("midi_router")
+
+
+# ALSA gives the sequencer clients of sound cards fixed numbers: card N gets
+# clients 16 + 4 * N to 16 + 4 * N + 3 (see SNDRV_SEQ_CLIENTS_PER_CARD).
+ALSA_FIRST_CARD_CLIENT = 16
+ALSA_CLIENTS_PER_CARD = 4
+ALSA_FIRST_DYNAMIC_CLIENT = 128
+SYS_CLASS_SOUND = "/sys/class/sound"
+
+
+def _read_sysfs_attribute(directory, name):
+    try:
+        with open(os.path.join(directory, name)) as stream:
+            return stream.read().strip()
+    except OSError:
+        return None
+
+
+def get_alsa_device_key(long_name):
+    """
+    A key identifying the physical device port behind an ALSA port name (e.g.
+    "NiftyCASE:NiftyCASE MIDI 1 20:0"), which stays the same when the device is
+    plugged in again and gets another client number. USB devices with a serial
+    number are identified by their vendor, product and serial, others by the
+    USB port they're plugged into. Returns None for ports that aren't sound card
+    ports (e.g. software clients) or when sysfs isn't available.
+    """
+    _, port = config.Port.parse_long_port_name(long_name)
+    if port is None:
+        return None
+    client, client_port = (int(number) for number in port.split(":"))
+    if not ALSA_FIRST_CARD_CLIENT <= client < ALSA_FIRST_DYNAMIC_CLIENT:
+        return None
+    card = (client - ALSA_FIRST_CARD_CLIENT) // ALSA_CLIENTS_PER_CARD
+    # Symlink to the card's USB interface, e.g. .../usb1/1-1/1-1.3/1-1.3:1.0
+    device = os.path.realpath(os.path.join(SYS_CLASS_SOUND, f"card{card}", "device"))
+    usb_device = os.path.dirname(device)
+    vendor = _read_sysfs_attribute(usb_device, "idVendor")
+    if vendor is None:
+        return None
+    product = _read_sysfs_attribute(usb_device, "idProduct")
+    serial = _read_sysfs_attribute(usb_device, "serial")
+    # Which of the card's clients, and which port of that client
+    port_key = ((client - ALSA_FIRST_CARD_CLIENT) % ALSA_CLIENTS_PER_CARD, client_port)
+    if serial:
+        return ("usb", vendor, product, serial) + port_key
+    return ("usb port", os.path.basename(usb_device)) + port_key
+
+
+class PortNames:
+    """The available names of one direction (inputs or outputs), parsed once and indexed by short name."""
+    def __init__(self, long_names, get_device_key=get_alsa_device_key):
+        self.long_names = list(long_names)
+        self.long_names_by_short_name = {}
+        for long_name in self.long_names:
+            short_name, _ = config.Port.parse_long_port_name(long_name)
+            self.long_names_by_short_name.setdefault(short_name, []).append(long_name)
+        self._get_device_key = get_device_key
+        self._device_keys = {}
+
+    def device_key(self, long_name):
+        """See get_alsa_device_key. Looked up at most once per snapshot."""
+        try:
+            return self._device_keys[long_name]
+        except KeyError:
+            pass
+        try:
+            device_key = self._get_device_key(long_name)
+        except (OSError, ValueError) as e:
+            logger.debug(f"No device key for {long_name}: {e!r}")
+            device_key = None
+        self._device_keys[long_name] = device_key
+        return device_key
+
+    def __contains__(self, long_name):
+        return long_name in self.long_names
+
+    def __eq__(self, other):
+        return isinstance(other, PortNames) and self.long_names == other.long_names
+
+
+class PortRegistry:
+    """
+    Snapshot of the available midi ports, taken once per device change and
+    shared by everything that needs port names until the next change.
+    """
+    def __init__(self, input_port_names, output_port_names, get_device_key=get_alsa_device_key):
+        self.inputs = PortNames(input_port_names, get_device_key)
+        self.outputs = PortNames(output_port_names, get_device_key)
+
+    def __eq__(self, other):
+        return isinstance(other, PortRegistry) and self.inputs == other.inputs and self.outputs == other.outputs
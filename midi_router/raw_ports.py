@@ -0,0 +1,66 @@
+"""
+Thin wrappers around rtmidi ports that deal in raw midi bytes.
+
+These bypass mido's message parsing entirely: input callbacks receive the list
+of bytes rtmidi produced, and outputs forward byte sequences straight to
+rtmidi's send_message.
+"""
+try:
+    import rtmidi
+except ImportError:
+    rtmidi = None
+
+
+class RawPort:
+    def __init__(self, rt, name, virtual=False):
+        if name is None:
+            raise IOError("raw ports must be opened by name")
+        if virtual:
+            # A new port other software can connect to
+            rt.open_virtual_port(name)
+        else:
+            port_names = rt.get_ports()
+            if name not in port_names:
+                rt.delete()
+                raise IOError(f"unknown port {name!r}")
+            rt.open_port(port_names.index(name))
+        self._rt = rt
+        self.name = name
+        self.closed = False
+
+    def close(self):
+        if not self.closed:
+            self._rt.close_port()
+            self._rt.delete()
+            self.closed = True
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(name={self.name!r})"
+
+
+class RawInputPort(RawPort):
+    def __init__(self, name, callback, virtual=False):
+        """
+        callback is registered directly with rtmidi and is called as
+        callback((message_bytes, delta_time), name) on the rtmidi thread.
+        """
+        if rtmidi is None:
+            raise ImportError("python-rtmidi is required for raw ports")
+        super().__init__(rtmidi.MidiIn(), name, virtual)
+        # Same filtering as mido: keep sysex and timing messages, drop active sensing
+        self._rt.ignore_types(False, False, True)
+        self._rt.set_callback(callback, name)
+
+    def close(self):
+        if not self.closed:
+            self._rt.cancel_callback()
+        super().close()
+
+
+class RawOutputPort(RawPort):
+    def __init__(self, name, virtual=False):
+        if rtmidi is None:
+            raise ImportError("python-rtmidi is required for raw ports")
+        super().__init__(rtmidi.MidiOut(), name, virtual)
+        # Bind directly so sending costs a single C call
+        self.send_message = self._rt.send_message
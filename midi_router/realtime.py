@@ -0,0 +1,216 @@
+"""
+Process settings that keep other processes and Python's garbage collector from
+delaying messages: real-time scheduling, CPU pinning, locked memory and
+garbage collection modes.
+
+Every setting falls back gracefully: when it can't be applied (usually for
+lack of privileges) the router runs on without it, and the report says why.
+"""
+import ctypes
+import ctypes.util
+import errno
+import gc
+import os
+import time
+try:
+    import resource
+except ImportError:
+    # Not on Windows
+    resource = None
+
+
+# mlockall flags from <sys/mman.h>
+MCL_CURRENT = 1
+MCL_FUTURE = 2
+
+# Garbage collection modes (see GarbageCollector)
+GC_MODES = ("auto", "freeze", "manual")
+# How often the collector checks whether the router is idle (unless "auto")
+GC_IDLE_CHECK_INTERVAL = 0.05
+# Young generation collections are run when idle once this many objects were allocated
+GC_YOUNG_THRESHOLD = 700
+# When messages never stop coming, young generation collections are run anyway
+# at this many allocations, so that cyclic garbage can't grow forever
+GC_BUSY_THRESHOLD = 100 * GC_YOUNG_THRESHOLD
+# Full collections are run when idle at most this often
+GC_FULL_COLLECTION_INTERVAL = 30.0
+
+
+def set_realtime_priority(priority):
+    """Run the process (and the threads it starts) under SCHED_FIFO at priority (1-99)."""
+    try:
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+    except AttributeError:
+        return False, "SCHED_FIFO isn't available on this platform"
+    except PermissionError:
+        return False, "not permitted (run as root, or raise the rtprio limit or grant CAP_SYS_NICE)"
+    except OSError as e:
+        return False, f"failed: {e}"
+    return True, f"SCHED_FIFO at priority {priority}"
+
+
+def set_cpu_affinity(cpus):
+    """Only run the process (and the threads it starts) on cpus."""
+    try:
+        os.sched_setaffinity(0, cpus)
+    except AttributeError:
+        return False, "CPU affinity isn't available on this platform"
+    except OSError as e:
+        if e.errno == errno.EINVAL:
+            return False, "none of these CPUs are available"
+        return False, f"failed: {e}"
+    return True, "pinned to CPUs " + ",".join(str(cpu) for cpu in sorted(os.sched_getaffinity(0)))
+
+
+def lock_memory():
+    """
+    Lock the process's memory into RAM, so that routing never waits for a page
+    to be read back from swap. Memory allocated later is locked too when the
+    memlock limit allows it; otherwise only the current memory is, since
+    allocations beyond the limit would fail.
+    """
+    libc_name = ctypes.util.find_library("c")
+    if libc_name is None or resource is None:
+        return False, "mlockall isn't available on this platform"
+    libc = ctypes.CDLL(libc_name, use_errno=True)
+    if not hasattr(libc, "mlockall"):
+        return False, "mlockall isn't available on this platform"
+    soft_limit, _ = resource.getrlimit(resource.RLIMIT_MEMLOCK)
+    lock_future = os.geteuid() == 0 or soft_limit == resource.RLIM_INFINITY
+    if libc.mlockall(MCL_CURRENT | MCL_FUTURE if lock_future else MCL_CURRENT) != 0:
+        return False, f"failed: {os.strerror(ctypes.get_errno())} (run as root, or raise the memlock limit)"
+    if lock_future:
+        return True, "current and future memory locked"
+    return True, f"current memory locked (the memlock limit of {soft_limit} bytes keeps future memory unlocked)"
+
+
+def apply_realtime_settings(priority=None, cpus=None, lock=False):
+    """
+    Apply the requested settings to the process. Returns a (setting, applied,
+    description) report of each.
+    """
+    report = []
+    if priority is not None:
+        report.append(("priority", *set_realtime_priority(priority)))
+    if cpus:
+        report.append(("cpu affinity", *set_cpu_affinity(cpus)))
+    if lock:
+        report.append(("memory lock", *lock_memory()))
+    return report
+
+
+def format_report(report):
+    return "\n".join(
+        f"{setting}: {description if applied else 'not applied, ' + description}"
+        for setting, applied, description in report
+    )
+
+
+def parse_cpus(value):
+    """ "0,2-3" to {0, 2, 3}. """
+    cpus = set()
+    for part in value.split(","):
+        first, _, last = part.partition("-")
+        cpus.update(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+class GarbageCollector:
+    """
+    Controls when Python's garbage collector runs in a MidiRouter.
+
+    "auto" leaves it to Python. "freeze" moves everything allocated up to the
+    end of startup (the routing table, ports, imported modules) out of the
+    collector's reach, so the collections Python still runs only look at recent
+    objects. After a routing table change, that is done again the next time
+    the router is idle (no message arrived for GC_IDLE_CHECK_INTERVAL).
+    "manual" does the same and also disables automatic collection: collections
+    run when the router is idle instead.
+
+    Also measures every collection's pause.
+    """
+    def __init__(self, mode="auto"):
+        if mode not in GC_MODES:
+            raise ValueError(f"unknown gc mode {mode!r}")
+        self.mode = mode
+        self.collections = [0, 0, 0]
+        self.max_pause_ns = 0
+        self.total_pause_ns = 0
+        self._collection_started_at = None
+        self._last_full_collection_at = time.monotonic()
+        self._frozen = False
+        self._freeze_pending = False
+
+    def start(self):
+        gc.callbacks.append(self._on_collection)
+        if self.mode == "manual":
+            gc.disable()
+
+    def stop(self):
+        if self.mode == "manual":
+            gc.enable()
+        if self.mode != "auto":
+            gc.unfreeze()
+        self._frozen = self._freeze_pending = False
+        try:
+            gc.callbacks.remove(self._on_collection)
+        except ValueError:
+            pass
+
+    def _on_collection(self, phase, info):
+        if phase == "start":
+            self._collection_started_at = time.perf_counter_ns()
+        elif self._collection_started_at is not None:
+            pause_ns = time.perf_counter_ns() - self._collection_started_at
+            self._collection_started_at = None
+            self.collections[info["generation"]] += 1
+            self.total_pause_ns += pause_ns
+            if pause_ns > self.max_pause_ns:
+                self.max_pause_ns = pause_ns
+
+    def freeze(self):
+        """
+        Called once the routing structures are in place. Only when starting
+        are they frozen right away: a full collection could stall routing
+        while ports are reconciled or the config reloaded, so later changes are
+        frozen by collect_if_idle.
+        """
+        if self.mode == "auto":
+            return
+        if self._frozen:
+            self._freeze_pending = True
+            return
+        self._frozen = True
+        gc.collect()
+        gc.freeze()
+
+    def collect_if_idle(self, idle):
+        """Called every GC_IDLE_CHECK_INTERVAL, unless in auto mode."""
+        if idle and self._freeze_pending:
+            self._freeze_pending = False
+            self._last_full_collection_at = time.monotonic()
+            # The replaced routing structures were frozen too, and can only be collected once unfrozen
+            gc.unfreeze()
+            gc.collect()
+            gc.freeze()
+            return
+        if self.mode != "manual":
+            return
+        young_count = gc.get_count()[0]
+        if idle:
+            now = time.monotonic()
+            if now - self._last_full_collection_at >= GC_FULL_COLLECTION_INTERVAL:
+                self._last_full_collection_at = now
+                gc.collect()
+            elif young_count >= GC_YOUNG_THRESHOLD:
+                gc.collect(1)
+        elif young_count >= GC_BUSY_THRESHOLD:
+            gc.collect(0)
+
+    def stats(self):
+        return {
+            "mode": self.mode,
+            "collections": list(self.collections),
+            "max_pause_us": self.max_pause_ns // 1000,
+            "total_pause_ms": self.total_pause_ns / 1e6,
+        }
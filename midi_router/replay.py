@@ -0,0 +1,82 @@
+import logging
+import threading
+import time
+
+import mido
+
+from midi_router import config
+from midi_router.capture import read_capture
+from midi_router.midi_router import MidiRouter
+
+
+logger = logging.getLogger("midi_router")
+
+
+class ReplayInputPort:
+    """Stands in for an input device whose messages come from a capture."""
+    def __init__(self, name):
+        self.name = name
+
+    def close(self):
+        pass
+
+
+class ReplayRouter(MidiRouter):
+    """
+    Routes captured messages instead of messages from input devices. Every
+    configured input gets a stand-in port, outputs are opened as usual.
+
+    Connected inputs keep their names, so that messages are never echoed back
+    to the device they were captured from, just like when routing live.
+    """
+    def _get_port_names(self):
+        input_port_names = mido.get_input_names()
+        short_names = {config.Port.parse_long_port_name(name)[0] for name in input_port_names}
+        input_port_names.extend(
+            port_info.long_name for port_info in self.config.ports.inputs if port_info.name not in short_names)
+        return input_port_names, mido.get_output_names()
+
+    def _open_input_port(self, long_name):
+        return ReplayInputPort(long_name)
+
+
+def replay_capture(capture_path, config, speed=1.0, **router_kwargs):
+    """
+    Feed the messages of a capture through a ReplayRouter, keeping their
+    original timing divided by speed (0 replays as fast as possible). Returns
+    the number of messages replayed.
+    """
+    _, records = read_capture(capture_path)
+    router = ReplayRouter(config, **router_kwargs)
+    thread = threading.Thread(target=router.run, name="replay router", daemon=True)
+    thread.start()
+    while not router.running.wait(0.1):
+        if not thread.is_alive():
+            raise RuntimeError("The replay router failed to start")
+    replayed = 0
+    skipped_identifiers = set()
+    try:
+        port_names_by_identifier = {
+            identifier: port.name for identifier, port in router.input_ports_by_identifier.items()}
+        started_at = time.perf_counter_ns()
+        first_timestamp = records[0][0] if records else 0
+        for timestamp, identifier, data in records:
+            input_port_name = port_names_by_identifier.get(identifier)
+            if input_port_name is None:
+                if identifier not in skipped_identifiers:
+                    logger.warning(f"Skipping messages from {identifier}, which isn't an input in the config")
+                    skipped_identifiers.add(identifier)
+                continue
+            if speed:
+                delay = started_at + (timestamp - first_timestamp) / speed - time.perf_counter_ns()
+                if delay > 0:
+                    time.sleep(delay / 1e9)
+            router.dispatcher.put(input_port_name, list(data) if router.raw else mido.Message.from_bytes(data))
+            replayed += 1
+        # Let the router drain what's still queued
+        while router.dispatcher.stats()["queue_depth"]:
+            time.sleep(0.001)
+    finally:
+        router.stop()
+        thread.join()
+    return replayed
@@ -0,0 +1,349 @@
+import time
+
+from midi_router import config
+from midi_router.clock import CLOCK_STATUS_BYTES
+from midi_router.transforms import CHANNEL_STATUS_BY_TYPE, SYSTEM_STATUS_BY_TYPE, MappingTransforms, compose_transforms
+
+
+# Every status byte (0x80-0xFF) has its own slot, so message type filters cost
+# nothing when routing. A message's slot is its status byte & 0x7F.
+NUM_SLOTS = 128
+CHANNEL_SLOTS_BY_TYPE = {message_type: status & 0x7F for message_type, status in CHANNEL_STATUS_BY_TYPE.items()}
+SYSTEM_SLOTS_BY_TYPE = {message_type: status & 0x7F for message_type, status in SYSTEM_STATUS_BY_TYPE.items()}
+# Channel messages are looked up by their type's slot | channel, and system
+# messages (which have no channel) by their slot | 0
+SLOTS_BY_TYPE = {**CHANNEL_SLOTS_BY_TYPE, **SYSTEM_SLOTS_BY_TYPE}
+CLOCK_SLOTS = frozenset(status & 0x7F for status in CLOCK_STATUS_BYTES)
+SYSEX_SLOT = SYSTEM_SLOTS_BY_TYPE["sysex"]
+SYSTEM_SLOTS_START = 0x70
+# The slots messages can be in
+MESSAGE_SLOTS = sorted(
+    {type_slot | channel for type_slot in CHANNEL_SLOTS_BY_TYPE.values() for channel in range(16)}
+    | set(SYSTEM_SLOTS_BY_TYPE.values()))
+# Note off and note on slots come first
+NOTE_SLOTS_END = 0x20
+
+
+class _Bus:
+    """A bus (see config.BusConfig) while compiling a RoutingTable."""
+    def __init__(self, input_port=None, output_port=None):
+        # The bus's virtual ports, if it's exposed as one
+        self.input_port = input_port
+        self.output_port = output_port
+        # The actions of the mappings from the bus, like an input port's
+        self.action_dicts = [{} for _ in range(NUM_SLOTS)]
+        self._joined_action_dicts = None
+
+    def get_joined_action_dicts(self):
+        """The actions of every slot once buses this bus routes to are joined (see RoutingTable._join_buses)."""
+        if self._joined_action_dicts is None:
+            joined_action_dicts = RoutingTable._join_buses(None, self.action_dicts)
+            if self.output_port is not None:
+                # Everything routed to the bus also goes to its virtual port
+                for slot in MESSAGE_SLOTS:
+                    key = (id(self.output_port), RoutingTable._get_dedupe_key(slot, None))
+                    joined_action_dicts[slot] = {key: (self.output_port, None), **joined_action_dicts[slot]}
+            self._joined_action_dicts = joined_action_dicts
+        return self._joined_action_dicts
+
+
+class RoutingTable:
+    """
+    Flat lookup table compiled from the config mappings.
+
+    Every connected input port gets NUM_SLOTS slots, one per status byte (that
+    is, per channel voice message type and channel, and per system message
+    type). Each slot holds a tuple of deduplicated (output_port, transform)
+    actions, where transform is a transforms.RouteTransform (or a
+    transforms.SysexFilter in the sysex slot), or None when the message is sent
+    unchanged. Routing a message is a single lookup followed by the sends.
+
+    Mappings to and from buses (see config.BusConfig) are joined when
+    compiling, composing their transforms, so a message routed through any
+    number of buses still takes a single lookup.
+
+    With a clock engine (see clock.ClockEngine), clock messages from its source
+    input are sent to the engine, and are never routed directly to the outputs
+    the engine sends clock to.
+
+    With a note tracker (see note_tracker.NoteTracker), every note on and note
+    off sent is recorded.
+    """
+    def __init__(self, slots_by_input_port_name, note_tracker=None):
+        self.slots_by_input_port_name = slots_by_input_port_name
+        self.note_tracker = note_tracker
+
+    @classmethod
+    def compile(cls, mappings, input_ports_by_identifier, output_ports_by_identifier, clock_engine=None,
+                note_tracker=None, max_sysex_size=None, buses=()):
+        """
+        buses are the config.BusConfigs. The ports of buses exposed as virtual
+        ports are in input_ports_by_identifier and output_ports_by_identifier
+        under the bus identifier.
+        """
+        bus_identifiers = {bus.identifier for bus in buses}
+        input_ports = {
+            identifier: port
+            for identifier, port in input_ports_by_identifier.items()
+            if port is not None and identifier not in bus_identifiers
+        }
+        output_ports = {
+            identifier: port
+            for identifier, port in output_ports_by_identifier.items()
+            if port is not None and identifier not in bus_identifiers
+        }
+        buses_by_identifier = {
+            bus.identifier: _Bus(input_ports_by_identifier.get(bus.identifier),
+                                 output_ports_by_identifier.get(bus.identifier))
+            for bus in buses
+        }
+
+        # Keyed by (id(output_port), effective output channel, transform tables) to
+        # dedupe actions while preserving the order in which mappings were declared.
+        # Actions can send to buses until they are joined below.
+        action_dicts_by_input_port_name = {
+            port.name: [{} for _ in range(NUM_SLOTS)]
+            for port in input_ports.values()
+        }
+
+        for mapping_config in mappings:
+            # (input port name, action dicts) of every source, where buses have no name
+            if mapping_config.from_port == config.PortConstant.ALL:
+                from_sources = [(port.name, action_dicts_by_input_port_name[port.name]) for port in input_ports.values()]
+            elif mapping_config.from_port.identifier in buses_by_identifier:
+                from_sources = [(None, buses_by_identifier[mapping_config.from_port.identifier].action_dicts)]
+            else:
+                from_port = input_ports.get(mapping_config.from_port.identifier)
+                # configs might reference disconnected devices
+                from_sources = [(from_port.name, action_dicts_by_input_port_name[from_port.name])] if from_port is not None else []
+
+            if mapping_config.to_port == config.PortConstant.ALL:
+                to_ports = list(output_ports.values())
+            elif mapping_config.to_port.identifier in buses_by_identifier:
+                to_ports = [buses_by_identifier[mapping_config.to_port.identifier]]
+            else:
+                to_port = output_ports.get(mapping_config.to_port.identifier)
+                to_ports = [to_port] if to_port is not None else []
+
+            if mapping_config.from_channel == config.ChannelConstant.ALL:
+                from_channels = range(16)
+            else:
+                from_channels = [mapping_config.from_channel]
+
+            transforms = MappingTransforms(mapping_config, max_sysex_size)
+            # (slot, transform, dedupe key) of every system message this mapping routes
+            system_slot_transforms = []
+            for message_type, slot in SYSTEM_SLOTS_BY_TYPE.items():
+                if message_type not in transforms.message_types:
+                    continue
+                transform = transforms.sysex_filter if slot == SYSEX_SLOT else None
+                system_slot_transforms.append((slot, transform, cls._get_dedupe_key(slot, transform)))
+            # (slot, transform, dedupe key) of every channel message this mapping routes
+            channel_slot_transforms = []
+            for message_type, type_slot in CHANNEL_SLOTS_BY_TYPE.items():
+                if message_type not in transforms.message_types:
+                    continue
+                for from_channel in from_channels:
+                    for to_channel in cls._get_to_channels(mapping_config, from_channel):
+                        transform = transforms.get(message_type, None if to_channel == from_channel else to_channel)
+                        key = (to_channel, None if transform is None else transform.key[1:])
+                        channel_slot_transforms.append((type_slot | from_channel, transform, key))
+
+            for from_port_name, action_dicts in from_sources:
+                for to_port in to_ports:
+                    # Never echo messages back to the device they came from
+                    if not isinstance(to_port, _Bus) and to_port.name == from_port_name:
+                        continue
+
+                    # Channel filters never apply to channelless messages
+                    for slot, transform, key in system_slot_transforms:
+                        action_dicts[slot].setdefault((id(to_port), key), (to_port, transform))
+
+                    for slot, transform, key in channel_slot_transforms:
+                        action_dicts[slot].setdefault((id(to_port), key), (to_port, transform))
+
+        if buses_by_identifier:
+            action_dicts_by_input_port_name = {
+                input_port_name: cls._join_buses(input_port_name, action_dicts)
+                for input_port_name, action_dicts in action_dicts_by_input_port_name.items()
+            }
+            # Messages from a bus's virtual port go where messages routed to the bus go
+            for bus in buses_by_identifier.values():
+                if bus.input_port is not None:
+                    action_dicts_by_input_port_name[bus.input_port.name] = [
+                        {key: action for key, action in action_dict.items() if action[0].name != bus.input_port.name}
+                        for action_dict in bus.get_joined_action_dicts()
+                    ]
+
+        if clock_engine is not None:
+            clock_output_ids = {id(port) for port in clock_engine.select_outputs(output_ports)}
+            source_port = input_ports.get(clock_engine.source_identifier)
+            for input_port_name, action_dicts in action_dicts_by_input_port_name.items():
+                for slot in CLOCK_SLOTS:
+                    clock_action_dict = {
+                        key: action
+                        for key, action in action_dicts[slot].items()
+                        if key[0] not in clock_output_ids
+                    }
+                    if source_port is not None and input_port_name == source_port.name:
+                        clock_action_dict = {(id(clock_engine), None): (clock_engine, None), **clock_action_dict}
+                    action_dicts[slot] = clock_action_dict
+
+        return cls({
+            input_port_name: [tuple(action_dict.values()) for action_dict in action_dicts]
+            for input_port_name, action_dicts in action_dicts_by_input_port_name.items()
+        }, note_tracker)
+
+    @staticmethod
+    def _get_dedupe_key(slot, transform):
+        """The dedupe key of an action (without the output port) in slot."""
+        if slot >= SYSTEM_SLOTS_START:
+            return None if transform is None else transform.key
+        to_channel = slot & 0x0F if transform is None or transform.channel is None else transform.channel
+        return (to_channel, None if transform is None else transform.key[1:])
+
+    @classmethod
+    def _join_buses(cls, input_port_name, action_dicts):
+        """
+        Replace the actions that send to buses with the actions of the buses,
+        so that routing through buses takes a single lookup. input_port_name is
+        the port the actions route from (None for a bus).
+        """
+        joined_action_dicts = []
+        for slot, action_dict in enumerate(action_dicts):
+            joined_action_dict = {}
+            for key, (to_port, transform) in action_dict.items():
+                if not isinstance(to_port, _Bus):
+                    joined_action_dict.setdefault(key, (to_port, transform))
+                    continue
+                from_channel = None
+                bus_slot = slot
+                if slot < SYSTEM_SLOTS_START:
+                    from_channel = slot & 0x0F
+                    if transform is not None and transform.channel is not None:
+                        bus_slot = (slot & 0x70) | transform.channel
+                for bus_key, (bus_to_port, bus_transform) in to_port.get_joined_action_dicts()[bus_slot].items():
+                    # Never echo messages back to the device they came from
+                    if bus_to_port.name == input_port_name:
+                        continue
+                    if transform is None:
+                        # Sent on unchanged, so the bus's key still applies
+                        joined_action_dict.setdefault(bus_key, (bus_to_port, bus_transform))
+                        continue
+                    joined_transform = compose_transforms(transform, bus_transform, from_channel)
+                    joined_action_dict.setdefault(
+                        (id(bus_to_port), cls._get_dedupe_key(slot, joined_transform)), (bus_to_port, joined_transform))
+            joined_action_dicts.append(joined_action_dict)
+        return joined_action_dicts
+
+    @staticmethod
+    def _get_to_channels(mapping_config, from_channel):
+        to_channel = mapping_config.to_channel
+        if to_channel == config.ChannelConstant.ALL:
+            return [from_channel]
+        if isinstance(to_channel, list):
+            return to_channel
+        return [to_channel]
+
+    def route(self, input_port_name, message, sent_at=None):
+        """
+        Route a mido message. With a sent_at list, the time.perf_counter_ns()
+        after every action is appended to it (for stats.RouterStats).
+        """
+        slots = self.slots_by_input_port_name.get(input_port_name)
+        if slots is None:
+            return ()
+        slot = SLOTS_BY_TYPE[message.type] | getattr(message, "channel", 0)
+        actions = slots[slot]
+        if slot < NOTE_SLOTS_END and self.note_tracker is not None:
+            self._route_tracked_note(input_port_name, message, actions, sent_at)
+            return actions
+        for to_port, transform in actions:
+            if transform is None:
+                to_port.send(message)
+            else:
+                transformed = transform.apply(message)
+                if transformed is not None:
+                    to_port.send(transformed)
+            if sent_at is not None:
+                sent_at.append(time.perf_counter_ns())
+        return actions
+
+    def route_bytes(self, input_port_name, data, sent_at=None):
+        """
+        Route a raw midi message (a sequence of ints as produced by rtmidi).
+
+        Transforms rewrite a copied bytearray. Output ports must provide
+        send_message (see raw_ports.RawOutputPort).
+        """
+        slots = self.slots_by_input_port_name.get(input_port_name)
+        if slots is None:
+            return ()
+        slot = data[0] & 0x7F
+        actions = slots[slot]
+        if slot < NOTE_SLOTS_END and self.note_tracker is not None:
+            self._route_tracked_note_bytes(input_port_name, data, actions, sent_at)
+            return actions
+        for to_port, transform in actions:
+            if transform is None:
+                to_port.send_message(data)
+            else:
+                transformed = transform.apply_bytes(data)
+                if transformed is not None:
+                    to_port.send_message(transformed)
+            if sent_at is not None:
+                sent_at.append(time.perf_counter_ns())
+        return actions
+
+    def _route_tracked_note(self, input_port_name, message, actions, sent_at):
+        note_tracker = self.note_tracker
+        channel, note = message.channel, message.note
+        source = 0
+        if message.type == "note_on" and message.velocity:
+            source = note_tracker.source(input_port_name, channel, note)
+        for to_port, transform in actions:
+            if transform is None:
+                to_port.send(message)
+                note_tracker.record(to_port, channel, note, source)
+            else:
+                transformed = transform.apply(message)
+                if transformed is not None:
+                    to_port.send(transformed)
+                    note_tracker.record(to_port, transformed.channel, transformed.note, source)
+            if sent_at is not None:
+                sent_at.append(time.perf_counter_ns())
+
+    def _route_tracked_note_bytes(self, input_port_name, data, actions, sent_at):
+        note_tracker = self.note_tracker
+        channel, note = data[0] & 0x0F, data[1]
+        source = 0
+        if data[0] >= 0x90 and data[2]:
+            source = note_tracker.source(input_port_name, channel, note)
+        for to_port, transform in actions:
+            if transform is None:
+                to_port.send_message(data)
+                note_tracker.record(to_port, channel, note, source)
+            else:
+                transformed = transform.apply_bytes(data)
+                if transformed is not None:
+                    to_port.send_message(transformed)
+                    note_tracker.record(to_port, transformed[0] & 0x0F, transformed[1], source)
+            if sent_at is not None:
+                sent_at.append(time.perf_counter_ns())
+
+    def dict(self):
+        slot_names = {slot: message_type for message_type, slot in SYSTEM_SLOTS_BY_TYPE.items()}
+        for message_type, type_slot in CHANNEL_SLOTS_BY_TYPE.items():
+            for channel in range(16):
+                slot_names[type_slot | channel] = f"{message_type} {channel}"
+        return {
+            input_port_name: {
+                slot_names.get(slot_index, hex(0x80 | slot_index)): [
+                    to_port.name if transform is None else f"{to_port.name} ({transform})"
+                    for to_port, transform in actions
+                ]
+                for slot_index, actions in enumerate(slots)
+                if actions
+            }
+            for input_port_name, slots in self.slots_by_input_port_name.items()
+        }
@@ -0,0 +1,432 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import shutil
+import signal
+import tempfile
+import time
+
+from midi_router import config
+from midi_router.config_cache import load_config
+from midi_router.config_watcher import create_config_watcher
+from midi_router.metrics import MetricsServer
+from midi_router.midi_router import MidiRouter
+from midi_router.realtime import apply_realtime_settings
+from midi_router.stats import RouterStats, StatsServer, read_stats_async
+from midi_router.trace import MessageTracer
+
+
+logger = logging.getLogger("midi_router")
+
+
+# How often the supervisor checks on its workers
+WORKER_CHECK_SLEEP = 1.0
+
+# Wait this long before restarting a worker that exited, so that a worker that
+# keeps failing doesn't spin.
+WORKER_RESTART_DELAY = 2.0
+
+# How long a worker gets to release its notes and close its ports when stopped
+WORKER_STOP_TIMEOUT = 5.0
+
+# How long statistics wait for a worker before leaving it out
+STATS_TIMEOUT = 1.0
+
+
+def find_routing_groups(router_config):
+    """
+    Partition the config's ports into independent routing groups: the connected
+    components of the graph with an edge for every route from an input to an
+    output. Returns a list of (input identifiers, output identifiers, mapping
+    indexes, has clock) of the groups that have at least one mapping or the
+    clock engine.
+
+    Ports that share a name are kept in the same group, because which device
+    each of them gets is decided together (see
+    MidiRouter._get_identifiers_to_port_names).
+    """
+    inputs = [("in", port.identifier) for port in router_config.ports.inputs]
+    outputs = [("out", port.identifier) for port in router_config.ports.outputs]
+    # Mappings through a bus are joined, so a bus groups the ports it connects
+    bus_identifiers = {bus.identifier for bus in router_config.buses}
+    parents = {node: node for node in inputs + outputs + [("bus", identifier) for identifier in bus_identifiers]}
+
+    def find(node):
+        while parents[node] != node:
+            parents[node] = parents[parents[node]]
+            node = parents[node]
+        return node
+
+    def union(nodes):
+        nodes = list(nodes)
+        for node in nodes[1:]:
+            parents[find(node)] = find(nodes[0])
+
+    for kind, port_infos in (("in", router_config.ports.inputs), ("out", router_config.ports.outputs)):
+        identifiers_by_name = {}
+        for port_info in port_infos:
+            identifiers_by_name.setdefault(port_info.name, []).append((kind, port_info.identifier))
+        for nodes in identifiers_by_name.values():
+            union(nodes)
+
+    def get_node(kind, identifier):
+        return ("bus", identifier) if identifier in bus_identifiers else (kind, identifier)
+
+    def mapping_nodes(from_port, to_ports):
+        from_nodes = inputs if from_port == config.PortConstant.ALL else [get_node("in", from_port.identifier)]
+        to_nodes = outputs if to_ports == config.PortConstant.ALL else [get_node("out", port.identifier) for port in to_ports]
+        if not from_nodes or not to_nodes:
+            return []
+        return from_nodes + to_nodes
+
+    nodes_by_mapping_index = {}
+    for mapping_index, mapping_config in enumerate(router_config.mappings):
+        to_ports = mapping_config.to_port if mapping_config.to_port == config.PortConstant.ALL else [mapping_config.to_port]
+        nodes = mapping_nodes(mapping_config.from_port, to_ports)
+        union(nodes)
+        if nodes:
+            nodes_by_mapping_index[mapping_index] = nodes
+
+    clock_nodes = []
+    clock_config = router_config.clock
+    if clock_config is not None and clock_config.mode != config.ClockMode.PASSTHROUGH:
+        # The clock engine's source and outputs are routed together
+        clock_nodes = outputs if clock_config.to_ports == config.PortConstant.ALL else [
+            ("out", port.identifier) for port in clock_config.to_ports]
+        if clock_config.from_port is not None:
+            clock_nodes = [("in", clock_config.from_port.identifier)] + clock_nodes
+        union(clock_nodes)
+
+    groups_by_root = {}
+    for mapping_index, nodes in nodes_by_mapping_index.items():
+        groups_by_root.setdefault(find(nodes[0]), [set(), set(), [], False])[2].append(mapping_index)
+    if clock_nodes:
+        groups_by_root.setdefault(find(clock_nodes[0]), [set(), set(), [], False])[3] = True
+    for node in inputs + outputs:
+        group = groups_by_root.get(find(node))
+        if group is not None:
+            group[0 if node[0] == "in" else 1].add(node[1])
+    return [tuple(group) for group in groups_by_root.values()]
+
+
+def partition_config(router_config, max_parts):
+    """
+    Split the config into at most max_parts configs of whole routing groups,
+    balancing the number of mappings and ports of each part.
+    """
+    groups = sorted(find_routing_groups(router_config), key=lambda group: -(len(group[0]) + len(group[1]) + len(group[2])))
+    parts = [[set(), set(), [], False] for _ in range(min(max_parts, len(groups)))]
+    for input_identifiers, output_identifiers, mapping_indexes, has_clock in groups:
+        part = min(parts, key=lambda part: len(part[0]) + len(part[1]) + len(part[2]))
+        part[0].update(input_identifiers)
+        part[1].update(output_identifiers)
+        part[2].extend(mapping_indexes)
+        part[3] = part[3] or has_clock
+
+    configs = []
+    for input_identifiers, output_identifiers, mapping_indexes, has_clock in parts:
+        referenced_identifiers = {
+            port.identifier
+            for index in mapping_indexes
+            for port in (router_config.mappings[index].from_port, router_config.mappings[index].to_port)
+            if isinstance(port, config.PortSpecifier)
+        }
+        configs.append(config.Config(
+            ports=config.PortsConfig(
+                inputs=[port for port in router_config.ports.inputs if port.identifier in input_identifiers],
+                outputs=[port for port in router_config.ports.outputs if port.identifier in output_identifiers],
+            ),
+            mappings=[router_config.mappings[index] for index in sorted(mapping_indexes)],
+            clock=router_config.clock if has_clock else None,
+            sysex=router_config.sysex,
+            buses=[bus for bus in router_config.buses if bus.identifier in referenced_identifiers],
+        ))
+    return configs
+
+
+def _run_worker(config_path, stats_socket, trace_rate, log_level, router_kwargs, lock=False):
+    """Entry point of a worker process: a MidiRouter for one part of the config."""
+    logging.basicConfig(level=log_level)
+    # Ctrl-C reaches the whole process group. The supervisor stops its workers.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if lock:
+        # Unlike the scheduling policy and CPU affinity, locked memory isn't inherited
+        for setting, applied, description in apply_realtime_settings(lock=True):
+            if not applied:
+                logger.warning(f"{setting}: not applied, {description}")
+    router_config = load_config(config_path)
+    router = MidiRouter(
+        router_config,
+        tracer=MessageTracer(trace_rate) if trace_rate else None,
+        stats=RouterStats() if stats_socket is not None else None,
+        stats_socket=stats_socket,
+        config_path=config_path,
+        **router_kwargs,
+    )
+    signal.signal(signal.SIGTERM, lambda signum, frame: router.stop())
+    router.run()
+
+
+def get_port_identifiers(router_config):
+    return (
+        {port.identifier for port in router_config.ports.inputs},
+        {port.identifier for port in router_config.ports.outputs},
+    )
+
+
+class _Worker:
+    def __init__(self, index, work_dir, stats):
+        self.index = index
+        self.config_path = os.path.join(work_dir, f"worker-{index}.yaml")
+        self.stats_socket = os.path.join(work_dir, f"worker-{index}.sock") if stats else None
+        self.process = None
+        self.exited_at = None
+        # (input identifiers, output identifiers) of the worker's part of the config
+        self.port_identifiers = None
+
+    def write_config(self, router_config):
+        self.port_identifiers = get_port_identifiers(router_config)
+        # Replace the file in one step, so that the worker never reads a partial config
+        temporary_path = self.config_path + ".tmp"
+        with open(temporary_path, "w") as stream:
+            router_config.to_yaml(stream=stream)
+        os.replace(temporary_path, self.config_path)
+
+
+class ShardedRouter:
+    """
+    Runs independent routing groups (see find_routing_groups) in separate worker
+    processes, so that busy devices in different groups don't compete for the
+    GIL.
+
+    The supervisor owns the config and statistics. It writes every worker's
+    part of the config to a file, which the worker's MidiRouter loads and
+    watches. On a config change, workers get their new parts through those files
+    (and reload without reopening ports) if the partition is unchanged, and are
+    restarted otherwise. Statistics of all workers are merged and served on one
+    socket.
+
+    Each worker watches for device changes itself rather than the supervisor:
+    only the worker can reconcile its ports, it keeps reconciling while the
+    supervisor is busy, and forwarding announcements through the supervisor
+    would only add a hop before every reconcile.
+    """
+    def __init__(self, config, workers, config_path=None, stats_socket=None, trace_rate=None,
+                 log_level=logging.WARNING, router_kwargs=None, lock_memory=False, metrics_address=None):
+        self.config = config
+        self.num_workers = workers
+        self.config_path = config_path
+        self.stats_socket = stats_socket
+        self.metrics_address = metrics_address
+        self.trace_rate = trace_rate
+        self.log_level = log_level
+        self.router_kwargs = router_kwargs or {}
+        self.lock_memory = lock_memory
+        self.workers = []
+        self._context = multiprocessing.get_context("spawn")
+        self._work_dir = None
+        self._started_at = None
+        self._stopping = False
+        self._loop = None
+        self._main_task = None
+
+    def run(self):
+        self._stopping = False
+        self._work_dir = tempfile.mkdtemp(prefix="midi-router-")
+        try:
+            asyncio.run(self._run_async())
+        finally:
+            shutil.rmtree(self._work_dir, ignore_errors=True)
+
+    def stop(self):
+        """Stop run() from another thread."""
+        self._stopping = True
+        loop, main_task = self._loop, self._main_task
+        if loop is not None:
+            try:
+                loop.call_soon_threadsafe(main_task.cancel)
+            except RuntimeError:
+                # The loop already finished
+                pass
+
+    async def _run_async(self):
+        self._loop = asyncio.get_running_loop()
+        self._main_task = asyncio.current_task()
+        self._started_at = time.monotonic()
+        self._start_workers(partition_config(self.config, self.num_workers))
+
+        stats_server = None
+        if self.stats_socket is not None:
+            stats_server = StatsServer(self.stats_socket, self._get_stats_snapshot)
+            await stats_server.start()
+        metrics_server = None
+        if self.metrics_address is not None:
+            metrics_server = MetricsServer(self.metrics_address, self._get_stats_snapshot)
+            await metrics_server.start()
+        reload_requested = asyncio.Event()
+        tasks = [asyncio.create_task(self._supervise_workers())]
+        if self.config_path is not None:
+            tasks.append(asyncio.create_task(self._watch_config_file(reload_requested)))
+            tasks.append(asyncio.create_task(self._reload_on_request(reload_requested)))
+            try:
+                self._loop.add_signal_handler(signal.SIGHUP, reload_requested.set)
+            except (AttributeError, NotImplementedError, RuntimeError, ValueError):
+                logger.debug("Not reloading the config on SIGHUP")
+        try:
+            if not self._stopping:
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+                for task in done:
+                    task.result()
+        except asyncio.CancelledError:
+            if not self._stopping:
+                raise
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self._loop = self._main_task = None
+            self._stop_workers()
+            if stats_server is not None:
+                await stats_server.stop()
+            if metrics_server is not None:
+                await metrics_server.stop()
+
+    def _start_workers(self, worker_configs):
+        logger.info(f"Starting {len(worker_configs)} workers")
+        self.workers = []
+        for index, worker_config in enumerate(worker_configs):
+            worker = _Worker(index, self._work_dir,
+                             stats=self.stats_socket is not None or self.metrics_address is not None)
+            worker.write_config(worker_config)
+            self.workers.append(worker)
+            self._start_worker(worker)
+
+    def _start_worker(self, worker):
+        worker.process = self._context.Process(
+            target=_run_worker,
+            args=(worker.config_path, worker.stats_socket, self.trace_rate, self.log_level, self.router_kwargs,
+                  self.lock_memory),
+            name=f"midi-router worker {worker.index}",
+            daemon=True,
+        )
+        worker.process.start()
+        worker.exited_at = None
+        logger.info(f"Started worker {worker.index} (pid {worker.process.pid})")
+
+    def _stop_workers(self):
+        for worker in self.workers:
+            if worker.process.is_alive():
+                worker.process.terminate()
+        for worker in self.workers:
+            worker.process.join(WORKER_STOP_TIMEOUT)
+            if worker.process.is_alive():
+                logger.warning(f"Killing worker {worker.index}")
+                worker.process.kill()
+                worker.process.join()
+        self.workers = []
+
+    async def _supervise_workers(self):
+        while True:
+            await asyncio.sleep(WORKER_CHECK_SLEEP)
+            now = time.monotonic()
+            for worker in self.workers:
+                if worker.process.is_alive():
+                    continue
+                if worker.exited_at is None:
+                    logger.error(f"Worker {worker.index} exited with code {worker.process.exitcode}")
+                    worker.exited_at = now
+                elif now - worker.exited_at >= WORKER_RESTART_DELAY:
+                    self._start_worker(worker)
+
+    async def _watch_config_file(self, reload_requested):
+        watcher = create_config_watcher(self.config_path)
+        try:
+            while True:
+                await watcher.wait_for_change()
+                reload_requested.set()
+        finally:
+            watcher.close()
+
+    async def _reload_on_request(self, reload_requested):
+        while True:
+            await reload_requested.wait()
+            reload_requested.clear()
+            await self._reload_config()
+
+    def _load_config(self):
+        return load_config(self.config_path)
+
+    async def _reload_config(self):
+        logger.warning(f"Reloading config {self.config_path}")
+        try:
+            new_config = await asyncio.get_running_loop().run_in_executor(None, self._load_config)
+        except Exception as e:
+            logger.error(f"Keeping the current config. Failed to load {self.config_path}: {e}")
+            return
+        if new_config == self.config:
+            logger.info("Config unchanged")
+            return
+
+        worker_configs = partition_config(new_config, self.num_workers)
+        self.config = new_config
+        old_partition = [worker.port_identifiers for worker in self.workers]
+        new_partition = [get_port_identifiers(worker_config) for worker_config in worker_configs]
+        if old_partition == new_partition:
+            # Every worker reloads its own part without reopening ports
+            for worker, worker_config in zip(self.workers, worker_configs):
+                worker.write_config(worker_config)
+        else:
+            logger.warning("Routing groups changed. Restarting workers")
+            await asyncio.get_running_loop().run_in_executor(None, self._stop_workers)
+            self._start_workers(worker_configs)
+
+    async def _get_stats_snapshot(self):
+        """Queries all workers at once, so that a hung worker delays it by at most STATS_TIMEOUT."""
+        worker_snapshots = await asyncio.gather(
+            *(read_stats_async(worker.stats_socket, timeout=STATS_TIMEOUT) for worker in self.workers),
+            return_exceptions=True)
+        snapshot = {
+            "uptime": time.monotonic() - self._started_at,
+            "workers": 0,
+            "expected_workers": len(self.workers),
+            "routes": [],
+            "dispatch": {"queue_depth": 0, "max_queue_depth": 0},
+            "inputs": {},
+            "outputs": {},
+            "network": {},
+            "ports": {"input": {}, "output": {}},
+            "reinitializations": 0,
+        }
+        for worker_snapshot in worker_snapshots:
+            if isinstance(worker_snapshot, BaseException):
+                # Not started yet, restarting, or hung
+                continue
+            snapshot["workers"] += 1
+            snapshot["routes"].extend(worker_snapshot["routes"])
+            dispatch = worker_snapshot["dispatch"]
+            snapshot["dispatch"]["queue_depth"] += dispatch["queue_depth"]
+            snapshot["dispatch"]["max_queue_depth"] = max(snapshot["dispatch"]["max_queue_depth"], dispatch["max_queue_depth"])
+            if "dropped" in dispatch:
+                snapshot["dispatch"]["dropped"] = snapshot["dispatch"].get("dropped", 0) + dispatch["dropped"]
+            for name, lane in dispatch.get("lanes", {}).items():
+                merged_lane = snapshot["dispatch"].setdefault("lanes", {}).setdefault(name, {"depth": 0, "max_depth": 0})
+                merged_lane["depth"] += lane["depth"]
+                merged_lane["max_depth"] = max(merged_lane["max_depth"], lane["max_depth"])
+            snapshot["outputs"].update(worker_snapshot.get("outputs", {}))
+            snapshot["network"].update(worker_snapshot.get("network", {}))
+            snapshot["inputs"].update(worker_snapshot.get("inputs", {}))
+            for direction, ports in worker_snapshot.get("ports", {}).items():
+                snapshot["ports"][direction].update(ports)
+            snapshot["reinitializations"] += worker_snapshot.get("reinitializations", 0)
+            if "clock" in worker_snapshot:
+                snapshot["clock"] = worker_snapshot["clock"]
+            if "gc" in worker_snapshot:
+                worker_gc = worker_snapshot["gc"]
+                merged_gc = snapshot.setdefault("gc", {
+                    "mode": worker_gc["mode"], "collections": [0, 0, 0], "max_pause_us": 0, "total_pause_ms": 0.0})
+                merged_gc["collections"] = [
+                    count + worker_count for count, worker_count in zip(merged_gc["collections"], worker_gc["collections"])]
+                merged_gc["max_pause_us"] = max(merged_gc["max_pause_us"], worker_gc["max_pause_us"])
+                merged_gc["total_pause_ms"] += worker_gc["total_pause_ms"]
+        return snapshot
@@ -0,0 +1,269 @@
+"""
+Dry-run routing without any midi hardware: assigns a list of port names to the
+config's ports and compiles the routing table exactly as the router does, then
+routes a message stream through stand-in ports and reports the fan-out of every
+message, the load of every output and the cost of routing.
+"""
+import asyncio
+import time
+
+import mido
+
+from midi_router.capture import read_capture
+from midi_router.midi_router import MidiRouter
+from midi_router.note_tracker import NoteTracker
+from midi_router.port_registry import PortRegistry
+from midi_router.routing_table import RoutingTable
+from midi_router.transforms import CHANNEL_STATUS_BY_TYPE, SYSTEM_STATUS_BY_TYPE
+
+
+# Short-named ports connected by default get made up port numbers from here on
+DEFAULT_CLIENT = 128
+# Manufacturer ID for non-commercial use, so filters treat it like any dump
+SYNTHETIC_SYSEX_DATA = (0x7D,) + (0,) * 14
+
+
+class SimulatedInputPort:
+    def __init__(self, name):
+        self.name = name
+
+    def close(self):
+        pass
+
+
+class SimulatedOutputPort:
+    """Counts what would be sent."""
+    def __init__(self, name):
+        self.name = name
+        self.sent = 0
+
+    def send(self, message):
+        self.sent += 1
+
+    send_message = send
+
+    def close(self):
+        pass
+
+
+class SimulationRouter(MidiRouter):
+    """
+    MidiRouter whose ports are the given port names, opened as stand-ins.
+    Device keys aren't looked up, since the names don't belong to this machine.
+    """
+    def __init__(self, config, input_port_names, output_port_names, **kwargs):
+        super().__init__(config, **kwargs)
+        self.input_port_names = input_port_names
+        self.output_port_names = output_port_names
+
+    def _get_port_names(self):
+        return list(self.input_port_names), list(self.output_port_names)
+
+    def _get_port_registry(self):
+        return PortRegistry(*self._get_port_names(), get_device_key=lambda long_name: None)
+
+    def _open_input_port(self, long_name):
+        return SimulatedInputPort(long_name)
+
+    def _open_output_port(self, long_name):
+        return SimulatedOutputPort(long_name)
+
+    def compile(self):
+        """Assign the ports and compile the routing table, as when starting."""
+        self.input_ports_by_identifier = {}
+        self.output_ports_by_identifier = {}
+        self.routing_table = None
+        asyncio.run(self._apply_port_changes(self._get_port_registry()))
+
+
+def read_port_names(path):
+    """
+    Port names from a file of one name per line (each available as input and
+    output), or from the output of the info command. Returns (input port names,
+    output port names).
+    """
+    with open(path) as stream:
+        lines = [line.strip() for line in stream]
+    if "MIDI Input Ports:" not in lines and "MIDI Output Ports:" not in lines:
+        names = [line for line in lines if line]
+        return names, list(names)
+    input_port_names, output_port_names = [], []
+    names = None
+    for line in lines:
+        if line == "MIDI Input Ports:":
+            names = input_port_names
+        elif line == "MIDI Output Ports:":
+            names = output_port_names
+        elif line and names is not None:
+            names.append(line)
+    return input_port_names, output_port_names
+
+
+def get_default_port_names(config):
+    """
+    Port names as if every configured device was connected. Every short-named
+    port of a direction (e.g. of identical devices) gets a device of its own,
+    and the nth input and output of a name share theirs.
+    """
+    clients_by_name = {}
+    port_names = []
+    for port_infos in (config.ports.inputs, config.ports.outputs):
+        names = []
+        seen_by_name = {}
+        for port_info in port_infos:
+            if port_info.port:
+                names.append(port_info.long_name)
+                continue
+            index = seen_by_name[port_info.name] = seen_by_name.get(port_info.name, -1) + 1
+            clients = clients_by_name.setdefault(port_info.name, [])
+            if index == len(clients):
+                clients.append(DEFAULT_CLIENT + sum(len(clients) for clients in clients_by_name.values()))
+            names.append(f"{port_info.name} {clients[index]}:0")
+        port_names.append(names)
+    return port_names
+
+
+def synthetic_stream(input_port_names):
+    """Every message type on every channel, from every input."""
+    messages = [
+        mido.Message(message_type, channel=channel, velocity=100) if message_type == "note_on"
+        else mido.Message(message_type, channel=channel)
+        for message_type in CHANNEL_STATUS_BY_TYPE
+        for channel in range(16)
+    ]
+    messages.extend(
+        mido.Message("sysex", data=SYNTHETIC_SYSEX_DATA) if message_type == "sysex" else mido.Message(message_type)
+        for message_type in SYSTEM_STATUS_BY_TYPE
+    )
+    return [(input_port_name, message) for input_port_name in input_port_names for message in messages]
+
+
+def capture_stream(capture_path, input_ports_by_identifier):
+    """The messages of a capture, from the inputs their identifiers are assigned to."""
+    _, records = read_capture(capture_path)
+    return [
+        (input_ports_by_identifier[identifier].name, mido.Message.from_bytes(data))
+        for _, identifier, data in records
+        if identifier in input_ports_by_identifier
+    ]
+
+
+def _get_timing_table(router):
+    """
+    A copy of router's routing table whose clock engine and note tracker are
+    stand-ins, so that repeated routings don't pile up clock or held notes, but
+    cost the same.
+    """
+    routing_table = router.routing_table
+    clock_engine = router.clock_engine
+    clock_stand_in = SimulatedOutputPort(clock_engine.name) if clock_engine is not None else None
+    slots_by_input_port_name = {
+        input_port_name: [
+            tuple((clock_stand_in if to_port is clock_engine else to_port, transform) for to_port, transform in actions)
+            for actions in slots
+        ]
+        for input_port_name, slots in routing_table.slots_by_input_port_name.items()
+    }
+    note_tracker = None if routing_table.note_tracker is None else NoteTracker(raw=router.raw)
+    return RoutingTable(slots_by_input_port_name, note_tracker)
+
+
+def _describe(message):
+    if hasattr(message, "channel"):
+        return f"{message.type} {message.channel}"
+    return message.type
+
+
+def simulate(router, stream, repeat=100):
+    """
+    Route every message of stream ((input port name, mido message) tuples)
+    through router's compiled routing table. Returns a report (see
+    format_report).
+
+    Fan-out and output load count every message once. The cost is the time
+    routing a message takes, averaged over repeat routings of it through a
+    copy of the routing table (see _get_timing_table), so that only the first
+    routing reaches the clock engine and note tracker. Sends to the stand-in
+    ports cost next to nothing, so it is the cost of the router's own work.
+    """
+    routing_table = router.routing_table
+    output_ports = list(router.output_ports_by_identifier.values())
+    route = routing_table.route_bytes if router.raw else routing_table.route
+    timing_table = _get_timing_table(router)
+    timed_route = timing_table.route_bytes if router.raw else timing_table.route
+    clock_engine = router.clock_engine
+
+    load_by_output = {port.name: 0 for port in output_ports}
+    groups = {}
+    for input_port_name, message in stream:
+        data = message.bytes() if router.raw else message
+        sent_before = [port.sent for port in output_ports]
+        actions = route(input_port_name, data)
+        fan_out = 0
+        for port, sent in zip(output_ports, sent_before):
+            if port.sent != sent:
+                load_by_output[port.name] += port.sent - sent
+                fan_out += port.sent - sent
+        if clock_engine is not None and any(to_port is clock_engine for to_port, _ in actions):
+            # The clock engine sends clock on to its outputs itself
+            load_by_output[clock_engine.name] = load_by_output.get(clock_engine.name, 0) + 1
+            fan_out += 1
+
+        started_at = time.perf_counter_ns()
+        for _ in range(repeat):
+            timed_route(input_port_name, data)
+        cost_ns = (time.perf_counter_ns() - started_at) / repeat if repeat else 0
+
+        key = (input_port_name, _describe(message))
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = {"input": input_port_name, "message": key[1], "count": 0, "max_fan_out": 0,
+                                   "total_fan_out": 0, "total_cost_ns": 0.0}
+        group["count"] += 1
+        group["max_fan_out"] = max(group["max_fan_out"], fan_out)
+        group["total_fan_out"] += fan_out
+        group["total_cost_ns"] += cost_ns
+
+    return {
+        "inputs": {identifier: port.name for identifier, port in router.input_ports_by_identifier.items()},
+        "outputs": {identifier: port.name for identifier, port in router.output_ports_by_identifier.items()},
+        "groups": list(groups.values()),
+        "load_by_output": load_by_output,
+    }
+
+
+def format_report(report, config, top=10):
+    lines = ["Ports:"]
+    for direction, port_infos in (("inputs", config.ports.inputs), ("outputs", config.ports.outputs)):
+        for port_info in port_infos:
+            name = report[direction].get(port_info.identifier)
+            lines.append(f"  {port_info.identifier} ({direction[:-1]}): {name or 'not connected'}")
+    lines.append("")
+
+    groups = report["groups"]
+    messages = sum(group["count"] for group in groups)
+    if not messages:
+        lines.append("No messages from connected inputs")
+        return "\n".join(lines)
+    sent = sum(group["total_fan_out"] for group in groups)
+    cost_ns = sum(group["total_cost_ns"] for group in groups)
+    max_fan_out = max(group["max_fan_out"] for group in groups)
+    lines.append(
+        f"Routed {messages} messages to {sent} outputs: fan-out {sent / messages:.1f} on average, "
+        f"{max_fan_out} at most, {cost_ns / messages:.0f} ns per message on average")
+    lines.append("")
+
+    width = max(len(group["input"]) for group in groups)
+    lines.append(f"{'Input':<{width}}  {'message':<18}  {'msgs':>8}  {'fan-out':>7}  {'ns/msg':>8}")
+    for group in sorted(groups, key=lambda group: (-group["max_fan_out"], -group["total_cost_ns"]))[:top]:
+        lines.append(
+            f"{group['input']:<{width}}  {group['message']:<18}  {group['count']:>8}  {group['max_fan_out']:>7}  "
+            f"{group['total_cost_ns'] / group['count']:>8.0f}")
+    lines.append("")
+
+    loads = sorted(report["load_by_output"].items(), key=lambda item: -item[1])[:top]
+    width = max(len(name) for name, _ in loads) if loads else 0
+    lines.append(f"{'Output':<{width}}  {'msgs':>8}  {'share':>6}")
+    for name, load in loads:
+        lines.append(f"{name:<{width}}  {load:>8}  {load / max(sent, 1):>6.1%}")
+    return "\n".join(lines)
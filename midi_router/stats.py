@@ -0,0 +1,258 @@
+import asyncio
+import inspect
+import json
+import os
+import socket
+import tempfile
+import time
+
+
+DEFAULT_STATS_SOCKET = os.path.join(tempfile.gettempdir(), "midi-router.sock")
+
+# Latencies are bucketed with 4 buckets per power of two microseconds (exact below
+# 8us), which bounds the error of reported percentiles to 25%. The last bucket
+# collects everything above ~16s.
+LATENCY_SUB_BUCKETS = 4
+NUM_LATENCY_BUCKETS = 96
+
+
+def latency_bucket(latency_us):
+    if latency_us < 2 * LATENCY_SUB_BUCKETS:
+        return max(latency_us, 0)
+    bit_length = latency_us.bit_length()
+    index = (bit_length - 2) * LATENCY_SUB_BUCKETS + ((latency_us >> (bit_length - 3)) & 3)
+    return min(index, NUM_LATENCY_BUCKETS - 1)
+
+
+def latency_bucket_upper_bound(index):
+    """Upper bound (exclusive) of a bucket in microseconds."""
+    index += 1
+    if index < 2 * LATENCY_SUB_BUCKETS:
+        return index
+    bit_length, sub_bucket = divmod(index, LATENCY_SUB_BUCKETS)
+    return (LATENCY_SUB_BUCKETS + sub_bucket) << (bit_length - 1)
+
+
+class LatencyHistogram:
+    """
+    Fixed-size latency histogram.
+
+    Recording is a couple of integer operations and a list item increment, with
+    no locking. With the direct dispatcher several threads may record into the
+    same histogram, in which case an increment can occasionally be lost, which
+    is acceptable for statistics.
+    """
+    __slots__ = ("buckets", "count", "total_us", "max_us")
+
+    def __init__(self):
+        self.buckets = [0] * NUM_LATENCY_BUCKETS
+        self.count = 0
+        self.total_us = 0
+        self.max_us = 0
+
+    def record(self, latency_us):
+        self.buckets[latency_bucket(latency_us)] += 1
+        self.count += 1
+        self.total_us += latency_us
+        if latency_us > self.max_us:
+            self.max_us = latency_us
+
+    def percentile(self, fraction):
+        buckets = list(self.buckets)
+        target = fraction * sum(buckets)
+        seen = 0
+        for index, count in enumerate(buckets):
+            seen += count
+            if count and seen >= target:
+                return min(latency_bucket_upper_bound(index), self.max_us)
+        return 0
+
+    def nonzero_buckets(self):
+        """(upper bound in microseconds, count) of every bucket that isn't empty."""
+        return [
+            (latency_bucket_upper_bound(index), count)
+            for index, count in enumerate(list(self.buckets))
+            if count
+        ]
+
+
+class RouterStats:
+    """Per-input and per-route message counts and receive-to-send latencies."""
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.counts_by_input = {}
+        self.histograms_by_route = {}
+
+    def record(self, input_port_name, actions, received_at, sent_at):
+        """
+        received_at is the time.perf_counter_ns() when the message was
+        received, sent_at the time.perf_counter_ns() after each of the actions
+        (see RoutingTable.route), so that every route of a message fanned out
+        to several outputs gets its own latency.
+        """
+        counts_by_input = self.counts_by_input
+        counts_by_input[input_port_name] = counts_by_input.get(input_port_name, 0) + 1
+        histograms_by_route = self.histograms_by_route
+        for (to_port, _), action_sent_at in zip(actions, sent_at):
+            route = (input_port_name, to_port.name)
+            histogram = histograms_by_route.get(route)
+            if histogram is None:
+                histogram = histograms_by_route[route] = LatencyHistogram()
+            histogram.record((action_sent_at - received_at) // 1000)
+
+    def snapshot(self):
+        """
+        Counts only: snapshots are read by any number of clients, so message
+        rates are left to each of them (see add_rates).
+        """
+        routes = []
+        for (input_port_name, output_port_name), histogram in list(self.histograms_by_route.items()):
+            routes.append({
+                "input": input_port_name,
+                "output": output_port_name,
+                "count": histogram.count,
+                "p50_us": histogram.percentile(0.5),
+                "p99_us": histogram.percentile(0.99),
+                "max_us": histogram.max_us,
+                "total_us": histogram.total_us,
+                "buckets": histogram.nonzero_buckets(),
+            })
+        return {
+            "uptime": time.monotonic() - self.started_at,
+            "inputs": dict(self.counts_by_input),
+            "routes": routes,
+        }
+
+
+class StatsServer:
+    """
+    Serves a JSON snapshot to every client that connects to a unix socket.
+    get_snapshot may be a coroutine function.
+    """
+    def __init__(self, path, get_snapshot):
+        self.path = path
+        self.get_snapshot = get_snapshot
+        self._server = None
+
+    async def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._server = await asyncio.start_unix_server(self._handle_client, path=self.path)
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    async def _handle_client(self, reader, writer):
+        try:
+            snapshot = self.get_snapshot()
+            if inspect.isawaitable(snapshot):
+                snapshot = await snapshot
+            writer.write(json.dumps(snapshot).encode() + b"\n")
+            await writer.drain()
+        finally:
+            writer.close()
+
+
+def read_stats(path=DEFAULT_STATS_SOCKET, timeout=2.0):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.settimeout(timeout)
+        client.connect(path)
+        chunks = []
+        while chunk := client.recv(65536):
+            chunks.append(chunk)
+    return json.loads(b"".join(chunks))
+
+
+async def read_stats_async(path, timeout=2.0):
+    """read_stats without blocking the event loop."""
+    async def read():
+        reader, writer = await asyncio.open_unix_connection(path, limit=2 ** 24)
+        try:
+            return json.loads(await reader.read())
+        finally:
+            writer.close()
+    return await asyncio.wait_for(read(), timeout)
+
+
+def add_rates(snapshot, previous):
+    """
+    Set the "rate" of every route of snapshot to its messages per second since
+    the previous snapshot. Routes restarted since (e.g. with their worker)
+    count from zero.
+    """
+    elapsed = max(snapshot["uptime"] - previous["uptime"], 1e-9)
+    previous_counts = {(route["input"], route["output"]): route["count"] for route in previous["routes"]}
+    for route in snapshot["routes"]:
+        count = route["count"]
+        previous_count = previous_counts.get((route["input"], route["output"]), 0)
+        if previous_count > count:
+            previous_count = 0
+        route["rate"] = (count - previous_count) / elapsed
+    return snapshot
+
+
+def format_stats(snapshot):
+    dispatch = snapshot["dispatch"]
+    lines = [
+        f"Uptime: {snapshot['uptime']:.0f}s" + (f", {snapshot['workers']} workers" if "workers" in snapshot else ""),
+        f"Dispatch: queue depth {dispatch['queue_depth']} (max {dispatch['max_queue_depth']})"
+        + (f", dropped {dispatch['dropped']}" if "dropped" in dispatch else ""),
+    ]
+    lanes = dispatch.get("lanes")
+    if lanes:
+        lines.append("Lanes: " + ", ".join(
+            f"{name} {lane['depth']} (max {lane['max_depth']})" for name, lane in lanes.items()))
+    clock = snapshot.get("clock")
+    if clock is not None:
+        bpm = "-" if clock["bpm"] is None else f"{clock['bpm']:.2f}"
+        lines.append(f"Clock: {clock['mode']} at {bpm} bpm, {clock['ticks_sent']} ticks sent")
+    garbage_collector = snapshot.get("gc")
+    if garbage_collector is not None:
+        lines.append(
+            f"GC: {garbage_collector['mode']}, "
+            + "/".join(str(count) for count in garbage_collector["collections"])
+            + f" collections (generation 0/1/2), max pause {garbage_collector['max_pause_us']} us, "
+            f"{garbage_collector['total_pause_ms']:.1f} ms in total")
+    ports = snapshot.get("ports")
+    if ports is not None:
+        open_errors = sum(port["open_errors"] for direction in ports.values() for port in direction.values())
+        lines.append(f"Re-initializations: {snapshot['reinitializations']}, failed port opens: {open_errors}")
+    lines.append("")
+
+    outputs = snapshot.get("outputs")
+    if outputs:
+        width = max(len(name) for name in outputs)
+        lines.append(f"{'Output queue':<{width}}  {'depth':>6}  {'dropped':>8}  {'coalesced':>10}")
+        for name, output in outputs.items():
+            lines.append(f"{name:<{width}}  {output['queue_depth']:>6}  {output['dropped']:>8}  {output['coalesced']:>10}")
+        lines.append("")
+
+    network = snapshot.get("network")
+    if network:
+        width = max(len(name) for name in network)
+        lines.append(f"{'Network port':<{width}}  {'datagrams':>10}  {'errors':>7}  {'recovered':>10}  {'lost':>7}")
+        for name, port in network.items():
+            lines.append(
+                f"{name:<{width}}  {port['datagrams']:>10}  {port['errors']:>7}  {port['recovered']:>10}  {port['lost']:>7}")
+        lines.append("")
+
+    routes = snapshot["routes"]
+    if not routes:
+        lines.append("No messages routed yet")
+        return "\n".join(lines)
+
+    route_names = [f"{route['input']} -> {route['output']}" for route in routes]
+    width = max(len(name) for name in route_names)
+    lines.append(f"{'Route':<{width}}  {'msgs':>10}  {'msg/s':>9}  {'p50 us':>8}  {'p99 us':>8}  {'max us':>8}")
+    for name, route in zip(route_names, routes):
+        rate = "-" if "rate" not in route else f"{route['rate']:.1f}"
+        lines.append(
+            f"{name:<{width}}  {route['count']:>10}  {rate:>9}  "
+            f"{route['p50_us']:>8}  {route['p99_us']:>8}  {route['max_us']:>8}"
+        )
+    return "\n".join(lines)
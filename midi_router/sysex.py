@@ -0,0 +1,107 @@
+import collections
+import logging
+import threading
+
+
+logger = logging.getLogger("midi_router")
+
+
+SYSEX_STATUS = 0xF0
+
+
+class SysexOutputPort:
+    """
+    Output port wrapper that sends SysEx dumps from its own thread.
+
+    Routing a dump only queues it, and the same message (or byte list) is
+    queued to every output rather than copied. The sender thread sends one dump
+    at a time, then waits as long as the dump takes on the wire at
+    bytes_per_second, so that a patch bank made of many dumps doesn't overrun the
+    device. Other messages are sent straight away instead of waiting behind the
+    queued dumps, so dumps never hold back clock and notes by more than the
+    send of a single dump. Sends are serialized, like LockedOutputPort.
+
+    When queue_size dumps are already waiting, new dumps are dropped.
+    """
+    def __init__(self, port, raw=False, bytes_per_second=None, queue_size=64):
+        self.port = port
+        self.name = port.name
+        self.raw = raw
+        self.bytes_per_second = bytes_per_second
+        self.queue_size = queue_size
+        self.dropped = 0
+        self.closed = False
+        self._send = port.send_message if raw else port.send
+        self._lock = threading.Lock()
+        self._pending = collections.deque()
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._write, name=f"sysex {self.name}", daemon=True)
+        self._thread.start()
+
+    def configure(self, sysex_config):
+        """Apply new settings (see config.SysexConfig) from a config reload."""
+        self.bytes_per_second = sysex_config.bytes_per_second
+        self.queue_size = sysex_config.queue_size
+
+    def send(self, message):
+        is_sysex = message[0] == SYSEX_STATUS if self.raw else message.type == "sysex"
+        if is_sysex:
+            with self._condition:
+                if self.closed:
+                    return
+                if len(self._pending) >= self.queue_size:
+                    self.dropped += 1
+                    logger.warning(f"Dropping SysEx to {self.name}: {len(self._pending)} dumps are already waiting")
+                    return
+                self._pending.append(message)
+                self._condition.notify()
+        else:
+            with self._lock:
+                if not self.closed:
+                    self._send(message)
+
+    # Raw mode sends bytes through send_message
+    send_message = send
+
+    def _write(self):
+        pending = self._pending
+        while True:
+            with self._condition:
+                while not pending and not self.closed:
+                    self._condition.wait()
+                if self.closed:
+                    return
+                message = pending.popleft()
+            try:
+                with self._lock:
+                    if self.closed:
+                        return
+                    self._send(message)
+            except Exception:
+                logger.exception(f"Failed to send SysEx to {self.name}")
+                continue
+            bytes_per_second = self.bytes_per_second
+            if bytes_per_second:
+                size = len(message) if self.raw else len(message.data) + 2
+                with self._condition:
+                    self._condition.wait_for(lambda: self.closed, size / bytes_per_second)
+
+    def close(self):
+        # Dumps still queued are discarded; the device is usually gone by now.
+        with self._condition:
+            self.closed = True
+            self._pending.clear()
+            self._condition.notify()
+        with self._lock:
+            self.port.close()
+        self._thread.join(timeout=1)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.port!r})"
+
+
+def find_sysex_output_port(port):
+    """The SysexOutputPort port wraps (possibly through other wrappers), or None."""
+    while port is not None and not isinstance(port, SysexOutputPort):
+        port = getattr(port, "port", None)
+    return port
@@ -0,0 +1,97 @@
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+
+trace_logger = logging.getLogger("midi_router.trace")
+
+
+# Default maximum number of traced messages per second. Anything above this is
+# skipped (and counted) so that tracing a busy clock or CC stream stays cheap.
+DEFAULT_TRACE_RATE = 50
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that enqueues records as-is.
+
+    The default implementation formats the record in the calling thread, which
+    would put the string formatting back on the routing path. Instead the
+    listener's handlers format it on the background thread.
+    """
+    def prepare(self, record):
+        return record
+
+
+class _Trace:
+    """Formats a routed message lazily, when the record is handled."""
+    __slots__ = ("input_port_name", "message", "actions", "skipped")
+
+    def __init__(self, input_port_name, message, actions, skipped):
+        self.input_port_name = input_port_name
+        self.message = message
+        self.actions = actions
+        self.skipped = skipped
+
+    def __str__(self):
+        message = self.message
+        if not hasattr(message, "type"):
+            message = " ".join(f"{byte:02X}" for byte in message)
+        lines = [f"from {self.input_port_name}: {message}"]
+        for to_port, transform in self.actions:
+            if transform is None:
+                lines.append(f"  to {to_port.name}")
+            else:
+                lines.append(f"  to {to_port.name} ({transform})")
+        if self.skipped:
+            lines.append(f"  ({self.skipped} messages not traced since the previous trace)")
+        return "\n".join(lines)
+
+
+class MessageTracer:
+    """
+    Rate-limited trace of routed messages.
+
+    Calling the tracer only does token bucket bookkeeping and enqueues a record;
+    formatting and I/O happen on a QueueListener thread using the root logger's
+    handlers. The bookkeeping is locked, as the direct dispatcher traces from
+    every input's thread.
+    """
+    def __init__(self, max_per_second=DEFAULT_TRACE_RATE):
+        self.max_per_second = max_per_second
+        self.skipped = 0
+        self._tokens = max_per_second
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+        self._queue = queue.SimpleQueue()
+        self._handler = _DeferredQueueHandler(self._queue)
+        self._listener = None
+
+    def start(self):
+        self._listener = logging.handlers.QueueListener(
+            self._queue, *logging.getLogger().handlers, respect_handler_level=True)
+        trace_logger.addHandler(self._handler)
+        trace_logger.setLevel(logging.INFO)
+        trace_logger.propagate = False
+        self._listener.start()
+
+    def stop(self):
+        trace_logger.removeHandler(self._handler)
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
+
+    def __call__(self, input_port_name, message, actions):
+        with self._lock:
+            now = time.monotonic()
+            tokens = min(self.max_per_second, self._tokens + (now - self._last_refill) * self.max_per_second)
+            self._last_refill = now
+            if tokens < 1:
+                self._tokens = tokens
+                self.skipped += 1
+                return
+            self._tokens = tokens - 1
+            skipped, self.skipped = self.skipped, 0
+        trace_logger.info("%s", _Trace(input_port_name, message, actions, skipped))
@@ -0,0 +1,274 @@
+# Status bytes of channel voice messages (without the channel) and of system
+# messages, by mido message type
+CHANNEL_STATUS_BY_TYPE = {
+    "note_off": 0x80,
+    "note_on": 0x90,
+    "polytouch": 0xA0,
+    "control_change": 0xB0,
+    "program_change": 0xC0,
+    "aftertouch": 0xD0,
+    "pitchwheel": 0xE0,
+}
+SYSTEM_STATUS_BY_TYPE = {
+    "sysex": 0xF0,
+    "quarter_frame": 0xF1,
+    "songpos": 0xF2,
+    "song_select": 0xF3,
+    "tune_request": 0xF6,
+    "clock": 0xF8,
+    "start": 0xFA,
+    "continue": 0xFB,
+    "stop": 0xFC,
+    "active_sensing": 0xFE,
+    "reset": 0xFF,
+}
+
+
+class RouteTransform:
+    """
+    Compiled rewrite of a channel voice message on one route.
+
+    Every part is either None (unchanged) or precomputed: the output channel,
+    and 128 entry tables mapping the first data byte (note or controller
+    number, where None drops the message) and the second data byte (velocity).
+    Applying a transform is a few lookups, however many rules it was compiled
+    from.
+    """
+    __slots__ = ("channel", "data1_name", "data1_table", "data2_table", "description", "key")
+
+    def __init__(self, channel=None, data1_name=None, data1_table=None, data2_table=None, description=""):
+        self.channel = channel
+        # The mido attribute of the first data byte ("note" or "control")
+        self.data1_name = data1_name
+        self.data1_table = data1_table
+        self.data2_table = data2_table
+        self.description = description
+        # Equal transforms have equal keys, which lets the routing table dedupe them
+        self.key = (channel, data1_table, data2_table)
+
+    def apply(self, message):
+        """Transform a mido message. Returns None if the message is dropped."""
+        changes = {}
+        if self.channel is not None:
+            changes["channel"] = self.channel
+        if self.data1_table is not None:
+            value = self.data1_table[getattr(message, self.data1_name)]
+            if value is None:
+                return None
+            changes[self.data1_name] = value
+        if self.data2_table is not None:
+            changes["velocity"] = self.data2_table[message.velocity]
+        return message.copy(**changes)
+
+    def apply_bytes(self, data):
+        """Transform a raw message. Returns None if the message is dropped."""
+        rewritten = bytearray(data)
+        if self.channel is not None:
+            rewritten[0] = (rewritten[0] & 0xF0) | self.channel
+        if self.data1_table is not None:
+            value = self.data1_table[rewritten[1]]
+            if value is None:
+                return None
+            rewritten[1] = value
+        if self.data2_table is not None:
+            rewritten[2] = self.data2_table[rewritten[2]]
+        return rewritten
+
+    def __str__(self):
+        return self.description
+
+
+def get_sysex_manufacturer(data, start):
+    """The manufacturer ID bytes of a SysEx message whose data starts at data[start]."""
+    if len(data) > start and data[start] == 0:
+        return tuple(data[start:start + 3])
+    return tuple(data[start:start + 1])
+
+
+class SysexFilter:
+    """
+    Compiled SysEx filter of one route. Drops dumps that are too long, or whose
+    manufacturer isn't allowed, and passes everything else on unchanged.
+    """
+    __slots__ = ("max_size", "manufacturers", "exclude_manufacturers", "description", "key")
+
+    def __init__(self, max_size=None, manufacturers=None, exclude_manufacturers=frozenset(), description=""):
+        # Sizes include F0 and F7, manufacturers are sets of ID byte tuples
+        self.max_size = max_size
+        self.manufacturers = manufacturers
+        self.exclude_manufacturers = exclude_manufacturers
+        self.description = description
+        self.key = (max_size, manufacturers, exclude_manufacturers)
+
+    def _allows(self, manufacturer):
+        if self.manufacturers is not None and manufacturer not in self.manufacturers:
+            return False
+        return manufacturer not in self.exclude_manufacturers
+
+    def apply(self, message):
+        """Filter a mido sysex message (whose data excludes F0 and F7). Returns None if it is dropped."""
+        data = message.data
+        if self.max_size is not None and len(data) + 2 > self.max_size:
+            return None
+        if not self._allows(get_sysex_manufacturer(data, 0)):
+            return None
+        return message
+
+    def apply_bytes(self, data):
+        """Filter a raw sysex message. Returns None if it is dropped."""
+        if self.max_size is not None and len(data) > self.max_size:
+            return None
+        if not self._allows(get_sysex_manufacturer(data, 1)):
+            return None
+        return data
+
+    def __str__(self):
+        return self.description
+
+
+def compile_note_table(mapping_config):
+    notes, transpose = mapping_config.notes, mapping_config.transpose
+    if notes is None and not transpose:
+        return None
+    low, high = (notes.low, notes.high) if notes is not None else (0, 127)
+    return tuple(
+        note + transpose if low <= note <= high and 0 <= note + transpose <= 127 else None
+        for note in range(128)
+    )
+
+
+def compile_velocity_table(mapping_config):
+    curve = mapping_config.velocity
+    if curve is None:
+        return None
+    # Velocity 0 is a note off and stays one
+    return (0,) + tuple(
+        round(curve.min + (curve.max - curve.min) * ((velocity - 1) / 126) ** curve.gamma)
+        for velocity in range(1, 128)
+    )
+
+
+def compile_control_table(mapping_config):
+    if not mapping_config.control_map:
+        return None
+    return tuple(mapping_config.control_map.get(control, control) for control in range(128))
+
+
+def _manufacturer_set(manufacturers):
+    return frozenset(
+        tuple(manufacturer) if isinstance(manufacturer, list) else (manufacturer,)
+        for manufacturer in manufacturers
+    )
+
+
+def compile_sysex_filter(mapping_config, max_size=None):
+    """max_size is the global limit, which applies along with the mapping's own."""
+    if mapping_config.max_sysex_size is not None:
+        max_size = mapping_config.max_sysex_size if max_size is None else min(max_size, mapping_config.max_sysex_size)
+    manufacturers = None
+    if mapping_config.sysex_manufacturers is not None:
+        manufacturers = _manufacturer_set(mapping_config.sysex_manufacturers)
+    exclude_manufacturers = _manufacturer_set(mapping_config.exclude_sysex_manufacturers)
+    if max_size is None and manufacturers is None and not exclude_manufacturers:
+        return None
+
+    parts = []
+    if max_size is not None:
+        parts.append(f"max {max_size} bytes")
+    if manufacturers is not None or exclude_manufacturers:
+        parts.append("manufacturer filter")
+    return SysexFilter(max_size, manufacturers, exclude_manufacturers, ", ".join(parts))
+
+
+def allowed_message_types(mapping_config):
+    if mapping_config.message_types is None:
+        message_types = set(CHANNEL_STATUS_BY_TYPE) | set(SYSTEM_STATUS_BY_TYPE)
+    else:
+        message_types = set(mapping_config.message_types)
+    return message_types - set(mapping_config.exclude_message_types)
+
+
+class MappingTransforms:
+    """The transforms of one mapping, compiled once when the config is loaded."""
+    def __init__(self, mapping_config, max_sysex_size=None):
+        self.message_types = allowed_message_types(mapping_config)
+        self.sysex_filter = compile_sysex_filter(mapping_config, max_sysex_size)
+        self.note_table = compile_note_table(mapping_config)
+        self.velocity_table = compile_velocity_table(mapping_config)
+        self.control_table = compile_control_table(mapping_config)
+        self._transforms = {}
+
+    def get(self, message_type, to_channel):
+        """
+        The RouteTransform for a channel voice message type sent to to_channel
+        (None if unchanged), or None if the message is sent unchanged.
+        """
+        if message_type in ("note_on", "note_off"):
+            data1_name, data1_table = "note", self.note_table
+            # Only note on velocities are curved
+            data2_table = self.velocity_table if message_type == "note_on" else None
+        elif message_type == "polytouch":
+            data1_name, data1_table, data2_table = "note", self.note_table, None
+        elif message_type == "control_change":
+            data1_name, data1_table, data2_table = "control", self.control_table, None
+        else:
+            data1_name = data1_table = data2_table = None
+        if data1_table is None:
+            data1_name = None
+
+        if to_channel is None and data1_table is None and data2_table is None:
+            return None
+        key = (to_channel, data1_name, data2_table is not None)
+        transform = self._transforms.get(key)
+        if transform is None:
+            parts = []
+            if to_channel is not None:
+                parts.append(f"channel {to_channel}")
+            if data1_name is not None:
+                parts.append(f"{data1_name} map")
+            if data2_table is not None:
+                parts.append("velocity curve")
+            transform = self._transforms[key] = RouteTransform(
+                to_channel, data1_name, data1_table, data2_table, ", ".join(parts))
+        return transform
+
+
+def _compose_tables(first, second):
+    if first is None:
+        return second
+    if second is None:
+        return first
+    return tuple(None if value is None else second[value] for value in first)
+
+
+def compose_transforms(first, second, from_channel=None):
+    """
+    The transform of a route that applies first, then second (either of which
+    can be None for unchanged), for joining routes through a bus. from_channel
+    is the channel of the messages the route takes, for channel messages.
+    """
+    if first is None:
+        return second
+    if second is None:
+        return first
+    if isinstance(first, SysexFilter):
+        max_sizes = [size for size in (first.max_size, second.max_size) if size is not None]
+        if first.manufacturers is None or second.manufacturers is None:
+            manufacturers = first.manufacturers if second.manufacturers is None else second.manufacturers
+        else:
+            manufacturers = first.manufacturers & second.manufacturers
+        return SysexFilter(
+            min(max_sizes) if max_sizes else None, manufacturers,
+            first.exclude_manufacturers | second.exclude_manufacturers,
+            f"{first.description}, then {second.description}")
+
+    channel = first.channel if second.channel is None else second.channel
+    if channel == from_channel:
+        channel = None
+    data1_table = _compose_tables(first.data1_table, second.data1_table)
+    data2_table = _compose_tables(first.data2_table, second.data2_table)
+    if channel is None and data1_table is None and data2_table is None:
+        return None
+    return RouteTransform(
+        channel, first.data1_name or second.data1_name, data1_table, data2_table,
+        f"{first.description}, then {second.description}")